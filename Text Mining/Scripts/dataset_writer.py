@@ -0,0 +1,206 @@
+"""
+Partitioned Parquet dataset for the processed WSB posts and comments.
+
+Rows are written Hive style as <root>/doc_type=<type>/created_date=<YYYY-MM-DD>/
+part-<run>-<seq>.parquet. created_date is the local day of created_utc, the
+same clock as created_utc_datetime (wsb_schema.localDatetimes), so a date
+filter on the partitions matches the datetime column. The partition columns are dropped from the files and
+come back from the path, which is what Spark, DuckDB and pyarrow.dataset expect.
+Partitions are written in parallel threads because pyarrow releases the GIL
+while encoding. Each file is sorted by created_utc and cut into row groups of
+ROW_GROUP_ROWS, so row group stats stay tight.
+
+Column types follow wsb_schema. Categoricals are stored as Parquet dictionaries
+and strings as Arrow strings, and the readers cast back to the schema, so a
+frame read from the dataset is as compact as the one that was written.
+
+_manifest.jsonl at the root lists every file with its partition values, row
+count, size and min/max of the numeric and datetime columns, one JSON line per
+file. A write appends only its own lines, so the cost of a write does not grow
+with the dataset. The readers below prune on it without listing directories or
+opening footers. A _manifest.json from before, a single JSON document, is still
+read.
+"""
+
+import concurrent.futures
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from wsb_schema import applySchema, localDatetimes
+
+PARTITION_COLUMNS = ['doc_type', 'created_date']
+MANIFEST_NAME = '_manifest.jsonl'
+LEGACY_MANIFEST_NAME = '_manifest.json'
+COMPRESSION = 'zstd'  # or 'snappy' for readers that favour decode speed
+ROW_GROUP_ROWS = 128 * 1024
+WRITE_THREADS = 8
+
+# A run id for the part file names, unique even for runs started in the same second.
+def newRunId():
+    return time.strftime('%Y%m%d%H%M%S', time.localtime()) + '-' + uuid.uuid4().hex[:8]
+
+# Values of the k=v directories in a part file path.
+def partitionValues(path):
+    values = {}
+    for part in os.path.normpath(path).split(os.sep):
+        key, sep, value = part.partition('=')
+        if sep and key in PARTITION_COLUMNS:
+            values[key] = value
+    return values
+
+# Min/max of the numeric and datetime columns, JSON ready.
+def columnStats(df):
+    stats = {}
+    for col in df.columns:
+        s = df[col]
+        if not (pd.api.types.is_numeric_dtype(s) or pd.api.types.is_datetime64_any_dtype(s)) or pd.api.types.is_bool_dtype(s):
+            continue
+        s = s.dropna()
+        if s.empty:
+            continue
+        lo, hi = s.min(), s.max()
+        if pd.api.types.is_datetime64_any_dtype(s):
+            lo, hi = lo.isoformat(), hi.isoformat()
+        else:
+            lo, hi = np.asarray(lo).item(), np.asarray(hi).item()
+        stats[col] = {'min': lo, 'max': hi}
+    return stats
+
+# Write one partition, returns its manifest entry.
+def writePartition(root, key, part, runId, seq, compression):
+    docType, createdDate = key
+    folder = os.path.join(root, 'doc_type=' + str(docType), 'created_date=' + createdDate)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'part-' + runId + '-' + str(seq).zfill(5) + '.parquet')
+
+    if 'created_utc' in part.columns:
+        part = part.sort_values('created_utc', kind='stable')
+    part = part.drop(columns=PARTITION_COLUMNS)
+    # Only the categories this file uses go into its dictionaries.
+    for col in part.columns:
+        if isinstance(part[col].dtype, pd.CategoricalDtype):
+            part[col] = part[col].cat.remove_unused_categories()
+    table = pa.Table.from_pandas(part, preserve_index=False)
+    pq.write_table(table, path, compression=compression, row_group_size=ROW_GROUP_ROWS)
+
+    return {'path': os.path.relpath(path, root),
+            'doc_type': str(docType),
+            'created_date': createdDate,
+            'rows': int(part.shape[0]),
+            'bytes': os.path.getsize(path),
+            'stats': columnStats(part)}
+
+# The created_date partition of every row: the local day, like created_utc_datetime.
+def createdDates(df):
+    if 'created_utc_datetime' in df.columns:
+        local = pd.to_datetime(df['created_utc_datetime'])
+    elif 'created_utc' in df.columns:
+        local = pd.Series(localDatetimes(df['created_utc']).to_numpy(), index=df.index)
+    else:
+        return 'unknown'
+    return local.dt.strftime('%Y-%m-%d').fillna('unknown')
+
+# Write the part files of df without touching the manifest, returns their entries.
+# For writers in several processes: they return the entries and one process appends them.
+def writeParts(root, df, runId, seq=1, compression=COMPRESSION, threads=WRITE_THREADS):
+    os.makedirs(root, exist_ok=True)
+    df = df.assign(created_date=createdDates(df))
+
+    groups = df.groupby(PARTITION_COLUMNS, sort=True, observed=True)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(writePartition, root, key, part, runId, seq, compression) for key, part in groups]
+        return [f.result() for f in futures]
+
+# Write df into the dataset at root, one file per (doc_type, local day) partition.
+# seq tells apart several calls with the same runId, e.g. streaming chunks.
+def writeDataset(root, df, runId=None, seq=1, compression=COMPRESSION, threads=WRITE_THREADS):
+    entries = writeParts(root, df, runId or newRunId(), seq, compression, threads)
+    appendManifest(root, entries)
+    return entries
+
+# Read the manifest, empty when the dataset is new.  A line cut short by a crash is skipped.
+def readManifest(root):
+    files = []
+    legacy = os.path.join(root, LEGACY_MANIFEST_NAME)
+    if os.path.exists(legacy):
+        with open(legacy, encoding='utf-8') as f:
+            files.extend(json.load(f)['files'])
+    path = os.path.join(root, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    files.append(json.loads(line))
+                except ValueError:
+                    continue
+    return {'files': files}
+
+# Add entries to the manifest in one appending write.  A line cut short by a crash is ended first.
+def appendManifest(root, entries):
+    if not entries:
+        return
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, MANIFEST_NAME)
+    lines = ''.join(json.dumps(entry) + '\n' for entry in entries)
+    with open(path, 'a+b') as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                lines = '\n' + lines
+        f.write(lines.encode('utf-8'))
+
+# Part files matching the filters, pruned on the manifest.  start/end are
+# inclusive 'YYYY-MM-DD' strings.
+def datasetFiles(root, docTypes=None, start=None, end=None):
+    files = []
+    for entry in readManifest(root)['files']:
+        if docTypes is not None and entry['doc_type'] not in docTypes:
+            continue
+        if start is not None and entry['created_date'] < start:
+            continue
+        if end is not None and entry['created_date'] > end:
+            continue
+        files.append(os.path.join(root, entry['path']))
+    return files
+
+# Read one part file with its partition columns put back, in the schema types.
+def readPart(path, columns=None):
+    values = partitionValues(path)
+    fileColumns = None if columns is None else [c for c in columns if c not in values]
+    df = pd.read_parquet(path, columns=fileColumns)
+    for key, value in values.items():
+        if columns is None or key in columns:
+            df[key] = value
+    return applySchema(df)
+
+# Row groups in a part file.
+def rowGroupCount(path):
+    return pq.ParquetFile(path).metadata.num_row_groups
+
+# Stream one part file as frames of at most batchRows rows, like readPart.
+# Only columns (and rowGroups, if given) are read, and at most a row group is decoded at a time.
+def iterPart(path, columns=None, batchRows=ROW_GROUP_ROWS, rowGroups=None):
+    values = partitionValues(path)
+    fileColumns = None if columns is None else [c for c in columns if c not in values]
+    with pq.ParquetFile(path) as f:
+        for batch in f.iter_batches(batch_size=batchRows, row_groups=rowGroups, columns=fileColumns):
+            df = batch.to_pandas()
+            for key, value in values.items():
+                if columns is None or key in columns:
+                    df[key] = value
+            yield applySchema(df)
+
+# Read the matching part of the dataset into one frame.
+def readDataset(root, docTypes=None, start=None, end=None, columns=None):
+    files = datasetFiles(root, docTypes, start, end)
+    if not files:
+        return pd.DataFrame(columns=columns)
+    # Categoricals with different categories concat to strings, the schema makes them categorical again.
+    return applySchema(pd.concat([readPart(f, columns) for f in files], ignore_index=True))
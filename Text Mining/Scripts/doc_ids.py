@@ -0,0 +1,129 @@
+"""
+Deterministic Elasticsearch document ids for the WSB loader.
+
+An id hashes a declared key and nothing else. By default the key is the Reddit
+id plus doc_type; any canonical column subset can be used instead. Key values
+are taken as strings and joined with a unit separator, so the id does not
+depend on pandas formatting, column order or dtypes.
+
+The hash is computed over whole columns in numpy. The joined keys are laid out
+as a padded byte matrix, two FNV-1a lanes with different offsets run over it a
+byte position at a time, and each lane ends with a splitmix64 finalizer. The
+result is 128 bits, written as 32 hex characters. Since the algorithm lives
+here it never changes under a library upgrade. Keys are hashed in blocks of
+HASH_ROWS so long keys stay bounded in memory.
+
+idMigration scans an index written with the old row-hash ids and maps each
+_id to the id its key gives now. applyIdMigration moves the documents over.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+DOC_KEY = ('id', 'doc_type')
+HASH_ROWS = 1 << 16
+SEPARATOR = '\x1f'
+
+_FNV_PRIME = np.uint64(0x100000001b3)
+_LANES = (np.uint64(0xcbf29ce484222325), np.uint64(0x84222325cbf29ce4))
+_HEX = np.array([('%04x' % i).encode() for i in range(1 << 16)], dtype='S4')
+
+# splitmix64 finalizer, spreads every input bit over the output.
+def _mix(h):
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+# The key columns joined into one Arrow string per row.  Nulls are an empty value.
+def canonicalKeys(df, key=DOC_KEY):
+    parts = []
+    for col in key:
+        arr = pa.array(df[col], from_pandas=True)
+        if isinstance(arr, pa.ChunkedArray):
+            arr = arr.combine_chunks()
+        if pa.types.is_dictionary(arr.type):
+            arr = arr.dictionary_decode()
+        parts.append(pc.fill_null(arr.cast(pa.large_string()), ''))
+    if len(parts) == 1:
+        return parts[0]
+    return pc.binary_join_element_wise(*parts, pa.scalar(SEPARATOR, pa.large_string()))
+
+# Two 64 bit hashes of every string of an Arrow string array.
+def hashStrings(arr):
+    arr = arr.cast(pa.large_string())
+    n = len(arr)
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64, count=n + 1, offset=8 * arr.offset)
+    data = np.frombuffer(arr.buffers()[2], dtype=np.uint8) if arr.buffers()[2] is not None else np.empty(0, np.uint8)
+    out = np.empty((n, 2), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for lo in range(0, n, HASH_ROWS):
+            hi = min(n, lo + HASH_ROWS)
+            starts = offsets[lo:hi]
+            lengths = offsets[lo + 1:hi + 1] - starts
+            width = int(lengths.max()) if hi > lo else 0
+            lanes = [np.full(hi - lo, seed, dtype=np.uint64) for seed in _LANES]
+            last = np.maximum(starts + lengths - 1, 0)
+            for j in range(width):
+                live = lengths > j
+                byte = data[np.minimum(starts + j, last)].astype(np.uint64)
+                for k, h in enumerate(lanes):
+                    lanes[k] = np.where(live, (h ^ byte) * _FNV_PRIME, h)
+            out[lo:hi, 0] = _mix(lanes[0] ^ lengths.astype(np.uint64))
+            out[lo:hi, 1] = _mix(lanes[1] + lengths.astype(np.uint64))
+    return out
+
+# 32 hex character ids for the rows of df, from the key columns.
+def documentIds(df, key=DOC_KEY):
+    hashes = hashStrings(canonicalKeys(df, key))
+    digits = _HEX[hashes.astype('>u8').view('>u2').reshape(-1, 8)]
+    return np.ascontiguousarray(digits).view('S32').ravel().astype(str).tolist()
+
+# Map the ids of index to the ids of their key.  Returns a frame of old_id, new_id for
+# the documents whose id changes.  Uses a scroll, so it sees the index as of the start.
+def idMigration(es, index, key=DOC_KEY, pageSize=5000):
+    from elasticsearch import helpers
+    old = []
+    rows = []
+    for hit in helpers.scan(es, index=index, _source=list(key), size=pageSize, query={'query': {'match_all': {}}}):
+        old.append(hit['_id'])
+        rows.append(hit.get('_source', {}))
+    mapping = pd.DataFrame({'old_id': old})
+    if old:
+        mapping['new_id'] = documentIds(pd.DataFrame(rows, columns=list(key)), key)
+    else:
+        mapping['new_id'] = []
+    return mapping[mapping['old_id'] != mapping['new_id']].reset_index(drop=True)
+
+# Re-key the documents of a migration: each is created under its new id in target
+# (index itself by default).  When target is index, the old documents whose create came
+# back 201 or 409 are then deleted in a second bulk call, so a failed create never loses
+# a document.  Returns the bulk stats.
+def applyIdMigration(es, index, mapping, target=None, batch=1000):
+    import json
+    from es_bulk import BulkIndexer, actionLine
+    target = target or index
+    with BulkIndexer(es) as indexer:
+        for lo in range(0, mapping.shape[0], batch):
+            part = mapping.iloc[lo:lo + batch]
+            found = es.mget(index=index, ids=part['old_id'].tolist())['docs']
+            lines = []
+            pairs = []
+            for doc, newId in zip(found, part['new_id']):
+                if not doc.get('found'):
+                    continue
+                lines.append(actionLine('create', target, newId) + '\n' + json.dumps(doc['_source']) + '\n')
+                pairs.append((newId, doc['_id']))
+            if not lines:
+                continue
+            items = indexer.sendNow(''.join(lines).encode('utf-8'), [newId for newId, _ in pairs])
+            if target != index:
+                continue
+            stored = {result['_id'] for item in items for result in item.values() if result.get('status') in (201, 409)}
+            moved = [oldId for newId, oldId in pairs if newId in stored]
+            if moved:
+                indexer.submit(''.join(actionLine('delete', index, docId) + '\n' for docId in moved).encode('utf-8'),
+                               moved)
+        indexer.collect()
+    return indexer.stats
@@ -0,0 +1,253 @@
+"""
+Bulk indexing for the WSB Elasticsearch loader.
+
+Documents go out through the _bulk API as NDJSON bodies capped at MAX_DOCS
+documents and MAX_BYTES bytes. Up to IN_FLIGHT bodies are in flight at once
+on one client. The default action is create, the bulk form of
+op_type=create. A document whose id is already in the index comes back as a
+per-item 409, which is counted as existing instead of being checked first with
+es.exists. Every other per-item failure is collected with its id, type and
+reason. The documents themselves are rendered to JSON lines by pandas in one
+call per frame.
+
+Backpressure: a request answered 429 is sent again, and so are just the items
+rejected with es_rejected_execution_exception. Each retry waits a jittered
+exponential backoff (full jitter, BACKOFF_BASE doubling up to BACKOFF_MAX) and
+gives up after MAX_RETRIES, counting what is left as failed. A RateLimiter caps
+documents per second over every process that shares it, retries included.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import random
+import time
+
+from elasticsearch import ApiError, Elasticsearch
+
+ES_HOSTS = ['http://localhost:9200']
+MAX_DOCS = 5000
+MAX_BYTES = 10 * 1024 * 1024
+IN_FLIGHT = 4
+# Per-item errors kept for the report, the rest are only counted.
+MAX_ERRORS = 1000
+RETRY_STATUS = (429,)
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# A client for the loaders.  Retries are off, the bulk indexer decides what to resend.
+def newClient(hosts=None, connections=IN_FLIGHT, timeout=120):
+    return Elasticsearch(hosts or ES_HOSTS, connections_per_node=connections, request_timeout=timeout,
+                         max_retries=0, retry_on_status=())
+
+# One JSON line per row: NaN and NaT become null, datetimes ISO 8601.  Split on '\n' only,
+# which to_json escapes inside values, unlike the U+2028 and U+0085 splitlines also cuts at.
+def jsonLines(df):
+    if df.shape[0] == 0:
+        return []
+    lines = df.to_json(orient='records', lines=True, date_format='iso', force_ascii=False).rstrip('\n').split('\n')
+    if len(lines) != df.shape[0]:
+        raise ValueError('%d JSON lines for %d rows' % (len(lines), df.shape[0]))
+    return lines
+
+# The action line of a document.
+def actionLine(opType, index, docId):
+    meta = {'_index': index}
+    if docId is not None:
+        meta['_id'] = docId
+    return json.dumps({opType: meta})
+
+# Cut (id, source line) pairs into NDJSON bulk bodies of at most maxDocs documents and maxBytes bytes.
+# Yields (body, ids).  A single document larger than maxBytes goes out alone.
+def bulkBodies(ids, sources, index, opType='create', maxDocs=MAX_DOCS, maxBytes=MAX_BYTES):
+    lines = []
+    batchIds = []
+    size = 0
+    for docId, source in zip(ids, sources):
+        entry = (actionLine(opType, index, docId) + '\n' + source + '\n').encode('utf-8')
+        if lines and (len(batchIds) >= maxDocs or size + len(entry) > maxBytes):
+            yield b''.join(lines), batchIds
+            lines, batchIds, size = [], [], 0
+        lines.append(entry)
+        batchIds.append(docId)
+        size += len(entry)
+    if lines:
+        yield b''.join(lines), batchIds
+
+# Seconds to wait before retry attempt (0 based): uniform up to the capped exponential.
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# The (op, entry bytes) of every document of a bulk body, in order.
+def bodyEntries(body):
+    lines = body.split(b'\n')
+    entries = []
+    i = 0
+    while i < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        (op, meta), = json.loads(lines[i]).items()
+        size = 1 if op == 'delete' else 2
+        entries.append((op, b'\n'.join(lines[i:i + size]) + b'\n'))
+        i += size
+    return entries
+
+# A global documents per second cap, shared by the processes given the same limiter.
+# A virtual clock: every acquire books the next n / rate seconds and sleeps until its slot.
+class RateLimiter:
+    def __init__(self, docsPerSecond, ctx=multiprocessing):
+        self.rate = float(docsPerSecond)
+        self.nextFree = ctx.Value('d', 0.0, lock=False)
+        self.lock = ctx.Lock()
+
+    def acquire(self, n):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.nextFree.value, now)
+            self.nextFree.value = slot + n / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+# onAck(tag, failed) is called, on the submitting thread, once every body submitted with
+# tag has been acknowledged and seal(tag) was called, with the number of documents that failed.
+class BulkIndexer:
+    def __init__(self, es, inFlight=IN_FLIGHT, limiter=None, maxRetries=MAX_RETRIES, onAck=None):
+        self.es = es
+        self.inFlight = inFlight
+        self.limiter = limiter
+        self.maxRetries = maxRetries
+        self.onAck = onAck
+        self.pool = concurrent.futures.ThreadPoolExecutor(inFlight)
+        self.pending = set()
+        self.futureTags = {}
+        # tag -> [bodies out, documents failed, sealed]
+        self.tags = {}
+        self.stats = {'docs': 0, 'created': 0, 'updated': 0, 'deleted': 0, 'existed': 0, 'failed': 0,
+                      'requests': 0, 'bytes': 0, 'retries': 0}
+        self.errors = []
+
+    # Send one body, waiting for a slot when inFlight bodies are out already.
+    def submit(self, body, ids, tag=None):
+        while len(self.pending) >= self.inFlight:
+            self.collect(concurrent.futures.FIRST_COMPLETED)
+        future = self.pool.submit(self.send, body, ids)
+        self.pending.add(future)
+        if tag is not None:
+            self.tags.setdefault(tag, [0, 0, False])[0] += 1
+            self.futureTags[future] = tag
+
+    # Every body of tag has been submitted.
+    def seal(self, tag):
+        self.tags.setdefault(tag, [0, 0, False])[2] = True
+        self.acknowledge(tag)
+
+    def acknowledge(self, tag):
+        out, failed, sealed = self.tags[tag]
+        if sealed and out == 0:
+            del self.tags[tag]
+            if self.onAck is not None:
+                self.onAck(tag, failed)
+
+    # Send one body until every item is through or out of retries.  Runs on the pool.
+    # Returns the final item of every document, the requests, bytes and retries spent.
+    def send(self, body, ids):
+        items = []
+        requests = size = retries = 0
+        for attempt in range(self.maxRetries + 1):
+            if attempt:
+                retries += 1
+                time.sleep(backoff(attempt - 1))
+            if self.limiter is not None:
+                self.limiter.acquire(len(ids))
+            requests += 1
+            size += len(body)
+            try:
+                response = self.es.bulk(operations=body)
+            except ApiError as e:
+                if e.status_code not in RETRY_STATUS:
+                    raise
+                response = None
+            if response is None:
+                rejected = list(range(len(ids)))
+                if attempt == self.maxRetries:
+                    items += [{op: {'_id': docId, 'status': 429, 'error': {'type': 'es_rejected_execution_exception',
+                                                                          'reason': 'bulk request rejected'}}}
+                              for (op, _), docId in zip(bodyEntries(body), ids)]
+            else:
+                rejected = []
+                for i, item in enumerate(response['items']):
+                    (op, result), = item.items()
+                    if result.get('status') in RETRY_STATUS and attempt < self.maxRetries:
+                        rejected.append(i)
+                    else:
+                        items.append(item)
+            if not rejected or attempt == self.maxRetries:
+                break
+            entries = bodyEntries(body)
+            body = b''.join(entries[i][1] for i in rejected)
+            ids = [ids[i] for i in rejected]
+        return items, requests, size, retries
+
+    # Account for the finished requests.
+    def collect(self, returnWhen=concurrent.futures.ALL_COMPLETED):
+        done, self.pending = concurrent.futures.wait(self.pending, return_when=returnWhen)
+        for future in done:
+            failed = self.record(*future.result())
+            tag = self.futureTags.pop(future, None)
+            if tag is not None:
+                self.tags[tag][0] -= 1
+                self.tags[tag][1] += failed
+                self.acknowledge(tag)
+
+    # Add a response to the stats.  Returns the number of documents that failed.
+    def record(self, items, requests, size, retries=0):
+        self.stats['requests'] += requests
+        self.stats['bytes'] += size
+        self.stats['retries'] += retries
+        failed = 0
+        for item in items:
+            (op, result), = item.items()
+            self.stats['docs'] += 1
+            status = result.get('status', 500)
+            if status == 201:
+                self.stats['created'] += 1
+            elif op == 'delete' and status in (200, 404):
+                self.stats['deleted'] += status == 200
+            elif status < 300:
+                self.stats['updated'] += 1
+            elif status == 409 and op == 'create':
+                self.stats['existed'] += 1
+            else:
+                failed += 1
+                self.stats['failed'] += 1
+                if len(self.errors) < MAX_ERRORS:
+                    error = result.get('error', {})
+                    self.errors.append({'_id': result.get('_id'), 'status': status,
+                                        'type': error.get('type'), 'reason': error.get('reason')})
+        return failed
+
+    # Send one body on the calling thread and add it to the stats.  Returns the final item of
+    # every document, for callers whose next request depends on the outcome.
+    def sendNow(self, body, ids):
+        items, requests, size, retries = self.send(body, ids)
+        self.record(items, requests, size, retries)
+        return items
+
+    # Send every body and wait for all of them.  Returns the stats.
+    def run(self, bodies):
+        for body, ids in bodies:
+            self.submit(body, ids)
+        self.collect()
+        return self.stats
+
+    def close(self):
+        self.collect()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,81 @@
+"""
+Resumable bulk loads for es_loader.
+
+A part file is loaded row group by row group. A row group is committed to its
+checkpoint only once every bulk request that carried it has been acknowledged
+and none of its documents failed. The checkpoint is a small JSON file per
+(part file, index) in CHECKPOINT_DIR, replaced atomically, and every loader
+process writes only the checkpoints of its own files. A rerun skips committed
+row groups and sends the others again. Rows of a row group that did get in
+before a crash come back as create conflicts, which document ids derived from
+the key (doc_ids) make harmless, so delivery is at least once and idempotent.
+
+A backfill also records its run id under the alias until its alias swap is
+done, so a rerun writes into the same indices instead of starting over.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+CHECKPOINT_DIR = '_es_checkpoints'
+
+def writeJson(path, value):
+    tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=1)
+    os.replace(tmp, path)
+
+def readJson(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+class FileCheckpoint:
+    def __init__(self, folder, path, index):
+        os.makedirs(folder, exist_ok=True)
+        key = hashlib.blake2b((index + '|' + os.path.abspath(path)).encode('utf-8'), digest_size=12).hexdigest()
+        self.file = os.path.join(folder, key + '.json')
+        self.state = readJson(self.file, {'path': os.path.abspath(path), 'index': index, 'row_groups': None,
+                                          'done': [], 'failed': {}})
+
+    # Row groups committed so far.
+    def done(self):
+        return set(self.state['done'])
+
+    def setRowGroups(self, n):
+        if self.state['row_groups'] != n:
+            self.state['row_groups'] = n
+            writeJson(self.file, self.state)
+
+    # Commit an acknowledged row group.  One with failed documents stays pending and is sent again.
+    def commit(self, rowGroup, failed=0):
+        if failed:
+            self.state['failed'][str(rowGroup)] = failed
+        else:
+            self.state['failed'].pop(str(rowGroup), None)
+            if rowGroup not in self.state['done']:
+                self.state['done'].append(rowGroup)
+        writeJson(self.file, self.state)
+
+    def complete(self):
+        return self.state['row_groups'] is not None and len(self.state['done']) == self.state['row_groups']
+
+# The unfinished backfill run of alias, if any.
+def pendingRun(folder, alias):
+    return readJson(os.path.join(folder, alias + '.run.json'), {}).get('run')
+
+def startRun(folder, alias, runId):
+    os.makedirs(folder, exist_ok=True)
+    writeJson(os.path.join(folder, alias + '.run.json'), {'alias': alias, 'run': runId})
+
+# The backfill of alias is live, its checkpoints are not needed any more.
+def finishRun(folder, alias, checkpoints=()):
+    for path in checkpoints:
+        if os.path.exists(path):
+            os.remove(path)
+    path = os.path.join(folder, alias + '.run.json')
+    if os.path.exists(path):
+        os.remove(path)
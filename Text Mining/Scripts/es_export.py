@@ -0,0 +1,141 @@
+"""
+Export WSB documents from Elasticsearch back into a partitioned Parquet dataset.
+
+The exporter opens one point in time on the index and splits it into sliced
+searches, one slice per worker process. Each worker pages through its slice
+with search_after, sorted on _shard_doc, so pages cost the same however deep
+they go. The ticker, date range and doc_type filters go into the query as
+filter clauses, so ES does the filtering. A ticker matches any mention in the
+body or the title: *_tickers only hold the first one, so the filter also looks
+for a "GME:" token in the whitespace analysed *_ticker_mentions fields. Only the projected fields come back
+in _source.
+
+Hits go to a frame in the schema types every FLUSH_ROWS rows, and the frame is
+written with dataset_writer.writeParts. A worker therefore holds at most one
+flush of rows. Workers return their manifest entries, and the main process
+appends them to the dataset's manifest in one go.
+"""
+
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import pandas as pd
+
+from dataset_writer import writeParts, appendManifest, newRunId
+from es_bulk import newClient
+from es_index import MENTION_FIELDS
+from es_loader import logMessage
+from wsb_schema import DATASET_SCHEMA, applySchema
+
+EXPORT_INDEX = 'wsb_post_live'
+WORKERS = 4
+PAGE_SIZE = 5000
+FLUSH_ROWS = 100000
+KEEP_ALIVE = '5m'
+# Always fetched, the dataset is partitioned on them.
+PARTITION_FIELDS = ['doc_type', 'created_utc']
+
+# The bool query of the filters.  start/end are inclusive 'YYYY-MM-DD' strings.
+def exportQuery(tickers=None, start=None, end=None, docTypes=None):
+    filters = []
+    if tickers:
+        should = [{'terms': {'body_tickers': list(tickers)}}, {'terms': {'title_tickers': list(tickers)}}]
+        should += [{'prefix': {field: t + ':'}} for field in MENTION_FIELDS for t in tickers]
+        filters.append({'bool': {'should': should, 'minimum_should_match': 1}})
+    if docTypes:
+        filters.append({'terms': {'doc_type': list(docTypes)}})
+    if start or end:
+        dates = {}
+        if start:
+            dates['gte'] = start
+        if end:
+            dates['lte'] = end
+        filters.append({'range': {'created_date': dates}})
+    if not filters:
+        return {'match_all': {}}
+    return {'bool': {'filter': filters}}
+
+# Hit sources to a frame in the schema types.
+def hitFrame(sources):
+    df = pd.DataFrame.from_records(sources)
+    for col, dtype in DATASET_SCHEMA.items():
+        if col in df.columns and str(dtype).startswith('datetime64'):
+            df[col] = pd.to_datetime(df[col], format='ISO8601')
+    return applySchema(df)
+
+# Worker state: one client per exporter process.
+_exporter = {}
+
+def initExporter(hosts):
+    _exporter['es'] = newClient(hosts, connections=1)
+
+# Page through one slice of the point in time and write it under root.  Returns the manifest entries and the hit count.
+def exportSlice(sliceId, pitId, slices, query, fields, root, runId, pageSize=PAGE_SIZE, flushRows=FLUSH_ROWS):
+    es = _exporter.get('es') or newClient(connections=1)
+    # Client errors do not unpickle, which would hang the pool, so they go back as RuntimeError.
+    try:
+        entries = []
+        sources = []
+        hits = 0
+        seq = 0
+        after = None
+        while True:
+            search = {'pit': {'id': pitId, 'keep_alive': KEEP_ALIVE}, 'query': query, 'size': pageSize,
+                      'sort': ['_shard_doc'], 'track_total_hits': False}
+            if slices > 1:
+                search['slice'] = {'id': sliceId, 'max': slices}
+            if fields is not None:
+                search['_source'] = fields
+            if after is not None:
+                search['search_after'] = after
+            response = es.search(**search)
+            pitId = response.get('pit_id', pitId)
+            page = response['hits']['hits']
+            if not page:
+                break
+            sources.extend(hit['_source'] for hit in page)
+            hits += len(page)
+            after = page[-1]['sort']
+            if len(sources) >= flushRows:
+                seq += 1
+                entries += writeParts(root, hitFrame(sources), runId + '-s%d' % sliceId, seq)
+                sources = []
+        if sources:
+            seq += 1
+            entries += writeParts(root, hitFrame(sources), runId + '-s%d' % sliceId, seq)
+        return entries, hits
+    except Exception as e:
+        raise RuntimeError('exporting slice %d failed: %r' % (sliceId, e)) from None
+
+# Export the documents of index matching the filters into the dataset at root.
+# fields projects _source, None for every field.  Returns the number of documents written.
+def exportDataset(root, index=EXPORT_INDEX, tickers=None, start=None, end=None, docTypes=None, fields=None,
+                  workers=WORKERS, hosts=None, pageSize=PAGE_SIZE):
+    if fields is not None:
+        fields = list(fields) + [f for f in PARTITION_FIELDS if f not in fields]
+    query = exportQuery(tickers, start, end, docTypes)
+    es = newClient(hosts)
+    pitId = es.open_point_in_time(index=index, keep_alive=KEEP_ALIVE)['id']
+    runId = newRunId()
+    logMessage("Exporting %s in %d slices" % (index, workers))
+    try:
+        work = partial(exportSlice, pitId=pitId, slices=workers, query=query, fields=fields, root=root,
+                       runId=runId, pageSize=pageSize)
+        entries = []
+        total = 0
+        with Pool(workers, initializer=initExporter, initargs=(hosts,)) as p:
+            for sliceEntries, hits in p.imap_unordered(work, range(workers)):
+                entries += sliceEntries
+                total += hits
+    finally:
+        es.close_point_in_time(id=pitId)
+    appendManifest(root, entries)
+    logMessage("Exported %d documents into %d files" % (total, len(entries)))
+    return total
+
+if __name__ == '__main__':
+    # A month of GME comments, body and scores only.
+    exportPath = os.path.join('processed', 'wsb_export')
+    exportDataset(exportPath, tickers=['GME'], start='2021-01-01', end='2021-01-31', docTypes=['wsb_comment'],
+                  fields=['id', 'body', 'body_tickers', 'body_vadar_compound', 'created_utc_datetime'])
@@ -0,0 +1,163 @@
+"""
+Index lifecycle for WSB bulk loads.
+
+A backfill writes into new monthly indices named <alias>-<YYYY.MM>-<run>.
+They are created from WSB_MAPPING, the explicit mapping derived from the
+dataset schema. Free text is text with no keyword subfield, ids, tickers and
+labels are keyword, scores are float and timestamps are date. dynamic is false,
+so a column the mapping does not know stays in _source but is not indexed.
+
+An index is created with the settings the cluster gives it (templates and
+defaults), and createLoadIndex records its replicas and refresh interval in the
+mapping's _meta before switching it to LOAD_SETTINGS: no refresh and no
+replicas. A resumed load finds them there. Once the load is done, finishLoad
+refreshes and force-merges each index down to MERGE_SEGMENTS segments and puts
+the recorded settings back. It then waits for green when the cluster has the
+data nodes to allocate every replica, and for yellow otherwise, as on a single
+node. Only then does swapAlias move the alias. In one update_aliases call, the alias
+goes to the new indices and leaves the older versions of the same months, so
+queries on the alias see the old data or the new, never a half loaded index.
+A month is replaced as a whole, so a backfill takes every file of the months
+it touches.
+
+ES rejects an alias with the name of a concrete index. Loaders before the
+backfill wrote into a concrete index with the alias's name, so migrateLegacy
+clones such an index to <alias>-legacy-<run> and, in one update_aliases call,
+deletes it and points the alias at the clone. Queries on the name keep working
+throughout. The legacy index holds every month, so only a full backfill can
+replace it.
+"""
+
+import time
+import uuid
+
+from wsb_schema import DATASET_SCHEMA, STRING, CATEGORY, FLOAT
+
+SHARDS = 1
+LOAD_SETTINGS = {'number_of_replicas': 0, 'refresh_interval': '-1'}
+# Settings LOAD_SETTINGS changes, put back by finishLoad.  A missing one goes back to the default.
+LIVE_KEYS = list(LOAD_SETTINGS)
+MERGE_SEGMENTS = 1
+HEALTH_TIMEOUT = '10m'
+# The month part of the name of a migrated legacy index.
+LEGACY = 'legacy'
+
+# Analyzed text.  Every other string column is a keyword.
+TEXT_FIELDS = ['body', 'title', 'body_filtered', 'title_filtered']
+# Space separated TICKER:count lists, one token per mention.
+MENTION_FIELDS = ['body_ticker_mentions', 'title_ticker_mentions']
+
+def fieldMapping(name, dtype):
+    if name in TEXT_FIELDS:
+        return {'type': 'text'}
+    if name in MENTION_FIELDS:
+        return {'type': 'text', 'analyzer': 'whitespace'}
+    if name == 'created_utc':
+        return {'type': 'date', 'format': 'epoch_second'}
+    if name == 'created_date':
+        return {'type': 'date', 'format': 'strict_date'}
+    if dtype == FLOAT:
+        return {'type': 'float'}
+    if dtype == 'Int64':
+        return {'type': 'long'}
+    if dtype == 'Int32':
+        return {'type': 'integer'}
+    if dtype == 'boolean':
+        return {'type': 'boolean'}
+    if str(dtype).startswith('datetime64'):
+        return {'type': 'date'}
+    if dtype is STRING or dtype == CATEGORY:
+        return {'type': 'keyword'}
+    raise ValueError('no mapping for %s (%s)' % (name, dtype))
+
+WSB_MAPPING = {'dynamic': False,
+               'properties': {name: fieldMapping(name, dtype) for name, dtype in DATASET_SCHEMA.items()}}
+
+# The index of a month ('YYYY-MM-DD' or 'YYYY-MM') in a load run.
+def monthIndex(alias, runId, createdDate):
+    return '%s-%s-%s' % (alias, createdDate[:7].replace('-', '.'), runId)
+
+# The month part of an index name made by monthIndex.
+def indexMonth(alias, name):
+    return name[len(alias) + 1:].split('-')[0]
+
+# The live settings recorded in the _meta of an index, None before createLoadIndex recorded them.
+def liveSettings(es, name):
+    mappings = es.indices.get_mapping(index=name)[name]['mappings']
+    return mappings.get('_meta', {}).get('live_settings')
+
+# Create an index for loading: explicit mapping, no refresh, no replicas.  The settings the
+# cluster gave it are recorded first, an index created by an earlier run keeps its record.
+# Returns the live settings.
+def createLoadIndex(es, name, mapping=WSB_MAPPING, shards=SHARDS):
+    es.options(ignore_status=400).indices.create(index=name, settings={'number_of_shards': shards}, mappings=mapping)
+    live = liveSettings(es, name)
+    if live is None:
+        current = es.indices.get_settings(index=name)[name]['settings']['index']
+        live = {k: current.get(k) for k in LIVE_KEYS}
+        es.indices.put_mapping(index=name, meta={'live_settings': live})
+    es.indices.put_settings(index=name, settings=LOAD_SETTINGS)
+    return live
+
+# Make loaded indices ready for queries: refresh, force-merge, their live settings back.  Waits
+# for green when the data nodes can hold every replica, for yellow when they cannot.
+def finishLoad(es, names, segments=MERGE_SEGMENTS, timeout=HEALTH_TIMEOUT):
+    joined = ','.join(names)
+    es.indices.refresh(index=joined)
+    es.options(request_timeout=None).indices.forcemerge(index=joined, max_num_segments=segments)
+    replicas = 0
+    for name in names:
+        live = liveSettings(es, name) or {}
+        es.indices.put_settings(index=name, settings=live)
+        replicas = max(replicas, int(live.get('number_of_replicas') or 0))
+    nodes = es.cluster.health()['number_of_data_nodes']
+    status = 'green' if nodes > replicas else 'yellow'
+    es.options(request_timeout=None).cluster.health(index=joined, wait_for_status=status, timeout=timeout)
+
+# The indices behind alias, none when it does not exist.
+def aliasIndices(es, alias):
+    current = es.options(ignore_status=404).indices.get_alias(name=alias)
+    return [] if current.meta.status == 404 else list(current)
+
+# Whether name is a concrete index rather than an alias.
+def isConcreteIndex(es, name):
+    found = es.options(ignore_status=404).indices.get(index=name)
+    return found.meta.status != 404 and name in found
+
+# Legacy indices behind alias, see migrateLegacy.
+def legacyIndices(es, alias):
+    return [n for n in aliasIndices(es, alias) if n.startswith(alias + '-') and indexMonth(alias, n) == LEGACY]
+
+# Turn a concrete index named alias into an alias over a clone of it.  Writes to the index are
+# blocked for the clone.  Returns the clone, None when alias is not a concrete index.
+def migrateLegacy(es, alias, runId, timeout=HEALTH_TIMEOUT):
+    if not isConcreteIndex(es, alias):
+        return None
+    legacy = '%s-%s-%s' % (alias, LEGACY, runId)
+    es.indices.put_settings(index=alias, settings={'index.blocks.write': True})
+    es.options(request_timeout=None).indices.clone(index=alias, target=legacy,
+                                                   settings={'index.blocks.write': None})
+    es.options(request_timeout=None).cluster.health(index=legacy, wait_for_status='yellow', timeout=timeout)
+    es.indices.update_aliases(actions=[{'add': {'index': legacy, 'alias': alias}},
+                                       {'remove_index': {'index': alias}}])
+    return legacy
+
+# Point alias at names in one atomic step, taking it off the older indices of the same months.
+# retireLegacy also takes it off the legacy indices, for a backfill of every month.
+# Returns the indices it was taken off, deleted with dropOld.
+def swapAlias(es, alias, names, dropOld=False, retireLegacy=False):
+    months = {indexMonth(alias, n) for n in names}
+    if retireLegacy:
+        months.add(LEGACY)
+    old = [n for n in aliasIndices(es, alias)
+           if n not in names and n.startswith(alias + '-') and indexMonth(alias, n) in months]
+    actions = [{'add': {'index': n, 'alias': alias}} for n in sorted(names)]
+    actions += [{'remove': {'index': n, 'alias': alias}} for n in old]
+    es.indices.update_aliases(actions=actions)
+    if dropOld and old:
+        es.indices.delete(index=','.join(old))
+    return old
+
+# A load run id, sortable so later runs have later index names, unique within the second.
+def newLoadRun():
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime()) + uuid.uuid4().hex[:6]
@@ -1,64 +1,194 @@
-from elasticsearch import Elasticsearch
 import pandas as pd
 import hashlib
-import glob as g
 import os
+from functools import partial
+from multiprocessing import Pool
 from time import gmtime, strftime
+from dataset_writer import datasetFiles, iterPart, partitionValues, rowGroupCount
+from es_bulk import newClient, jsonLines, bulkBodies, BulkIndexer, RateLimiter, MAX_DOCS, MAX_BYTES, IN_FLIGHT
+from doc_ids import documentIds, DOC_KEY
+from es_index import createLoadIndex, finishLoad, swapAlias, monthIndex, newLoadRun, migrateLegacy, legacyIndices
+from es_checkpoint import FileCheckpoint, pendingRun, startRun, finishRun, CHECKPOINT_DIR
+
+BASE_INDEX = 'wsb_post_live'
+# Loader processes, whatever the number of files.  Each has one client with inFlight connections.
+WORKERS = 4
+# Columns sent to the index, None for all of them.  The key columns are always read.
+INDEX_COLUMNS = None
 
 def logMessage(msg):
     print(msg)
     print(strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()))
 
 # Generated a hash of a value.  You can pass the entire pandas row to this.
+# Ids used to be this hash of the formatted row, doc_ids.idMigration maps them to the key ids.
 def hash_string(value):
     return (hashlib.sha1(str(value).encode('utf-8')).hexdigest())
 
-# index to elastic search
-def esIndexRecord(df, esIndex):
-    es = Elasticsearch()  # init ElasticSearch
-
-    # Create index if not present.
-    # This relies on ES templates.
-    if es.indices.exists(index=esIndex) == False:
+# Create the index if not present.
+# This relies on ES templates.
+def createIndex(es, esIndex):
+    if not es.indices.exists(index=esIndex):
         logMessage("Creating index")
         print('Index Name --> ', esIndex)
-        es.indices.create(index=esIndex)
+        # Another loader may have created it in the meantime.
+        es.options(ignore_status=400).indices.create(index=esIndex)
+
+# index to elastic search through the bulk API, see es_bulk.
+# df is a frame or an iterable of frames, each is sent as soon as it is there.
+# Frames may come as (tag, frame): once every frame of a tag is acknowledged,
+# onAck(tag, failed) is called with the number of documents that failed.
+# Documents already in the index are skipped by ES itself (create), nothing is checked up front.
+# Document ids come from the key columns, see doc_ids.
+# Rejected requests and items are retried with backoff, limiter caps the docs/s.
+# Returns the bulk stats and the per-document errors.
+def esIndexRecord(df, esIndex, es=None, maxDocs=MAX_DOCS, maxBytes=MAX_BYTES, inFlight=IN_FLIGHT, key=DOC_KEY,
+                  limiter=None, onAck=None):
+    es = es or newClient(connections=inFlight)
+    createIndex(es, esIndex)
 
     # Insert data into ES.
     logMessage("Ingesting data into Elasticsearch")
-    df_iter = df.iterrows()
-    recCnt = 0
-    for id, document in df_iter:
-        recid = hash_string(document.to_string(header=False, index=False))
-        exists = es.exists(index=esIndex, id=recid, _source=False)
-        if exists == False:  # If exists, do not update.
-            recCnt = recCnt + 1
-            res = es.index(index=esIndex, id=recid, body=document.to_dict())
-    print ("Ingested ", recCnt, " records into Elasticsearch")
-
-def getData (filePath):
-    glDf = pd.read_parquet(filePath)
-    return glDf
-
-def main(on):
-    baseIndexName = 'wsb_post_live'
+    frames = [df] if isinstance(df, pd.DataFrame) else df
+    with BulkIndexer(es, inFlight, limiter, onAck=onAck) as indexer:
+        tag = None
+        for frame in frames:
+            if isinstance(frame, tuple):
+                if tag is not None and frame[0] != tag:
+                    indexer.seal(tag)
+                tag, frame = frame
+            if frame.shape[0] == 0:
+                continue
+            for body, ids in bulkBodies(documentIds(frame, key), jsonLines(frame), esIndex, 'create', maxDocs, maxBytes):
+                indexer.submit(body, ids, tag)
+        if tag is not None:
+            indexer.seal(tag)
+        indexer.collect()
+    stats = indexer.stats
+    print ("Ingested ", stats['created'], " records into Elasticsearch,", stats['existed'], "already there,",
+           stats['failed'], "failed,", stats['retries'], "retries")
+    for error in indexer.errors[:10]:
+        print(error)
+    return stats, indexer.errors
+
+# Stream one part file of the processed dataset, partition columns included, in frames
+# of batchRows rows.  Only columns (and the key columns) are read.
+# With a checkpoint, only the row groups it has not committed, as (row group, frame).
+def getData (filePath, columns=INDEX_COLUMNS, batchRows=MAX_DOCS, key=DOC_KEY, checkpoint=None):
+    if columns is not None:
+        columns = list(columns) + [c for c in key if c not in columns]
+    if checkpoint is None:
+        return iterPart(filePath, columns, batchRows)
+    return rowGroupFrames(filePath, columns, batchRows, checkpoint)
+
+def rowGroupFrames(filePath, columns, batchRows, checkpoint):
+    n = rowGroupCount(filePath)
+    checkpoint.setRowGroups(n)
+    done = checkpoint.done()
+    for rowGroup in range(n):
+        if rowGroup in done:
+            continue
+        # An empty row group still gets its tag, so it is committed.
+        yield rowGroup, pd.DataFrame()
+        for frame in iterPart(filePath, columns, batchRows, [rowGroup]):
+            yield rowGroup, frame
+
+# State of a loader process: its client, and so its connection pool, and the shared rate limiter.
+_loader = {}
+
+def initLoader(hosts, inFlight, limiter):
+    _loader['es'] = newClient(hosts, connections=inFlight)
+    _loader['inFlight'] = inFlight
+    _loader['limiter'] = limiter
+
+# indexName is an index or a function of the file path giving the index.
+# Row groups are checkpointed in the checkpoints folder, None to turn that off, see es_checkpoint.
+def main(on, indexName=BASE_INDEX, checkpoints=CHECKPOINT_DIR):
     print("Processing file, ", on)
-    df = getData(on)
+    if callable(indexName):
+        indexName = indexName(on)
+    checkpoint = FileCheckpoint(checkpoints, on, indexName) if checkpoints else None
+    if checkpoint is not None and checkpoint.complete():
+        print("Already loaded, ", on)
+        return on, {}
+    df = getData(on, checkpoint=checkpoint)
+
+    # The loader process's client, or a new one outside of loadFiles.
+    # Client errors do not unpickle, which would hang the pool, so they go back as RuntimeError.
+    try:
+        stats, errors = esIndexRecord(df, indexName, _loader.get('es'), inFlight=_loader.get('inFlight', IN_FLIGHT),
+                                      limiter=_loader.get('limiter'), onAck=checkpoint and checkpoint.commit)
+    except Exception as e:
+        raise RuntimeError('loading %s failed: %r' % (on, e)) from None
+    return on, stats
+
+# Index files with a fixed number of loader processes, at most docsPerSecond documents
+# per second over all of them.  Returns the stats summed over the files.
+def loadFiles(files, indexName=BASE_INDEX, workers=WORKERS, inFlight=IN_FLIGHT, docsPerSecond=None, hosts=None,
+              checkpoints=CHECKPOINT_DIR):
+    limiter = RateLimiter(docsPerSecond) if docsPerSecond else None
+    totals = {}
+    with Pool(max(1, min(workers, len(files))), initializer=initLoader, initargs=(hosts, inFlight, limiter)) as p:
+        for on, stats in p.imap_unordered(partial(main, indexName=indexName, checkpoints=checkpoints), files):
+            for k, v in stats.items():
+                totals[k] = totals.get(k, 0) + v
+    return totals
+
+# The monthly load index of a part file, from its created_date partition.
+def fileIndex(alias, runId, path):
+    return monthIndex(alias, runId, partitionValues(path)['created_date'])
 
-    # Establish elastic search instance.
-    indexName = baseIndexName
-    esIndexRecord(df, indexName)
+# Backfill files into new monthly indices behind alias, see es_index.  The indices are
+# loaded without refresh or replicas, then merged, made live and swapped in atomically.
+# They replace whole months, so pass every file of the months loaded.  full says files are
+# the whole dataset, which also retires a legacy index behind the alias.
+# A concrete index named alias is migrated behind it first, see es_index.migrateLegacy.
+# A backfill that did not get to its alias swap is resumed by the next one.
+# Returns the new indices and the load stats.
+def backfill(files, alias=BASE_INDEX, dropOld=False, full=False, hosts=None, checkpoints=CHECKPOINT_DIR, **load):
+    es = newClient(hosts)
+    runId = pendingRun(checkpoints, alias) if checkpoints else None
+    if runId:
+        logMessage("Resuming run " + runId)
+    else:
+        runId = newLoadRun()
+        if checkpoints:
+            startRun(checkpoints, alias, runId)
+    legacy = migrateLegacy(es, alias, runId)
+    if legacy:
+        logMessage("Index %s moved behind the alias as %s" % (alias, legacy))
+    # A legacy index holds every month, a partial backfill would serve its months twice.
+    legacy = legacyIndices(es, alias)
+    if legacy and not full:
+        raise ValueError("%s still serves %s, only a full backfill can replace it" % (alias, ', '.join(legacy)))
+    indexOf = partial(fileIndex, alias, runId)
+    names = sorted({indexOf(f) for f in files})
+    for name in names:
+        logMessage("Creating index " + name)
+        createLoadIndex(es, name)
+    totals = loadFiles(files, indexOf, hosts=hosts, checkpoints=checkpoints, **load)
+    if totals.get('failed'):
+        logMessage("Load had failures, alias %s left as it was" % alias)
+        return names, totals
+    logMessage("Merging and going live")
+    finishLoad(es, names)
+    old = swapAlias(es, alias, names, dropOld, retireLegacy=full)
+    logMessage("Alias %s moved to %d indices, off %d" % (alias, len(names), len(old)))
+    if checkpoints:
+        finishRun(checkpoints, alias, [FileCheckpoint(checkpoints, f, indexOf(f)).file for f in files])
+    return names, totals
 
 if __name__ == '__main__':
     logMessage("Executing batch process.")
 
-    filePath = 'C:\\Users\\green\\Documents\\Syracuse_University\\IST_736\\Project\\wsb-textmining\\processed\\wsb_*.gzip'
-    files = g.glob(filePath, recursive=True)
+    # Files come from the dataset manifest, narrow them with docTypes / start / end.
+    datasetPath = 'C:\\Users\\green\\Documents\\Syracuse_University\\IST_736\\Project\\wsb-textmining\\processed\\wsb_dataset'
+    files = datasetFiles(datasetPath)
 
-    # Multi processing into elastic.
-    from multiprocessing import Pool
-    with Pool(len(files)) as p:
-        print(p.map(main, files))
+    # Multi processing into elastic, WORKERS processes whatever the number of files.
+    # New monthly indices, swapped in behind the alias once they are loaded.  The files are
+    # the whole dataset, and the indices they replace are deleted so copies do not pile up.
+    print(backfill(files, BASE_INDEX, dropOld=True, full=True, docsPerSecond=None))
 
     logMessage("Batch process done.")
-    os._exit(0)
\ No newline at end of file
+    os._exit(0)
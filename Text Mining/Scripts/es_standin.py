@@ -0,0 +1,438 @@
+"""
+In-process stand-in for the Elasticsearch HTTP API, for trying the loaders
+without a cluster.
+
+It keeps documents in dicts per index and implements just enough of the API
+for es_loader, es_bulk, es_index and doc_ids: the root info, index
+create/exists/delete, _settings, _mapping, _refresh, _forcemerge, _clone,
+_cluster/health, _aliases and _alias, _bulk with index/create/delete actions,
+_mget, a match_all scroll, and point in time searches with slice, search_after
+on _shard_doc and term/terms/range/prefix queries under bool filter, must and
+should. Searches filter _source. Index names may be comma lists, wildcards or
+aliases. A create of an existing id gets a per-item 409, and an alias named
+like an index is rejected.
+New indices get DEFAULT_SETTINGS, with one replica as on a real cluster, and
+the stand-in has dataNodes data nodes. An index with more replicas than the
+other nodes can hold is yellow, and a health request waiting for green on it
+times out with a 408 like the real one.
+reject makes the next n bulk requests fail with 429, or rejects single items
+with es_rejected_execution_exception, so backpressure handling can be tried.
+Every response carries the X-Elastic-Product header the official client
+checks.
+
+    server = StandIn().start()
+    es = Elasticsearch(server.url)
+    ...
+    server.stop()
+"""
+
+import fnmatch
+import itertools
+import json
+import zlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_SETTINGS = {'number_of_shards': '1', 'number_of_replicas': '1'}
+
+class StandIn:
+    def __init__(self, port=0, dataNodes=1):
+        self.indices = {}
+        self.dataNodes = dataNodes
+        self.lock = threading.Lock()
+        self.requests = []
+        self.rejectRequests = 0
+        self.rejectItems = 0
+        self.scrolls = {}
+        self.pits = {}
+        self.scrollIds = itertools.count()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _handlerFor(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Fail the next requests bulk requests with 429, and the next items bulk items with a rejection.
+    def reject(self, requests=0, items=0):
+        with self.lock:
+            self.rejectRequests += requests
+            self.rejectItems += items
+
+    def index(self, name):
+        return self.indices.setdefault(name, {'docs': {}, 'settings': dict(DEFAULT_SETTINGS), 'mappings': {},
+                                              'aliases': set(), 'merges': 0})
+
+    # Apply index settings like the real API: values become strings, None resets to the default.
+    def putSettings(self, name, spec):
+        settings = self.indices[name]['settings']
+        for k, v in spec.get('index', spec).items():
+            if v is None:
+                settings.pop(k, None)
+                if k in DEFAULT_SETTINGS:
+                    settings[k] = DEFAULT_SETTINGS[k]
+            else:
+                settings[k] = str(v).lower() if isinstance(v, bool) else str(v)
+
+    # green when every replica fits on the other data nodes, else yellow.
+    def health(self, names, query):
+        status = 'green'
+        for name in names:
+            if int(self.indices[name]['settings'].get('number_of_replicas', 0)) >= self.dataNodes:
+                status = 'yellow'
+        wanted = query.get('wait_for_status', [None])[0]
+        timedOut = wanted == 'green' and status != 'green'
+        body = {'cluster_name': 'standin', 'status': status, 'timed_out': timedOut,
+                'number_of_nodes': self.dataNodes, 'number_of_data_nodes': self.dataNodes}
+        return (408 if timedOut else 200), body
+
+    # Concrete indices of a comma list of names, wildcards and aliases.
+    def resolve(self, names):
+        out = []
+        for name in names.split(','):
+            for index, state in self.indices.items():
+                if (fnmatch.fnmatchcase(index, name) or name in state['aliases']) and index not in out:
+                    out.append(index)
+        return out
+
+    def aliases(self):
+        return {a for state in self.indices.values() for a in state['aliases']}
+
+    def docs(self, name):
+        return self.indices[name]['docs'] if name in self.indices else {}
+
+    # (status, body) for one request.
+    def handle(self, method, path, query, body):
+        parts = [p for p in path.split('/') if p]
+        self.requests.append((method, path))
+        if not parts:
+            return 200, {'name': 'standin', 'cluster_name': 'standin', 'version': {'number': '8.11.0'},
+                         'tagline': 'You Know, for Search'}
+        if parts[-1] == '_bulk':
+            return self.bulk(parts[0] if len(parts) > 1 else None, body)
+        if len(parts) == 3 and parts[1] == '_clone':
+            return self.clone(parts[0], parts[2], json.loads(body) if body else {})
+        if parts[-1] == '_mget':
+            return self.mget(parts[0] if len(parts) > 1 else None, json.loads(body))
+        if parts[-2:] == ['_search', 'scroll']:
+            spec = json.loads(body) if body else {}
+            if method == 'DELETE':
+                ids = spec.get('scroll_id', [])
+                for scrollId in [ids] if isinstance(ids, str) else ids:
+                    self.scrolls.pop(scrollId, None)
+                return 200, {'succeeded': True, 'num_freed': 1}
+            return self.scrollPage(spec.get('scroll_id') or query['scroll_id'][0])
+        if len(parts) == 2 and parts[1] == '_search' and 'scroll' in query:
+            return self.openScroll(parts[0], query, json.loads(body) if body else {})
+        if parts[-1] == '_pit':
+            if method == 'DELETE':
+                found = self.pits.pop(json.loads(body)['id'], None) is not None
+                return 200, {'succeeded': found, 'num_freed': int(found)}
+            return self.openPit(parts[0])
+        if parts == ['_search']:
+            return self.pitSearch(json.loads(body))
+        if parts[0] == '_cluster' and parts[1:2] == ['health']:
+            return self.health(self.resolve(parts[2]) if len(parts) > 2 else list(self.indices), query)
+        if parts == ['_aliases'] and method == 'POST':
+            return self.updateAliases(json.loads(body)['actions'])
+        if parts[-2:-1] == ['_alias'] or parts[-1:] == ['_alias']:
+            name = parts[-1] if parts[-2:-1] == ['_alias'] else '*'
+            found = {index: {'aliases': {a: {} for a in sorted(state['aliases']) if fnmatch.fnmatchcase(a, name)}}
+                     for index, state in self.indices.items()}
+            found = {index: v for index, v in found.items() if v['aliases']}
+            if not found:
+                return 404, {'error': 'alias [%s] missing' % name, 'status': 404}
+            return (200, None) if method == 'HEAD' else (200, found)
+        if len(parts) == 2 and parts[1] in ('_settings', '_mapping', '_refresh', '_forcemerge'):
+            names = self.resolve(parts[0])
+            if not names:
+                return 404, _error('index_not_found_exception', 'no such index [%s]' % parts[0])
+            with self.lock:
+                for name in names:
+                    if parts[1] == '_settings' and method == 'PUT':
+                        self.putSettings(name, json.loads(body))
+                    elif parts[1] == '_mapping' and method == 'PUT':
+                        spec = json.loads(body)
+                        mappings = self.indices[name]['mappings']
+                        mappings.setdefault('properties', {}).update(spec.pop('properties', {}))
+                        mappings.update(spec)
+                    elif parts[1] == '_forcemerge':
+                        self.indices[name]['merges'] += 1
+            if parts[1] == '_settings' and method == 'GET':
+                return 200, {name: {'settings': {'index': self.indices[name]['settings']}} for name in names}
+            if parts[1] == '_mapping' and method == 'GET':
+                return 200, {name: {'mappings': self.indices[name]['mappings']} for name in names}
+            if parts[1] in ('_settings', '_mapping'):
+                return 200, {'acknowledged': True}
+            return 200, {'_shards': {'total': len(names), 'successful': len(names), 'failed': 0}}
+        if len(parts) == 1 and not parts[0].startswith('_'):
+            name = parts[0]
+            if method == 'HEAD':
+                return (200 if self.resolve(name) else 404), None
+            if method == 'PUT':
+                with self.lock:
+                    if name in self.indices:
+                        return 400, _error('resource_already_exists_exception', 'index [%s] already exists' % name)
+                    if name in self.aliases():
+                        return 400, _error('invalid_index_name_exception', 'an alias named [%s] exists' % name)
+                    spec = json.loads(body) if body else {}
+                    index = self.index(name)
+                    self.putSettings(name, spec.get('settings', {}))
+                    index['mappings'] = spec.get('mappings', {})
+                return 200, {'acknowledged': True, 'index': name}
+            if method == 'DELETE':
+                names = self.resolve(name)
+                if not names:
+                    return 404, _error('index_not_found_exception', 'no such index [%s]' % name)
+                with self.lock:
+                    for n in names:
+                        del self.indices[n]
+                return 200, {'acknowledged': True}
+            if method == 'GET':
+                names = self.resolve(name)
+                if not names:
+                    return 404, _error('index_not_found_exception', 'no such index [%s]' % name)
+                return 200, {n: {'aliases': {a: {} for a in self.indices[n]['aliases']},
+                                 'mappings': self.indices[n]['mappings'],
+                                 'settings': {'index': self.indices[n]['settings']}} for n in names}
+        return 404, _error('no_handler_found_exception', 'no handler for %s %s' % (method, path))
+
+    # All actions or none, like the real _aliases.  An alias cannot have the name of an index
+    # that is still there once the actions are done.
+    def updateAliases(self, actions):
+        with self.lock:
+            dropped = set()
+            for action in actions:
+                (kind, spec), = action.items()
+                if spec.get('index') not in self.indices:
+                    return 404, _error('index_not_found_exception', 'no such index [%s]' % spec.get('index'))
+                if kind not in ('add', 'remove', 'remove_index'):
+                    return 400, _error('illegal_argument_exception', 'unsupported action [%s]' % kind)
+                if kind == 'remove_index':
+                    dropped.add(spec['index'])
+            for action in actions:
+                (kind, spec), = action.items()
+                if kind == 'add' and spec['alias'] in self.indices and spec['alias'] not in dropped:
+                    return 400, _error('invalid_alias_name_exception',
+                                       'an index exists with the same name as the alias [%s]' % spec['alias'])
+            for action in actions:
+                (kind, spec), = action.items()
+                if kind == 'remove_index':
+                    continue
+                aliases = self.indices[spec['index']]['aliases']
+                if kind == 'add':
+                    aliases.add(spec['alias'])
+                else:
+                    aliases.discard(spec['alias'])
+            for name in dropped:
+                del self.indices[name]
+        return 200, {'acknowledged': True}
+
+    # Copy an index under a new name, documents, mappings and settings, like the real _clone.
+    def clone(self, source, target, spec):
+        with self.lock:
+            if source not in self.indices:
+                return 404, _error('index_not_found_exception', 'no such index [%s]' % source)
+            if target in self.indices or target in self.aliases():
+                return 400, _error('resource_already_exists_exception', 'index [%s] already exists' % target)
+            if str(self.indices[source]['settings'].get('index.blocks.write', 'false')) != 'true':
+                return 400, _error('illegal_state_exception', 'index %s must block write operations' % source)
+            state = self.indices[source]
+            self.indices[target] = {'docs': dict(state['docs']), 'settings': dict(state['settings']),
+                                    'mappings': json.loads(json.dumps(state['mappings'])), 'aliases': set(),
+                                    'merges': 0}
+            self.putSettings(target, spec.get('settings', {}))
+        return 200, {'acknowledged': True, 'index': target}
+
+    def bulk(self, defaultIndex, body):
+        with self.lock:
+            if self.rejectRequests:
+                self.rejectRequests -= 1
+                return 429, _error('es_rejected_execution_exception', 'rejected execution of bulk')
+        lines = [json.loads(line) for line in body.split(b'\n') if line.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            (op, meta), = lines[i].items()
+            i += 1
+            source = None
+            if op != 'delete':
+                source = lines[i]
+                i += 1
+            name = meta.get('_index', defaultIndex)
+            docId = meta.get('_id')
+            with self.lock:
+                docs = self.index(name)['docs']
+                if self.rejectItems:
+                    self.rejectItems -= 1
+                    item = {'_index': name, '_id': docId, 'status': 429,
+                            'error': {'type': 'es_rejected_execution_exception', 'reason': 'rejected execution'}}
+                elif op == 'create' and docId in docs:
+                    item = {'_index': name, '_id': docId, 'status': 409,
+                            'error': {'type': 'version_conflict_engine_exception',
+                                      'reason': '[%s]: version conflict, document already exists' % docId}}
+                elif op == 'delete':
+                    found = docs.pop(docId, None) is not None
+                    item = {'_index': name, '_id': docId, 'status': 200 if found else 404,
+                            'result': 'deleted' if found else 'not_found'}
+                else:
+                    created = docId not in docs
+                    docs[docId] = source
+                    item = {'_index': name, '_id': docId, 'status': 201 if created else 200,
+                            'result': 'created' if created else 'updated'}
+            errors = errors or 'error' in item
+            items.append({op: item})
+        return 200, {'took': 1, 'errors': errors, 'items': items}
+
+    # _source filtering: True/False or a list of fields.
+    @staticmethod
+    def project(source, fields):
+        if fields is None or fields is True:
+            return source
+        if fields is False:
+            return None
+        if isinstance(fields, str):
+            fields = fields.split(',')
+        return {k: v for k, v in source.items() if k in fields}
+
+    def mget(self, defaultIndex, spec):
+        docs = spec.get('docs') or [{'_id': i} for i in spec.get('ids', [])]
+        out = []
+        with self.lock:
+            for doc in docs:
+                name = doc.get('_index', defaultIndex)
+                source = self.docs(name).get(doc['_id'])
+                if source is None:
+                    out.append({'_index': name, '_id': doc['_id'], 'found': False})
+                else:
+                    out.append({'_index': name, '_id': doc['_id'], 'found': True, '_source': source})
+        return 200, {'docs': out}
+
+    # A scroll over a snapshot of the index, match_all only.
+    def openScroll(self, name, query, spec):
+        names = self.resolve(name)
+        if not names:
+            return 404, _error('index_not_found_exception', 'no such index [%s]' % name)
+        fields = spec.get('_source', query.get('_source', [None])[0])
+        with self.lock:
+            hits = [{'_index': n, '_id': docId, '_score': None, '_source': self.project(source, fields)}
+                    for n in names for docId, source in self.docs(n).items()]
+        scrollId = str(next(self.scrollIds))
+        self.scrolls[scrollId] = [hits, 0, int(spec.get('size', query.get('size', [10])[0]))]
+        return self.scrollPage(scrollId)
+
+    def scrollPage(self, scrollId):
+        if scrollId not in self.scrolls:
+            return 404, _error('search_context_missing_exception', 'No search context found for id [%s]' % scrollId)
+        state = self.scrolls[scrollId]
+        hits, pos, size = state
+        state[1] = pos + size
+        return 200, {'_scroll_id': scrollId, 'took': 1, 'timed_out': False,
+                     '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                     'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits[pos:pos + size]}}
+
+    # A point in time: the documents as they are now, in a fixed order.
+    def openPit(self, name):
+        names = self.resolve(name)
+        if not names:
+            return 404, _error('index_not_found_exception', 'no such index [%s]' % name)
+        with self.lock:
+            docs = [(n, docId, source) for n in names for docId, source in self.docs(n).items()]
+        pitId = 'pit-%d' % next(self.scrollIds)
+        self.pits[pitId] = docs
+        return 200, {'id': pitId}
+
+    # Search a point in time sorted on _shard_doc, with slice and search_after.
+    def pitSearch(self, spec):
+        pitId = spec.get('pit', {}).get('id')
+        if pitId not in self.pits:
+            return 404, _error('search_context_missing_exception', 'No search context found for id [%s]' % pitId)
+        sliced = spec.get('slice')
+        after = spec.get('search_after', [-1])[0]
+        size = spec.get('size', 10)
+        hits = []
+        for pos, (name, docId, source) in enumerate(self.pits[pitId]):
+            if pos <= after:
+                continue
+            if sliced and zlib.crc32(docId.encode('utf-8')) % sliced['max'] != sliced['id']:
+                continue
+            if not _matches(source, spec.get('query', {'match_all': {}})):
+                continue
+            hits.append({'_index': name, '_id': docId, '_score': None,
+                         '_source': self.project(source, spec.get('_source')), 'sort': [pos]})
+            if len(hits) == size:
+                break
+        return 200, {'pit_id': pitId, 'took': 1, 'timed_out': False,
+                     '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                     'hits': {'hits': hits}}
+
+# match_all, and bool filters of term, terms and range.  Range bounds compare as the
+# values come (numbers or ISO strings).
+def _matches(source, query):
+    (kind, spec), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'bool':
+        required = spec.get('filter', []) + spec.get('must', [])
+        should = spec.get('should', [])
+        least = int(spec.get('minimum_should_match', 0 if required else 1)) if should else 0
+        return (all(_matches(source, q) for q in required)
+                and sum(_matches(source, q) for q in should) >= least)
+    (field, cond), = spec.items()
+    value = source.get(field)
+    if kind == 'term':
+        return value == (cond['value'] if isinstance(cond, dict) else cond)
+    if kind == 'terms':
+        return value in cond
+    if kind == 'prefix':
+        # Against the whitespace tokens, as on the mention fields.
+        prefix = cond['value'] if isinstance(cond, dict) else cond
+        return value is not None and any(token.startswith(prefix) for token in str(value).split())
+    if kind == 'range':
+        if value is None:
+            return False
+        return all(op not in cond or test(value, cond[op]) for op, test in
+                   [('gte', lambda a, b: a >= b), ('gt', lambda a, b: a > b),
+                    ('lte', lambda a, b: a <= b), ('lt', lambda a, b: a < b)])
+    raise ValueError('unsupported query ' + kind)
+
+def _error(kind, reason):
+    return {'error': {'root_cause': [{'type': kind, 'reason': reason}], 'type': kind, 'reason': reason},
+            'status': 400}
+
+def _handlerFor(standIn):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def respond(self):
+            url = urllib.parse.urlsplit(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            status, payload = standIn.handle(self.command, url.path, urllib.parse.parse_qs(url.query), body)
+            data = b'' if payload is None else json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Elastic-Product', 'Elasticsearch')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(data)
+
+        do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = respond
+
+    return Handler
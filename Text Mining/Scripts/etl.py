@@ -6,332 +6,544 @@ Created on Mon May 17 21:21:43 2021
 """
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import re
-import datetime
 import emoji
-from textblob import TextBlob
 import glob as g
 import time
+import collections
 
 # Multiprocessing.
 import swifter
 import concurrent.futures
+import itertools
 import multiprocessing
 import tqdm
 
 #NLTK IMPORTS
 import nltk
-from nltk.corpus import stopwords
 #nltk.download('stopwords')
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
 #nltk.download('vader_lexicon')
 
+# ETL helpers.
+from stopword_filter import stopWordFilter
+from text_normalizer import cleanText, touchUpSeries, touchUpTickerSeries
+from sentiment_scoring import initVader, getVader, vaderLabel, scoreSentiment, textBlobScores
+from sentiment_cache import evictCache
+from market_data import loadMarketData, attachMarket, MARKET_COLUMNS
+from dataset_writer import writeDataset, newRunId
+from ingest_manifest import fileHash, isIngested, recordIngested, loadIdIndex, appendIdIndex, dropSeen
+from ticker_extractor import initTickers, getTickerExtractor, primaryTicker, formatMentions
+from etl_profiler import stage, workerStage, profiledBatch, currentProfiler, startProfile, finishProfile
+from thread_index import appendEdges, buildThreadIndex
+from shared_transport import SharedInput, SharedOutput, outputSpec, sharedBatch, arrowColumn, startTransport
+from wsb_schema import rawDtypes, applySchema, schemaOf, localDatetimes, WSB_POST_HEADERS, WSB_COMM_HEADERS
+
 # %%
 
 # I set my CPU cores to limit the overhead on the system so I can use my computer while this processes.
 NUM_PROCESSES = 12 #multiprocessing.cpu_count()
 CHUNCK_SIZE = 50000
+# Text goes to the workers through shared memory instead of pickles, see shared_transport.
+SHARED_TRANSPORT = True
+# Shared-memory batches out per worker at a time, each with its output segment.
+SHARED_BATCHES_PER_WORKER = 2
 
-def cleanPostDf(df):
-    # Rename the self text column to body
-    df = df.rename(columns={'selftext': 'body'}, inplace=False)
-
-    df['body'] = df['body'].astype(str)
-    df['title'] = df['title'].astype(str)
-
-    # Drop nulls
-    df = df.dropna(subset=['body'])
-    df = df[df['body'] != 'nan']
-
-    print("body")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body'] = list(tqdm.tqdm(pool.map(cleanData, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    print("title")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['title'] = list(tqdm.tqdm(pool.map(cleanData, df['title'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+# Streaming ingest: rows read to measure the file, smallest chunk allowed, and how many
+# copies of a raw row are alive while a chunk goes through cleaning and the merges.
+STREAM_SAMPLE_ROWS = 10000
+STREAM_MIN_ROWS = 1000
+STREAM_MEMORY_FACTOR = 6
 
-    print('demojize body')
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body'] = list(tqdm.tqdm(pool.map(emoji.demojize, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+# Raw columns the post and comment workers read.
+POST_PIPELINE_COLUMNS = ['body', 'title']
+COMMENT_PIPELINE_COLUMNS = ['body', 'parent_id', 'link_id']
 
-    print('demojize title')
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['title'] = list(tqdm.tqdm(pool.map(emoji.demojize, df['title'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+def cleanPostDf(df, pool):
+    df = preparePostDf(df)
 
-    print("body filtered")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_filtered'] = list(tqdm.tqdm(pool.map(stopWordFilter, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    print('title filtered')
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['title_filtered'] = list(tqdm.tqdm(pool.map(stopWordFilter, df['title'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    # Convert epoch
-    print("epoch")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['created_utc_datetime'] = list(tqdm.tqdm(pool.map(datetime.date.fromtimestamp, df['created_utc'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+    print("post pipeline")
+    df = runPipeline(df, processPostBatch, POST_PIPELINE_COLUMNS, pool)
 
     df['doc_type'] = 'wsb_post'
 
     return df
 
-def cleanCommentsDf(df):
-    df['body'] = df['body'].astype(str)
-
-    # Drop nulls
-    df = df.dropna(subset=['body'])
-    df = df[df['body'] != 'nan']
+def cleanCommentsDf(df, pool):
+    df = prepareCommentsDf(df)
 
-    print("body")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body'] = list(tqdm.tqdm(pool.map(cleanData, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+    print("comment pipeline")
+    df = runPipeline(df, processCommentBatch, COMMENT_PIPELINE_COLUMNS, pool)
 
-    print('demojize')
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body'] = list(tqdm.tqdm(pool.map(emoji.demojize, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    print("body filtered")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_filtered'] = list(tqdm.tqdm(pool.map(stopWordFilter, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+    df['doc_type'] = 'wsb_comment'
 
-    # Convert epoch
-    print("epoch")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['created_utc_datetime'] = list(tqdm.tqdm(pool.map(datetime.date.fromtimestamp, df['created_utc'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+    return df
 
-    # Remove top-level number from ids
-    print("clean id")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['parent_id'] = list(tqdm.tqdm(pool.map(cleanIds, df['parent_id'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+def preparePostDf(df):
+    # Rename the self text column to body
+    df = df.rename(columns={'selftext': 'body'}, inplace=False)
 
-    print("clean link id")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['link_id'] = list(tqdm.tqdm(pool.map(cleanIds, df['link_id'], chunksize=CHUNCK_SIZE), total=df.shape[0]))  # With a progressbar
+    # Drop nulls before the cast, astype(str) turns NA into '<NA>' or keeps it as NaN depending
+    # on the pandas version.  A missing title becomes empty text.
+    df = df[df['body'].notna()]
+    return df.assign(body=df['body'].astype(str), title=df['title'].fillna('').astype(str))
 
-    df['doc_type'] = 'wsb_comment'
+def prepareCommentsDf(df):
+    # Drop nulls before the cast, see preparePostDf.
+    df = df[df['body'].notna()]
+    return df.assign(body=df['body'].astype(str))
 
+# The prepare step, batch worker and worker columns of a job.
+def pipelineOf(on):
+    if (on['job'] == 'wsb_post_results'):
+        return preparePostDf, processPostBatch, POST_PIPELINE_COLUMNS
+    return prepareCommentsDf, processCommentBatch, COMMENT_PIPELINE_COLUMNS
+
+# The worker pool shared by every stage of a file.
+def makePool(cachePath=None, universePath=None):
+    if SHARED_TRANSPORT:
+        startTransport()
+    return concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES, initializer=initWorker, initargs=(cachePath, universePath))
+
+# Pool initializer: VADER, the sentiment cache and the ticker pattern, once per worker.
+def initWorker(cachePath=None, universePath=None):
+    initVader(cachePath)
+    initTickers(universePath)
+
+# Cut the frame into row batches, send them through the pool and assign the finished columns once.
+# Spawn cost and pickling are paid once per file instead of once per stage.
+def runPipeline(df, worker, columns, pool):
+    size = df.shape[0]
+    batchSize = max(1, min(CHUNCK_SIZE, -(-size // NUM_PROCESSES)))
+    batches = (df[columns].iloc[x:x + batchSize].to_dict('list') for x in range(0, size, batchSize))
+
+    profiler = currentProfiler()
+    parts = []
+    with stage('pipeline', size):
+        if SHARED_TRANSPORT:
+            parts = runShared(df, worker, columns, pool, batchSize, profiler)
+        else:
+            results = pool.map(profiledBatch, itertools.repeat(worker), batches, itertools.repeat(profiler is not None))
+            for cols, stats in tqdm.tqdm(results, total=-(-size // batchSize)):
+                parts.append(cols)
+                if profiler is not None:
+                    profiler.addWorkerStats(stats, len(cols['body']))
+    with stage('assemble', size):
+        return assembleColumns(df, worker, columns, parts)
+
+# runPipeline through shared memory: the input columns are packed once, and each batch gets an
+# output segment when it is submitted.  At most SHARED_BATCHES_PER_WORKER batches per worker are
+# out at a time, and each segment is released as soon as its result is copied out, so /dev/shm
+# holds a window of outputs instead of the whole file's.  Returns the batch columns in batch order.
+def runShared(df, worker, columns, pool, batchSize, profiler):
+    size = df.shape[0]
+    spec = outputSpec(worker, columns)
+    window = NUM_PROCESSES * SHARED_BATCHES_PER_WORKER
+    parts = []
+    with SharedInput(df, columns) as shared:
+        starts = iter(range(0, size, batchSize))
+        outstanding = collections.deque()
+
+        def submitNext():
+            x = next(starts, None)
+            if x is None:
+                return
+            rows = min(batchSize, size - x)
+            out = SharedOutput(spec, rows, shared.batchBytes(x, x + rows))
+            try:
+                future = pool.submit(sharedBatch, worker, shared.name, shared.layout, x, rows,
+                                     out.name, out.layout, profiler is not None)
+            except BaseException:
+                out.close()
+                raise
+            outstanding.append((out, future))
+
+        try:
+            for _ in range(window):
+                submitNext()
+            for _ in tqdm.tqdm(range(-(-size // batchSize))):
+                out, future = outstanding.popleft()
+                try:
+                    overflow, stats = future.result()
+                    parts.append(out.read(overflow))
+                finally:
+                    out.close()
+                if profiler is not None:
+                    profiler.addWorkerStats(stats, out.rows)
+                submitNext()
+        finally:
+            concurrent.futures.wait([future for out, future in outstanding])
+            for out, future in outstanding:
+                out.close()
+    return parts
+
+# Assign the finished columns of every batch, in batch order, to df.
+def assembleColumns(df, worker, columns, parts):
+    # An empty batch gives every output column, so empty files still get the full schema.
+    results = {k: [v] for k, v in worker({c: [] for c in columns}).items()}
+    for cols in parts:
+        for k in results:
+            results[k].append(cols[k])
+
+    # Numeric stages come back as typed arrays, text stages as lists or, from shared memory, Arrow arrays.
+    for k, chunks in results.items():
+        if isinstance(chunks[0], np.ndarray):
+            df[k] = np.concatenate(chunks)
+        elif any(isinstance(c, pa.Array) for c in chunks):
+            df[k] = arrowColumn(chunks)
+        else:
+            df[k] = list(itertools.chain.from_iterable(chunks))
     return df
 
+# Clean, demojize and stopword filter a list of texts.  Returns the cleaned and filtered lists.
+def processTexts(texts):
+    with workerStage('clean'):
+        texts = [cleanData(t) for t in texts]
+    with workerStage('demojize'):
+        texts = [emoji.demojize(t) for t in texts]
+    with workerStage('stopwords'):
+        filtered = [stopWordFilter(t) for t in texts]
+    return texts, filtered
+
+# <prefix>_tickers and <prefix>_ticker_mentions for a list of cleaned texts.
+def tickerColumns(texts, prefix):
+    with workerStage('tickers'):
+        found = getTickerExtractor().extractBatch(texts)
+        return {prefix + '_tickers': [primaryTicker(t) for t in found],
+                prefix + '_ticker_mentions': [formatMentions(t) for t in found]}
+
+# Worker side of the post pipeline: every per-row stage for one batch of raw rows.
+def processPostBatch(batch):
+    out = {}
+    out['body'], out['body_filtered'] = processTexts(batch['body'])
+    out['title'], out['title_filtered'] = processTexts(batch['title'])
+    out.update(tickerColumns(out['body'], 'body'))
+    out.update(tickerColumns(out['title'], 'title'))
+    with workerStage('sentiment'):
+        out.update(scoreSentiment(out['body'], 'body'))
+        out.update(scoreSentiment(out['title'], 'title', textBlob=False))
+    return out
+
+# Worker side of the comment pipeline.
+def processCommentBatch(batch):
+    out = {}
+    out['body'], out['body_filtered'] = processTexts(batch['body'])
+    with workerStage('clean ids'):
+        out['parent_id'] = [cleanIds(x) for x in batch['parent_id']]
+        out['link_id'] = [cleanIds(x) for x in batch['link_id']]
+    out.update(tickerColumns(out['body'], 'body'))
+    with workerStage('sentiment'):
+        out.update(scoreSentiment(out['body'], 'body'))
+    return out
+
 # For the WSB IDs.
 def cleanIds(x):
     return re.sub(r't\d+\_', '', x)
 
 # Clean the WSB post data.
 def cleanData(x):
-    text = x
-    text = re.sub('@[^\s]+', ' ', text)
-    text = re.sub(r"http\S+", " ", text)
-    text = re.sub(r'\s+[a-zA-Z]\s+', ' ', text)  # remove single chars
-    text = re.sub(r'[\~\`\!\@\#\%\^\&\*\+\=\{\}\[\]\|\\\:\;\"\<\>\?\,\.\/]',' ',text) # remove punctuation
-    #text = re.sub('\w*\d+\w*', ' ', text) # remove words containing numbers
-    text = re.sub(r'\d+', ' ', text)  # Remove numbers
-    text = re.sub(r'[\s\t\n\r]+', ' ', text, flags=re.I)
-    return text
+    return cleanText(x)
 
 def cleanBodyFields(df):
-    df['body'] = df['body'].str.lower()
-    df['body'] = df['body'].str.replace('[\$\(\)]', '', regex=True)
+    df['body'] = touchUpSeries(df['body'])
     return df['body']
 
 def cleanFilteredFields(df):
-    df['body_filtered'] = df['body_filtered'].str.lower()
-    df['body_filtered'] = df['body_filtered'].str.replace('[\$\(\)]', '', regex=True)
+    df['body_filtered'] = touchUpSeries(df['body_filtered'])
     return df['body_filtered']
 
 def cleanTickersFields(df):
-    df['body_tickers'] = df['body_tickers'].str.strip()
-    df['body_tickers'] = df['body_tickers'].str.replace('[\$\(\)]', '', regex=True)
+    df['body_tickers'] = touchUpTickerSeries(df['body_tickers'])
     return df['body_tickers']
 
 def cleanTitleFields(df):
-    df['title'] = df['title'].str.lower()
-    df['title'] = df['title'].str.replace('[\$\(\)]', '', regex=True)
+    df['title'] = touchUpSeries(df['title'])
     return df['title']
 
 def cleanTitleFilteredFields(df):
-    df['title_filtered'] = df['title_filtered'].str.lower()
-    df['title_filtered'] = df['title_filtered'].str.replace('[\$\(\)]', '', regex=True)
+    df['title_filtered'] = touchUpSeries(df['title_filtered'])
     return df['title_filtered']
 
 def cleanTitleTickersFields(df):
-    df['title_tickers'] = df['title_tickers'].str.strip()
-    df['title_tickers'] = df['title_tickers'].str.replace('[\$\(\)]', '', regex=True)
+    df['title_tickers'] = touchUpTickerSeries(df['title_tickers'])
     return df['title_tickers']
 
-# Scrub the text of english stopwords from NLTK.
-def stopWordFilter(txt):
-    stopWords = set(stopwords.words('english'))
-    t = txt
-    for s in stopWords:
-        pattern = r"\s+" + s + "\s+"
-        t = re.sub(pattern, ' ', t)
-
-    return(t)
-
 # Give reddit body, will look for stock tickers.
-# Returns empty array if nothing found.
+# Returns the first mentioned ticker of the universe, empty string if nothing found.
 def getTickersByRe(body):
-    note_search = re.search(r"\s+(\$([A-Z]{1,4})|\([A-Z]{1,4}\))\s+", body)
-
-    # If the title exists, extract and return it.
-    if note_search:
-        return note_search.group()
-    return ""
-
-# Extract the stock tickers based on company name.
-def getTickersByName(text):
-    companyNames = {'gamestop': 'GME',
-                    'black berry': 'BB',
-                    'blackberry': 'BB',
-                    'nokia': 'NOK',
-                    'silver': 'SLV',
-                    'kelloggs': 'K',
-                    'tesla':'TSLA',
-                    'space':'SPCE'}
-
-    # Loop through looking for the name.
-    for k in companyNames:
-        pattern = r"\s+"+ k +"\s+"
-
-        # If the title exists, extract and return it.
-        if re.search(pattern, text):
-            return companyNames[k]
-
-    return ""
+    return primaryTicker(getTickerExtractor().extract(body))
 
 # get the stock data to be merged with the WSB content.
+# Every ticker in the file is kept, indexed by (ticker, date).
 def getStockData(on):
-    stockLoc = on['folderLoc'] + '\\rawdata\\gme_amc_cleandata.csv'
-    stockDf = pd.read_csv(stockLoc)
-    gmeDf = stockDf[["Date", "GME RSI", "GME.Open", "GME.High", "GME.Low", "GME.Close", "GME.Volume", "GME.Adjusted"]]
-    gmeDf.columns = ["date", "rsi", "open", "high", "low", "close", "volume", "adjusted"]
-    gmeDf['ticker'] = 'GME'
-    gmeDf = gmeDf.sort_values(by=['date'])
-    return gmeDf
+    stockLoc = on.get('marketData') or on['folderLoc'] + '\\rawdata\\gme_amc_cleandata.csv'
+    return loadMarketData(stockLoc)
 
 # Vadar Sentiment
 def vadar_sentiment(text):
-    vader_sentiment = SentimentIntensityAnalyzer().polarity_scores(text)
-    if vader_sentiment == 0:
-        return "neutral"
-    elif vader_sentiment['neg'] != 0:
-        return "negative"
-    elif vader_sentiment['pos'] != 0:
-        return "positive"
-    return "neutral"
+    return vaderLabel(getVader().polarity_scores(text))
 
 # TB Polarity value.
 def tb_polarity(text):
-    return TextBlob(text).sentiment.polarity
+    return textBlobScores(text)[0]
 
 # TextBlob subjectivity value.
 def tb_subjectivity(text):
-    return TextBlob(text).sentiment.subjectivity
+    return textBlobScores(text)[1]
 
 # The pipe. ###################################
+# With on['profile'] set, every stage is timed and a JSON report lands in profileLoc(on).
 def runIngest(on):
-    resultsFileLoc = on['folderLoc'] + '\\processed\\' + on['job']
+    profiler = startProfile(on)
+    try:
+        return ingestFile(on)
+    finally:
+        finishProfile(on, profiler, profileLoc(on))
+
+def ingestFile(on):
+    # Incremental mode skips files whose contents were ingested before.
+    contentHash, ingested = checkIngested(on)
+    if ingested:
+        return {'job': on['job'], 'skipped': True}
+
+    # Bounded memory mode, see runIngestStreaming.
+    if streamingJob(on):
+        result = runIngestStreaming(on)
+        markIngested(on, contentHash, result['rows'])
+        return result
+
     fileLoc = on['filename']# + '\\rawdata\\' + on['filename']
     header = on['header']
-    df = pd.read_csv(fileLoc, usecols=header)#, nrows=10000)
+    with stage('read'):
+        df = pd.read_csv(fileLoc, usecols=header, dtype=rawDtypes(header))#, nrows=10000)
+    df, idCodes, seen = dedupChunk(on, df, loadSeenIds(on))
+    if df.shape[0] == 0:
+        markIngested(on, contentHash, 0)
+        return {'job': on['job'], 'df': df}
+
+    with stage('market load'):
+        marketDf = getStockData(on)
+    cachePath = on.get('sentimentCache')
+    with stage('pool start'):
+        pool = makePool(cachePath, on.get('tickerUniverse'))
+    with pool:
+        df = processFrame(on, df, marketDf, pool)
+    if cachePath:
+        evictCache(cachePath)
 
+    print ("putting to disk.")
+    putToDisk(on, df)
+    markWritten(on, idCodes)
+    markIngested(on, contentHash, df.shape[0])
+
+    # return back to main thread
+    return {'job': on['job'], 'df': df}
+
+# Reads the raw file in row chunks and appends every finished chunk to the output right away,
+# so memory is bounded by the chunk instead of the dump.  Set on['chunkRows'] for a fixed chunk,
+# or on['maxMemoryMB'] to size chunks from the measured bytes per row of the first chunk.
+# Rows match the in-memory path, only the posts' title GME rows move to the end of each chunk
+# instead of the end of the file.
+def runIngestStreaming(on):
+    runId = newRunId()
+
+    with stage('market load'):
+        marketDf = getStockData(on)
+    cachePath = on.get('sentimentCache')
+    seen = loadSeenIds(on)
+    count = 1
+    rows = 0
+    with makePool(cachePath, on.get('tickerUniverse')) as pool:
+        for df in readChunks(on):
+            df, idCodes, seen = dedupChunk(on, df, seen)
+            if df.shape[0] == 0:
+                continue
+            rows += df.shape[0]
+            df = processFrame(on, df, marketDf, pool)
+            count = putToDisk(on, df, runId, count)
+            markWritten(on, idCodes)
+            del df
+    if cachePath:
+        evictCache(cachePath)
+
+    return {'job': on['job'], 'rows': rows}
+
+# Whether the job reads its file in chunks, see runIngestStreaming.
+def streamingJob(on):
+    return bool(on.get('maxMemoryMB') or on.get('chunkRows'))
+
+# Incremental mode: the content hash of the file, and whether that content was ingested before.
+def checkIngested(on):
+    if not on.get('incremental'):
+        return None, False
+    contentHash = fileHash(on['filename'])
+    if isIngested(datasetLoc(on), contentHash):
+        print("already ingested", on['filename'])
+        return contentHash, True
+    return contentHash, False
+
+# The raw rows of a streaming job in chunks of on['chunkRows'] rows, or sized from the first
+# chunk to keep one chunk under on['maxMemoryMB'].
+def readChunks(on):
+    header = on['header']
+    chunkRows = on.get('chunkRows') or STREAM_SAMPLE_ROWS
+    first = True
+    with pd.read_csv(on['filename'], usecols=header, dtype=rawDtypes(header), iterator=True) as reader:
+        while True:
+            try:
+                with stage('read'):
+                    df = reader.get_chunk(chunkRows)
+            except StopIteration:
+                return
+
+            # Size the following chunks off the first one.
+            if first and not on.get('chunkRows'):
+                chunkRows = streamChunkRows(df, on['maxMemoryMB'])
+                print("streaming", chunkRows, "rows per chunk")
+            first = False
+            yield df
+
+# Drop the rows of a chunk that are in the dataset already.  Returns the rest, their id codes
+# and seen with those codes added, so later chunks of the run skip them too.
+def dedupChunk(on, df, seen):
+    with stage('dedup', df.shape[0]):
+        df, idCodes = dropSeenRows(on, df, seen)
+    if seen is not None:
+        seen = np.union1d(seen, idCodes)
+    return df, idCodes, seen
+
+# The doc_type the job writes.
+def docTypeOf(on):
+    return 'wsb_post' if (on['job'] == 'wsb_post_results') else 'wsb_comment'
+
+# Incremental mode: ids already in the output dataset for this job, None otherwise.
+def loadSeenIds(on):
+    if not on.get('incremental'):
+        return None
+    return loadIdIndex(datasetLoc(on), docTypeOf(on))
+
+# Incremental mode: drop rows already in the output dataset before any expensive stage.
+def dropSeenRows(on, df, seen):
+    if seen is None:
+        return df, None
+    before = df.shape[0]
+    df, idCodes = dropSeen(df, seen)
+    print("dropped", before - df.shape[0], "rows already ingested")
+    return df, idCodes
+
+# Incremental mode: add the ids just written to the id index.
+def markWritten(on, idCodes):
+    if idCodes is not None:
+        appendIdIndex(datasetLoc(on), docTypeOf(on), idCodes)
+
+# Once all of a file is on disk: rebuild the comment thread index and, in incremental mode,
+# record the file as ingested.
+def markIngested(on, contentHash, rows):
+    if docTypeOf(on) == 'wsb_comment' and rows:
+        with stage('thread index'):
+            buildThreadIndex(datasetLoc(on))
+    if contentHash is not None:
+        recordIngested(datasetLoc(on), contentHash, {'filename': on['filename'],
+                                                     'job': on['job'],
+                                                     'rows': int(rows),
+                                                     'ingested': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())})
+
+# Rows per chunk that keep one chunk, and its working copies, under maxMemoryMB.
+def streamChunkRows(sample, maxMemoryMB):
+    rowBytes = sample.memory_usage(deep=True).sum() / max(1, sample.shape[0])
+    return max(STREAM_MIN_ROWS, int(maxMemoryMB * 1024 * 1024 / (max(1, rowBytes) * STREAM_MEMORY_FACTOR)))
+
+# Everything between reading raw rows and writing them: cleaning, sentiment, tickers and the stock merge.
+def processFrame(on, df, marketDf, pool):
     # Clean the text data.
     if (on['job'] == 'wsb_post_results'):
-        df = cleanPostDf(df)
+        df = cleanPostDf(df, pool)
     else:
-        df = cleanCommentsDf(df)
+        df = cleanCommentsDf(df, pool)
 
-    # Polarity subjectivity
-    print("Polarity")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_polarity'] = list(tqdm.tqdm(pool.map(tb_polarity, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))  # With a progressbar
+    return finishFrame(on, df, marketDf)
 
-    print("subjectivity")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_subjectivity'] = list(tqdm.tqdm(pool.map(tb_subjectivity, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    print('vader sentiment')
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_vadar_sentiment'] = list(tqdm.tqdm(pool.map(vadar_sentiment, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
-
-    # Find stock tickers
-    print("extract stock tickers")
-    with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-        df['body_tickers'] = list(tqdm.tqdm(pool.map(getTickersByRe, df['body'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+# The main-process stages after the workers: touch ups, the stock join and the final types.
+def finishFrame(on, df, marketDf):
+    rows = df.shape[0]
+    with stage('epoch', rows):
+        df['created_utc_datetime'] = localDatetimes(df['created_utc']).to_numpy()
 
     print("data touch ups.")
-    df.body = df.body.str.lower()
-    df.body = df.body.str.replace('[\$\(\)]', '', regex=True)
-    df.body_filtered = df.body_filtered.str.lower()
-    df.body_filtered = df.body_filtered.str.replace('[\$\(\)]', '', regex=True)
-    df.body_tickers = df.body_tickers.str.strip()
-    df.body_tickers = df.body_tickers.str.replace('[\$\(\)]', '', regex=True)
-
-    print("merging stock data.")
-    # Merge stock data for both GME
-    gmeDf = getStockData(on)
-    df['created_utc_datetime'] = df['created_utc_datetime'].astype(str)
-    gmeDf['date'] = gmeDf['date'].astype(str)
-    df = pd.merge(df, gmeDf, left_on=['created_utc_datetime', 'body_tickers'], right_on=['date', 'ticker'], how='left')
-
-    if (on['job'] == 'wsb_post_results'):
-        print('title vadar')
-        with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-            df['title_vadar_sentiment'] = list(tqdm.tqdm(pool.map(vadar_sentiment, df['title'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+    with stage('touch ups', rows):
+        cleanBodyFields(df)
+        cleanFilteredFields(df)
+        cleanTickersFields(df)
 
-        print('title tickers ')
-        with concurrent.futures.ProcessPoolExecutor(NUM_PROCESSES) as pool:
-            df['title_tickers'] = list(tqdm.tqdm(pool.map(getTickersByRe, df['title'], chunksize=CHUNCK_SIZE), total=df.shape[0]))
+        if (on['job'] == 'wsb_post_results'):
+            cleanTitleFields(df)
+            cleanTitleFilteredFields(df)
+            cleanTitleTickersFields(df)
 
-        df.title = df.title.str.lower()
-        df.title = df.title.str.replace('[\$\(\)]', '', regex=True)
-        df.title_filtered = df.title_filtered.str.lower()
-        df.title_filtered = df.title_filtered.str.replace('[\$\(\)]', '', regex=True)
-        df.title_tickers = df.title_tickers.str.strip()
-        df.title_tickers = df.title_tickers.str.replace('[\$\(\)]', '', regex=True)
-
-        titleDf = df[df['title_tickers'] == 'GME']
-        titleDf = titleDf.drop(columns=["date", "rsi", "open", "high", "low", "close", "volume", "adjusted", "ticker"])
-        titleDf = pd.merge(titleDf, gmeDf, left_on=['created_utc_datetime', 'title_tickers'], right_on=['date', 'ticker'], how='left')
-
-        df = df[df['title_tickers'] != 'GME'] # drop the rows with GME in the title.
-        df = pd.concat([df, titleDf])  # Put the removed back with stock data.
+    print("merging stock data.")
+    # Posts join on the title ticker when there is market data for it, else on the body ticker.
+    with stage('market join', rows):
+        titleTickers = 'title_tickers' if (on['job'] == 'wsb_post_results') else None
+        attachMarket(df, marketDf, 'created_utc_datetime', 'body_tickers', titleTickers)
 
-    df['created_utc_datetime'] = df.created_utc.apply(lambda x: datetime.datetime.fromtimestamp(x))
-    df[["rsi", "open", "high", "low", "close", "volume", "adjusted"]] = df[["rsi", "open", "high", "low", "close", "volume", "adjusted"]].fillna(value=0)
+    with stage('finalize', rows):
+        df[MARKET_COLUMNS] = df[MARKET_COLUMNS].fillna(value=0)
+        applySchema(df, schemaOf(docTypeOf(on)))
 
-    print ("putting to disk.")
-    putToDisk(resultsFileLoc, df)
+    return df
 
-    # return back to main thread
-    return {'job': on['job'], 'df': df}
+# Where the partitioned parquet dataset lives.
+def datasetLoc(on):
+    return on.get('datasetLoc') or on['folderLoc'] + '\\processed\\wsb_dataset'
+
+# Where the profiling reports go.
+def profileLoc(on):
+    return on.get('profileDir') or datasetLoc(on) + '\\_profiles'
+
+# Puts the posts and comments into the partitioned parquet dataset, and to csv slices when on['writeCsv'] is set.
+# Streaming ingest calls this once per chunk with the run id and the next part number,
+# and gets back the part number to continue from.
+def putToDisk(on, df, runId=None, count=1):
+    runId = runId or newRunId()
+    with stage('write', df.shape[0]):
+        writeDataset(datasetLoc(on), df, runId, count)
+        # Reply edges for the thread index, see thread_index.
+        if 'parent_id' in df.columns:
+            appendEdges(datasetLoc(on), df)
+    if not on.get('writeCsv'):
+        return count + 1
 
-# Puts the posts and comments to both csv and parque.
-def putToDisk(resultsFileLoc, df):
-    currentTime = time.strftime('%Y%m%d%H%M%S', time.localtime())
+    resultsFileLoc = on['folderLoc'] + '\\processed\\' + on['job']
     size = df.shape[0]
     step = 250000
     end = step
-    count = 1
     for x in range(0, size, step):
         print(x, end)
         d = df[x:end]
-        d.to_csv(resultsFileLoc + '_' + currentTime + '_' + str(count) + '.csv', index=False)
-        d.to_parquet(resultsFileLoc + '_' + currentTime + '_' + str(count) + '.gzip', compression='gzip')
+        with stage('write csv', d.shape[0]):
+            d.to_csv(resultsFileLoc + '_' + runId + '_' + str(count) + '.csv', index=False)
         end += step
         count += 1
+    return count
 
 # %%
 if __name__ == '__main__':
 
     folderLoc = 'C:\\Users\\green\\Documents\\Syracuse_University\\IST_736\\Project\\wsb-textmining'
+    sentimentCache = folderLoc + '\\processed\\wsb_sentiment_cache.sqlite'
+    tickerUniverse = None # symbol,name CSV, e.g. folderLoc + '\\rawdata\\ticker_universe.csv'
+    incremental = True # skip files and Reddit ids that are already in the dataset
+    profile = False # per-stage timings and throughput report in <dataset>\\_profiles
     wsbPosts = 'wallstreetbets_posts*.csv'
     wsbComments = 'wallstreetbets_comments*.csv'
 
-    wsbPostHeaders = ['id', 'author', 'author_premium', 'created_utc', 'domain', 'title', 'selftext', 'subreddit',
-                      'subreddit_id', 'num_comments', 'upvote_ratio']
-    wsbCommHeaders = ['id', 'parent_id', 'link_id', 'author', 'created_utc', 'body', 'subreddit', 'subreddit_id']
+    wsbPostHeaders = WSB_POST_HEADERS
+    wsbCommHeaders = WSB_COMM_HEADERS
+
+    # Every pending file goes through one shared worker pool, see etl_scheduler.
+    from etl_scheduler import runScheduled
+    jobs = []
 
     files = g.glob(folderLoc + '\\rawdata\\live\\' + wsbPosts, recursive=True)
     print(files)
@@ -340,11 +552,12 @@ if __name__ == '__main__':
         postDic = {'job': 'wsb_post_results',
                    'folderLoc': folderLoc,
                    'filename': f,
-                   'header': wsbPostHeaders}
-        print('starting posts')
-        print(postDic)
-        runIngest(postDic)
-        print('completed posts')
+                   'header': wsbPostHeaders,
+                   'sentimentCache': sentimentCache,
+                   'tickerUniverse': tickerUniverse,
+                   'incremental': incremental,
+                   'profile': profile}
+        jobs.append(postDic)
 
     files = g.glob(folderLoc + '\\rawdata\\live\\' + wsbComments, recursive=True)
     print(files)
@@ -353,9 +566,14 @@ if __name__ == '__main__':
         commentsDic = {'job': 'wsb_comments_results',
                        'folderLoc': folderLoc,
                        'filename': f,
-                       'header': wsbCommHeaders}
-
-
-        print('starting comments')
-        runIngest(commentsDic)
-        print('completed comments')
\ No newline at end of file
+                       'header': wsbCommHeaders,
+                       'sentimentCache': sentimentCache,
+                       'tickerUniverse': tickerUniverse,
+                       'incremental': incremental,
+                       'profile': profile}
+        jobs.append(commentsDic)
+
+    print('starting', len(jobs), 'files')
+    for r in runScheduled(jobs):
+        print(r)
+    print('completed')
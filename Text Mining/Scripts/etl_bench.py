@@ -0,0 +1,303 @@
+"""
+ETL benchmark suite on the synthetic corpus (wsb_synth).
+
+The per-text stages (cleanData, stopWordFilter, vadar_sentiment,
+getTickersByRe) run over up to MICRO_ROWS comment bodies. Each is the best of
+`repeats` runs and gets the input it sees in the pipeline: raw text for
+cleanData, cleaned and demojized text for the rest. runIngest runs end to end
+on the posts and the comments file. Every run writes to a fresh dataset folder
+with the cache and incremental mode off. putToDisk then writes the processed
+comments again.
+
+Results are rows/s per benchmark. Baselines live in a JSON file keyed by corpus
+size, and --save records the current run. A run is compared against the
+baseline of its size, and any benchmark more than `tolerance` slower is
+flagged as a regression, with exit code 1. Baselines are only comparable on
+the same machine; the file notes the host they were taken on.
+
+--check runs the before/after checks instead: a rewritten stage against the
+code it replaced, on REAL_SAMPLE, the corpus bodies and, for stopwords, random
+texts. Any failed check exits with code 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import emoji
+import pandas as pd
+
+import etl
+from stopword_filter import getStopWords, stopWordFilterSeries
+from wsb_schema import WSB_POST_HEADERS, WSB_COMM_HEADERS
+from wsb_synth import generateCorpus, sizeRows
+
+BENCHMARKS = ['cleanData', 'stopWordFilter', 'vadar_sentiment', 'getTickersByRe',
+              'putToDisk', 'runIngest posts', 'runIngest comments']
+MICRO_ROWS = 50000
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etl_bench_baselines.json')
+TOLERANCE = 0.2
+
+# Real WSB wording with the tickers each text should give, for the before/after checks.
+REAL_SAMPLE = [
+    ("GME to the moon! $GME 420c 2/19 \U0001F48E\U0001F64C", {'GME': 1}),
+    ("Bought more $PLTR today, and (AAPL) calls too.", {'PLTR': 1, 'AAPL': 1}),
+    ("I love space and silver jewellery", {}),
+    ("Nokia and BlackBerry are the next GameStop", {'NOK': 1, 'BB': 1, 'GME': 1}),
+    ("$AMC $AMC $AMC", {'AMC': 3}),
+    ("What is (BB) doing after hours?", {'BB': 1}),
+    ("Tesla is overvalued, $TSLA puts printing", {'TSLA': 2}),
+    ("Short interest on $gme is 140%", {}),
+]
+
+# The ticker regex etl used before ticker_extractor.
+OLD_TICKER_RE = re.compile(r"\s+(\$([A-Z]{1,4})|\([A-Z]{1,4}\))\s+")
+
+def oldTickersByRe(body):
+    found = OLD_TICKER_RE.search(body)
+    return found.group().strip().strip('$()') if found else ""
+
+# Texts where runs of repeated stopwords make the old loop depend on its order.
+STOPWORD_SAMPLE = [" don't weren't a a me ", "x the the y", "I was a a a moron", " the the the the ",
+                   "a a", "\ta\n a\ta  ", "buy the the dip the"]
+STOPWORD_RANDOM = 100000
+
+# The stopword loop etl used before stopword_filter, over the stopwords in the given order.
+def oldStopWordFilter(txt, order):
+    t = txt
+    for s in order:
+        t = re.sub(r"\s+" + s + r"\s+", ' ', t)
+    return t
+
+# Short random texts of stopwords, a few other words and mixed whitespace.
+def randomStopWordTexts(count, seed):
+    rng = random.Random(seed)
+    words = ['a', 'a', 'the', 'the', 'me', "don't", "weren't", 'i', 'is', 'GME', 'moon', 'A', 'theme']
+    gaps = [' ', ' ', '  ', '\t', '\n', ' \n ']
+    texts = []
+    for _ in range(count):
+        parts = [rng.choice(gaps) if rng.random() < 0.5 else '']
+        for _ in range(rng.randint(0, 8)):
+            parts += [rng.choice(words), rng.choice(gaps)]
+        if rng.random() < 0.5:
+            parts.pop()
+        texts.append(''.join(parts))
+    return texts
+
+# Per text microseconds of fn over texts, best of repeats.
+def microsPerText(fn, texts, repeats):
+    return round(1e6 * bestOf(lambda: [fn(t) for t in texts], repeats) / max(1, len(texts)), 2)
+
+# Tickers before and after: the old regex and the extractor.  Fails when a REAL_SAMPLE text
+# gives other tickers than expected, or the extractor misses a ticker the old regex found.
+def tickerCheck(bodies, repeats):
+    extractor = etl.getTickerExtractor()
+    failures = []
+    for text, expected in REAL_SAMPLE:
+        got = extractor.extract(emoji.demojize(etl.cleanData(text)))
+        if got != expected:
+            failures.append('tickers: %r gives %r, expected %r' % (text, got, expected))
+    texts = [emoji.demojize(etl.cleanData(t)) for t, _ in REAL_SAMPLE] + bodies
+    missed = [t for t in texts if oldTickersByRe(t) and oldTickersByRe(t) not in extractor.extract(t)]
+    failures += ['tickers: missed %r in %r' % (oldTickersByRe(t), t) for t in missed[:10]]
+    lines = ['tickers: %d texts, old regex %.2f us/text, extractor %.2f us/text, %d missed'
+             % (len(texts), microsPerText(oldTickersByRe, texts, repeats),
+                microsPerText(extractor.extract, texts, repeats), len(missed))]
+    return lines, failures
+
+# Stopwords before and after: the old loop in NLTK list order, stopWordFilter and
+# stopWordFilterSeries.  Fails on any text where they differ.  Also counts the texts where the old loop in set order, the
+# order it used to run in, or in a shuffled order gives something else.
+def stopwordCheck(bodies, repeats, seed):
+    order = sorted(getStopWords(), key=getStopWords().get)
+    shuffled = order[:]
+    random.Random(seed).shuffle(shuffled)
+    setOrder = list(set(order))
+    texts = STOPWORD_SAMPLE + [t for t, _ in REAL_SAMPLE] + bodies
+    allTexts = texts + randomStopWordTexts(STOPWORD_RANDOM, seed)
+    failures = []
+    unstable = 0
+    for text, gotSeries in zip(allTexts, stopWordFilterSeries(pd.Series(allTexts, dtype=object)).tolist()):
+        old = oldStopWordFilter(text, order)
+        got = etl.stopWordFilter(text)
+        if got != old:
+            failures.append('stopwords: %r gives %r, the old loop %r' % (text, got, old))
+        elif gotSeries != old:
+            failures.append('stopwords: %r gives %r as a Series, the old loop %r' % (text, gotSeries, old))
+        elif oldStopWordFilter(text, setOrder) != old or oldStopWordFilter(text, shuffled) != old:
+            unstable += 1
+    lines = ['stopwords: %d texts, old loop %.2f us/text, filter %.2f us/text, %d mismatches, '
+             '%d where the old loop depends on its order'
+             % (len(texts) + STOPWORD_RANDOM, microsPerText(lambda t: oldStopWordFilter(t, setOrder), texts, repeats),
+                microsPerText(etl.stopWordFilter, texts, repeats), len(failures), unstable)]
+    return lines, failures[:10]
+
+# The before/after checks on the comment bodies of the corpus.
+def runChecks(size='10k', corpusDir=None, seed=0, repeats=3, microRows=MICRO_ROWS):
+    corpusDir = corpusDir or os.path.join(tempfile.gettempdir(), 'wsb_synth')
+    paths = generateCorpus(corpusDir, size, seed)
+    bodies = pd.read_csv(paths['comments'], usecols=['body'], nrows=min(sizeRows(size), microRows))['body']
+    cleaned = [emoji.demojize(etl.cleanData(t)) for t in bodies.dropna().astype(str)]
+    lines, failures = tickerCheck(cleaned, repeats)
+    stopLines, stopFailures = stopwordCheck(cleaned, repeats, seed)
+    return lines + stopLines, failures + stopFailures
+
+# Best wall time of fn() over repeats runs.
+def bestOf(fn, repeats):
+    best = None
+    for _ in range(max(1, repeats)):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def result(rows, seconds):
+    return {'rows': int(rows), 'seconds': round(seconds, 6),
+            'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None}
+
+# Time fn over every text.
+def benchTexts(fn, texts, repeats):
+    return result(len(texts), bestOf(lambda: [fn(t) for t in texts], repeats))
+
+# The per-text stages on the comment bodies.
+def microBenchmarks(paths, rows, repeats):
+    bodies = pd.read_csv(paths['comments'], usecols=['body'], nrows=rows)['body'].dropna().astype(str).tolist()
+    cleaned = [emoji.demojize(etl.cleanData(t)) for t in bodies]
+    etl.initWorker()
+    return {'cleanData': benchTexts(etl.cleanData, bodies, repeats),
+            'stopWordFilter': benchTexts(etl.stopWordFilter, cleaned, repeats),
+            'vadar_sentiment': benchTexts(etl.vadar_sentiment, cleaned, repeats),
+            'getTickersByRe': benchTexts(etl.getTickersByRe, cleaned, repeats)}
+
+# A job dict for a corpus file, writing into datasetLoc.
+def benchJob(job, path, header, paths, datasetLoc):
+    return {'job': job,
+            'folderLoc': os.path.dirname(path),
+            'filename': path,
+            'header': header,
+            'marketData': paths['market'],
+            'datasetLoc': datasetLoc,
+            'sentimentCache': None,
+            'incremental': False}
+
+# runIngest end to end on both files, then putToDisk on the processed comments.
+def ingestBenchmarks(paths, repeats, workDir):
+    results = {}
+    processed = None
+    for name, job, path, header in [('runIngest posts', 'wsb_post_results', paths['posts'], WSB_POST_HEADERS),
+                                    ('runIngest comments', 'wsb_comments_results', paths['comments'], WSB_COMM_HEADERS)]:
+        best = None
+        for r in range(max(1, repeats)):
+            datasetLoc = os.path.join(workDir, 'ingest_' + str(r))
+            on = benchJob(job, path, header, paths, datasetLoc)
+            start = time.perf_counter()
+            out = etl.runIngest(on)
+            elapsed = time.perf_counter() - start
+            shutil.rmtree(datasetLoc, ignore_errors=True)
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = result(out['df'].shape[0], best)
+        processed = (on, out['df'])
+
+    on, df = processed
+    def write():
+        datasetLoc = os.path.join(workDir, 'write')
+        shutil.rmtree(datasetLoc, ignore_errors=True)
+        etl.putToDisk(dict(on, datasetLoc=datasetLoc), df)
+    results['putToDisk'] = result(df.shape[0], bestOf(write, repeats))
+    return results
+
+# Run the suite on the corpus of size.  corpusDir keeps the generated files between runs.
+def runBenchmarks(size='10k', corpusDir=None, seed=0, repeats=3, ingestRepeats=1, microRows=MICRO_ROWS, only=None):
+    corpusDir = corpusDir or os.path.join(tempfile.gettempdir(), 'wsb_synth')
+    paths = generateCorpus(corpusDir, size, seed)
+    results = {}
+    micro = [b for b in ['cleanData', 'stopWordFilter', 'vadar_sentiment', 'getTickersByRe'] if not only or b in only]
+    if micro:
+        allMicro = microBenchmarks(paths, min(sizeRows(size), microRows), repeats)
+        results.update({b: allMicro[b] for b in micro})
+    if not only or any(b in only for b in ['putToDisk', 'runIngest posts', 'runIngest comments']):
+        workDir = tempfile.mkdtemp(prefix='wsb_bench_')
+        try:
+            results.update(ingestBenchmarks(paths, ingestRepeats, workDir))
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def loadBaselines(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+# Record results as the baseline of size.
+def saveBaselines(results, size, path=BASELINE_PATH):
+    baselines = loadBaselines(path)
+    baselines[str(size).lower()] = {'host': platform.node(),
+                                    'python': platform.python_version(),
+                                    'processes': etl.NUM_PROCESSES,
+                                    'recorded': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+                                    'results': results}
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# Compare results with the baseline of size.  Returns the report lines and the regressed benchmarks.
+def compareBaselines(results, size, baselines, tolerance=TOLERANCE):
+    base = baselines.get(str(size).lower(), {}).get('results', {})
+    lines = ['%-20s %12s %12s %8s  %s' % ('benchmark', 'rows/s', 'baseline', 'ratio', 'status')]
+    regressions = []
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        now = results[name]['rows_per_s']
+        then = base.get(name, {}).get('rows_per_s')
+        if not then or not now:
+            lines.append('%-20s %12s %12s %8s  %s' % (name, now, '-', '-', 'no baseline'))
+            continue
+        ratio = now / then
+        status = 'ok'
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio > 1 + tolerance:
+            status = 'faster'
+        lines.append('%-20s %12.1f %12.1f %8.2f  %s' % (name, now, then, ratio, status))
+    return lines, regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the WSB ETL on a synthetic corpus.')
+    parser.add_argument('--size', default='10k', help='10k, 100k, 1m, 10m or a row count')
+    parser.add_argument('--corpus', default=None, help='folder the generated corpus is kept in')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3, help='runs per text benchmark and putToDisk, best counts')
+    parser.add_argument('--ingest-repeats', type=int, default=1)
+    parser.add_argument('--micro-rows', type=int, default=MICRO_ROWS)
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS)
+    parser.add_argument('--baselines', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--save', action='store_true', help='record this run as the baseline of its size')
+    parser.add_argument('--check', action='store_true', help='run the before/after checks instead')
+    args = parser.parse_args()
+
+    if args.check:
+        lines, failures = runChecks(args.size, args.corpus, args.seed, args.repeats, args.micro_rows)
+        print('\n'.join(lines + failures))
+        sys.exit(1 if failures else 0)
+
+    results = runBenchmarks(args.size, args.corpus, args.seed, args.repeats, args.ingest_repeats,
+                            args.micro_rows, args.only)
+    lines, regressions = compareBaselines(results, args.size, loadBaselines(args.baselines), args.tolerance)
+    print('\n'.join(lines))
+    if args.save:
+        saveBaselines(results, args.size, args.baselines)
+        print('baseline saved to', args.baselines)
+    sys.exit(1 if regressions and not args.save else 0)
@@ -0,0 +1,169 @@
+"""
+Stage-level profiling for the WSB ETL.
+
+A StageProfiler records wall time, rows, rows/s and peak RSS for every
+main-process stage of a file (read, dedup, pipeline, touch ups, market join,
+write). Worker batches run through profiledBatch. It times each workerStage
+block inside the batch function and measures the pickled size of the batch in
+and the columns out, and the worker's peak RSS. Worker stage seconds are summed
+over all workers, so their rows/s is per worker, not wall clock.
+
+Profiling is off unless a job sets 'profile'. Then finishProfile writes a JSON
+report per file and prints a summary table.
+"""
+
+import contextlib
+import json
+import os
+import pickle
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Peak resident memory of this process in MB, None when the platform can't tell.
+def peakRssMB():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1024.0 * 1024.0)
+    except ImportError:
+        return None
+
+class StageProfiler:
+    def __init__(self, label):
+        self.label = label
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    def record(self, name, seconds, rows=0, bytesSent=0, bytesReceived=0, rss=None):
+        s = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0,
+                                          'bytes_sent': 0, 'bytes_received': 0, 'peak_rss_mb': None})
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['rows'] += rows
+        s['bytes_sent'] += bytesSent
+        s['bytes_received'] += bytesReceived
+        if rss is not None:
+            s['peak_rss_mb'] = max(s['peak_rss_mb'] or 0.0, rss)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, rows, rss=peakRssMB())
+
+    # Fold in the stats profiledBatch sent back for one batch.
+    def addWorkerStats(self, stats, rows):
+        self.record('pipeline transport', 0.0, rows, stats.get('bytes_sent', 0), stats.get('bytes_received', 0))
+        for name, seconds in stats.get('stages', {}).items():
+            self.record('worker ' + name, seconds, rows, rss=stats.get('rss'))
+
+    def report(self):
+        stages = []
+        for name, s in self.stages.items():
+            entry = {'stage': name}
+            entry.update(s)
+            entry['seconds'] = round(s['seconds'], 6)
+            entry['rows_per_s'] = round(s['rows'] / s['seconds'], 1) if s['seconds'] > 0 else None
+            stages.append(entry)
+        return {'label': self.label,
+                'total_seconds': round(time.perf_counter() - self.start, 6),
+                'peak_rss_mb': peakRssMB(),
+                'stages': stages}
+
+    def summaryTable(self):
+        lines = ['%-24s %10s %10s %12s %10s %10s %10s' % ('stage', 'seconds', 'rows', 'rows/s', 'MB sent', 'MB recv', 'RSS MB')]
+        for s in self.report()['stages']:
+            lines.append('%-24s %10.3f %10d %12s %10.1f %10.1f %10s' % (
+                s['stage'], s['seconds'], s['rows'], s['rows_per_s'] if s['rows_per_s'] is not None else '-',
+                s['bytes_sent'] / 1048576.0, s['bytes_received'] / 1048576.0,
+                '%.0f' % s['peak_rss_mb'] if s['peak_rss_mb'] is not None else '-'))
+        return '\n'.join(lines)
+
+# The profiler main-process stages report to, None when profiling is off.
+_current = None
+
+# Make profiler the current one, None turns profiling off.
+def activate(profiler):
+    global _current
+    _current = profiler
+
+def currentProfiler():
+    return _current
+
+# Time a main-process stage, a no-op when profiling is off.
+@contextlib.contextmanager
+def stage(name, rows=0):
+    if _current is None:
+        yield
+        return
+    with _current.stage(name, rows):
+        yield
+
+# Worker side: seconds per workerStage in the batch being profiled, None when not profiling.
+_workerSeconds = None
+
+# Time a stage inside a worker batch function.
+@contextlib.contextmanager
+def workerStage(name):
+    if _workerSeconds is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _workerSeconds[name] = _workerSeconds.get(name, 0.0) + time.perf_counter() - start
+
+# Run one batch in a worker.  stats always has the elapsed seconds; with measure
+# it also has the per-stage seconds, pickled bytes both ways and the worker's peak RSS.
+def profiledBatch(worker, batch, measure=False):
+    global _workerSeconds
+    stats = {}
+    if measure:
+        _workerSeconds = {}
+        stats['bytes_sent'] = len(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+    start = time.perf_counter()
+    try:
+        cols = worker(batch)
+    finally:
+        stats['elapsed'] = time.perf_counter() - start
+        if measure:
+            stats['stages'] = _workerSeconds
+            _workerSeconds = None
+    if measure:
+        stats['bytes_received'] = len(pickle.dumps(cols, pickle.HIGHEST_PROTOCOL))
+        stats['rss'] = peakRssMB()
+    return cols, stats
+
+# Start profiling a job when it asks for it.
+def startProfile(on):
+    profiler = StageProfiler(os.path.basename(on['filename'])) if on.get('profile') else None
+    activate(profiler)
+    return profiler
+
+# Write the JSON report of a job and print its summary table.  Returns the report path.
+def finishProfile(on, profiler, folder):
+    activate(None)
+    if profiler is None:
+        return None
+    report = profiler.report()
+    report['job'] = on['job']
+    report['filename'] = on['filename']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, on['job'] + '_' + os.path.splitext(profiler.label)[0] + '_'
+                        + time.strftime('%Y%m%d%H%M%S', time.localtime()) + '.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print(profiler.summaryTable())
+    print('profile written to', path)
+    return path
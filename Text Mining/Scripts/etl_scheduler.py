@@ -0,0 +1,301 @@
+"""
+Cross-file scheduler for the WSB ETL.
+
+runScheduled takes the job dicts of every pending file. It pushes their row
+batches through one shared worker pool of NUM_PROCESSES, so small files no
+longer leave cores idle and big files no longer have to wait for the next one.
+Every file is read in chunks with etl.readChunks, sized by the job's
+chunkRows/maxMemoryMB or else by PIECE_MEMORY_MB, and deduplicated with
+etl.dedupChunk, as in etl.runIngestStreaming. A "piece" is one of those chunks.
+Its memory is estimated like etl.streamChunkRows does, as its raw bytes times
+etl.STREAM_MEMORY_FACTOR. No more piece is read once the open ones reach
+MEMORY_MB, so the whole run stays within about MEMORY_MB plus one piece, however
+big the files. Each piece is finished and written as soon as its last batch is
+back.
+
+Batch size follows the measured per-row cost of each worker function, aiming at
+TARGET_BATCH_SECONDS per batch. That keeps the pool busy without a huge batch
+holding up the end of a file.
+"""
+
+import collections
+import concurrent.futures
+import os
+import time
+
+import tqdm
+
+import etl
+from dataset_writer import newRunId
+from etl_profiler import StageProfiler, activate, stage, profiledBatch, finishProfile
+from sentiment_cache import evictCache
+from shared_transport import SharedInput, SharedOutput, outputSpec, sharedBatch, startTransport
+
+TARGET_BATCH_SECONDS = 2.0
+FIRST_BATCH_ROWS = 1000
+MIN_BATCH_ROWS = 100
+MAX_BATCH_ROWS = etl.CHUNCK_SIZE
+# Weight of the newest batch in the per-row cost estimate.
+COST_SMOOTHING = 0.3
+# Memory the open pieces may take, and the chunk size of jobs that set no chunkRows/maxMemoryMB.
+MEMORY_MB = 4096
+PIECE_MEMORY_MB = MEMORY_MB // 4
+# Batches queued per worker, so a worker never waits on the main process.
+BATCHES_PER_WORKER = 2
+
+# One raw file and its progress.
+class FileTask:
+    def __init__(self, on):
+        self.on = on
+        self.prepare, self.worker, self.columns = etl.pipelineOf(on)
+        self.contentHash = None
+        self.chunks = None
+        self.exhausted = False
+        self.openPieces = 0
+        self.rows = 0
+        self.seq = 1
+        self.runId = newRunId()
+        self.start = None
+        self.profiler = StageProfiler(os.path.basename(on['filename'])) if on.get('profile') else None
+
+    # Chunks of the file, PIECE_MEMORY_MB each unless the job sizes them.
+    def open(self):
+        on = self.on if etl.streamingJob(self.on) else dict(self.on, maxMemoryMB=PIECE_MEMORY_MB)
+        self.chunks = etl.readChunks(on)
+
+# Rows of one file that are finished and written together.
+class Piece:
+    def __init__(self, task, df, idCodes):
+        self.task = task
+        self.df = df
+        self.idCodes = idCodes
+        self.size = df.shape[0]
+        self.bytes = int(df.memory_usage(deep=True).sum()) * etl.STREAM_MEMORY_FACTOR
+        self.cursor = 0
+        self.batches = 0
+        self.parts = {}
+        self.firstSubmit = None
+        # Input columns in shared memory while batches are out, see shared_transport.
+        self.shared = None
+        if etl.SHARED_TRANSPORT and self.size > 0:
+            self.shared = SharedInput(df, task.columns)
+
+    # Unmap the shared input once every batch is back.
+    def release(self):
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+    def submittedAll(self):
+        return self.cursor >= self.size
+
+    def finished(self):
+        return self.submittedAll() and len(self.parts) == self.batches
+
+class Scheduler:
+    def __init__(self, jobs, workers, memoryMB=MEMORY_MB):
+        self.pending = collections.deque(FileTask(on) for on in jobs)
+        self.memory = memoryMB * 1024 * 1024
+        self.openBytes = 0
+        self.reading = collections.deque()
+        self.pieces = collections.deque()
+        self.inFlight = {}
+        self.workers = workers
+        self.rowCost = {}
+        self.markets = {}
+        self.seen = {}
+        self.report = []
+        self.progress = tqdm.tqdm(unit='rows')
+
+    # Rows for the next batch of a piece, from the measured cost of its worker.
+    def batchRows(self, piece):
+        cost = self.rowCost.get(piece.task.worker.__name__)
+        rows = FIRST_BATCH_ROWS if cost is None else int(TARGET_BATCH_SECONDS / max(cost, 1e-9))
+        rows = min(rows, -(-piece.size // self.workers))
+        return max(MIN_BATCH_ROWS, min(MAX_BATCH_ROWS, rows))
+
+    # Read pieces until the memory budget is used or nothing is left to read.  One piece is
+    # always let in, so a piece bigger than the budget still goes through.
+    def fill(self):
+        while (self.reading or self.pending) and (not self.pieces or self.openBytes < self.memory):
+            task = self.reading[0] if self.reading else self.openFile()
+            if task is None:
+                continue
+            self.readPiece(task)
+
+    # Start the next pending file, None when it was ingested already.
+    def openFile(self):
+        task = self.pending.popleft()
+        on = task.on
+        task.start = time.perf_counter()
+        task.contentHash, ingested = etl.checkIngested(on)
+        if ingested:
+            self.report.append({'job': on['job'], 'filename': on['filename'], 'skipped': True})
+            return None
+        task.open()
+        self.reading.append(task)
+        print('starting', on['filename'])
+        return task
+
+    # Read the next piece of a file, dedup it and queue it for the workers.
+    def readPiece(self, task):
+        activate(task.profiler)
+        try:
+            self.readPieceOf(task)
+        finally:
+            activate(None)
+
+    def readPieceOf(self, task):
+        on = task.on
+        df = next(task.chunks, None)
+        if df is None:
+            task.exhausted = True
+            self.reading.remove(task)
+            self.finishFileIfDone(task)
+            return
+
+        key = (etl.datasetLoc(on), etl.docTypeOf(on))
+        if on.get('incremental') and key not in self.seen:
+            self.seen[key] = etl.loadSeenIds(on)
+        df, idCodes, self.seen[key] = etl.dedupChunk(on, df, self.seen.get(key))
+        with stage('prepare', df.shape[0]):
+            df = task.prepare(df)
+
+        task.openPieces += 1
+        piece = Piece(task, df, idCodes)
+        if piece.size == 0:
+            self.finishPiece(piece)
+        else:
+            self.pieces.append(piece)
+            self.openBytes += piece.bytes
+
+    # Submit batches, oldest piece first, until every worker has its queue full.
+    def submit(self, pool):
+        for piece in self.pieces:
+            while not piece.submittedAll() and len(self.inFlight) < self.workers * BATCHES_PER_WORKER:
+                rows = min(self.batchRows(piece), piece.size - piece.cursor)
+                measure = piece.task.profiler is not None
+                out = None
+                if piece.shared is not None:
+                    out = SharedOutput(outputSpec(piece.task.worker, piece.task.columns), rows,
+                                       piece.shared.batchBytes(piece.cursor, piece.cursor + rows))
+                    future = pool.submit(sharedBatch, piece.task.worker, piece.shared.name, piece.shared.layout,
+                                         piece.cursor, rows, out.name, out.layout, measure)
+                else:
+                    batch = piece.df[piece.task.columns].iloc[piece.cursor:piece.cursor + rows].to_dict('list')
+                    future = pool.submit(profiledBatch, piece.task.worker, batch, measure)
+                if piece.firstSubmit is None:
+                    piece.firstSubmit = time.perf_counter()
+                self.inFlight[future] = (piece, piece.batches, rows, out)
+                piece.cursor += rows
+                piece.batches += 1
+            if len(self.inFlight) >= self.workers * BATCHES_PER_WORKER:
+                return
+
+    # Take a finished batch, update the cost estimate and finish its piece when complete.
+    def collect(self, future):
+        piece, number, rows, out = self.inFlight.pop(future)
+        if out is None:
+            cols, stats = future.result()
+        else:
+            try:
+                overflow, stats = future.result()
+                cols = out.read(overflow)
+            finally:
+                out.close()
+        if piece.task.profiler is not None:
+            piece.task.profiler.addWorkerStats(stats, rows)
+        name = piece.task.worker.__name__
+        cost = stats['elapsed'] / max(rows, 1)
+        old = self.rowCost.get(name)
+        self.rowCost[name] = cost if old is None else (1 - COST_SMOOTHING) * old + COST_SMOOTHING * cost
+        self.progress.update(rows)
+
+        piece.parts[number] = cols
+        if piece.finished():
+            self.pieces.remove(piece)
+            self.openBytes -= piece.bytes
+            self.finishPiece(piece)
+
+    # Main-process stages and the write for a piece whose batches are all back.
+    def finishPiece(self, piece):
+        piece.release()
+        task = piece.task
+        on = task.on
+        if piece.size > 0:
+            activate(task.profiler)
+            try:
+                if task.profiler is not None:
+                    task.profiler.record('pipeline', time.perf_counter() - piece.firstSubmit, piece.size)
+                with stage('assemble', piece.size):
+                    df = etl.assembleColumns(piece.df, task.worker, task.columns, [piece.parts[i] for i in range(piece.batches)])
+                df['doc_type'] = etl.docTypeOf(on)
+                df = etl.finishFrame(on, df, self.market(on))
+                task.seq = etl.putToDisk(on, df, task.runId, task.seq)
+                etl.markWritten(on, piece.idCodes)
+                task.rows += df.shape[0]
+            finally:
+                activate(None)
+        task.openPieces -= 1
+        self.finishFileIfDone(task)
+
+    # Record a file once it is fully read and every piece is written.
+    def finishFileIfDone(self, task):
+        if task.exhausted and task.openPieces == 0:
+            etl.markIngested(task.on, task.contentHash, task.rows)
+            seconds = time.perf_counter() - task.start
+            self.report.append({'job': task.on['job'], 'filename': task.on['filename'],
+                                'rows': task.rows, 'seconds': round(seconds, 3)})
+            print('completed', task.on['filename'], task.rows, 'rows in', round(seconds, 1), 's')
+            finishProfile(task.on, task.profiler, etl.profileLoc(task.on))
+
+    # Market data is loaded once per source.
+    def market(self, on):
+        key = on.get('marketData') or on['folderLoc']
+        if key not in self.markets:
+            self.markets[key] = etl.getStockData(on)
+        return self.markets[key]
+
+    def run(self, pool):
+        try:
+            while True:
+                self.fill()
+                self.submit(pool)
+                if not self.inFlight:
+                    if not (self.pieces or self.reading or self.pending):
+                        break
+                    continue
+                done, _ = concurrent.futures.wait(list(self.inFlight), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    self.collect(future)
+        finally:
+            self.progress.close()
+            self.release()
+
+    # Free the shared memory of everything still out, after a failure.
+    def release(self):
+        concurrent.futures.wait(list(self.inFlight))
+        for piece, number, rows, out in self.inFlight.values():
+            if out is not None:
+                out.close()
+        self.inFlight.clear()
+        for piece in self.pieces:
+            piece.release()
+
+# Run every job through one worker pool, with at most about memoryMB of pieces open.  The
+# sentiment cache and ticker universe of the first job are used for the whole run.
+# Returns a report entry per file.
+def runScheduled(jobs, workers=None, memoryMB=MEMORY_MB):
+    if not jobs:
+        return []
+    workers = workers or etl.NUM_PROCESSES
+    cachePath = jobs[0].get('sentimentCache')
+    scheduler = Scheduler(jobs, workers, memoryMB)
+    if etl.SHARED_TRANSPORT:
+        startTransport()
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=etl.initWorker,
+                                                initargs=(cachePath, jobs[0].get('tickerUniverse'))) as pool:
+        scheduler.run(pool)
+    if cachePath:
+        evictCache(cachePath)
+    return scheduler.report
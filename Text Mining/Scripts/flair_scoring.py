@@ -0,0 +1,94 @@
+"""
+Batched Flair sentiment for nlp_pipeline.
+
+run_flair_analysis scores each distinct text once, in length sorted
+mini-batches, optionally over several CPU processes. The pool functions live
+in this importable module, so a spawned worker (Windows, macOS) finds them by
+import, even when run_flair_analysis is called from an interactive session
+whose functions could not be pickled. A script that calls it must still keep
+its body under the __main__ guard, since a spawned worker re-imports the main
+script as __mp_main__.
+"""
+
+import multiprocessing
+import os
+
+import flair
+from tqdm import tqdm
+
+# Flair settings: sentences per predict call, CPU processes and torch threads per process (None splits the CPUs).
+FLAIR_BATCH_SIZE = 64
+FLAIR_PROCESSES = 1
+FLAIR_THREADS = None
+
+def length_batches(texts, batch_size):
+    '''
+    Indexes of texts in mini-batches of similar length, longest first, so little padding is computed.
+    '''
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def predict_batch(model, texts, batch_size):
+    '''
+    Flair labels of texts, predicted together without autograd.
+    '''
+    import torch
+    sentences = [flair.data.Sentence(text) for text in texts]
+    with torch.no_grad():
+        model.predict(sentences, mini_batch_size=batch_size)
+    return [s.labels for s in sentences]
+
+# Worker process state: the model, loaded once per process.
+_flair_worker = {}
+
+def init_flair_worker(counter, threads, batch_size):
+    '''
+    Pin the worker to its own CPUs with that many torch threads and load the model.
+    counter is a shared multiprocessing.Value that hands each worker the next index,
+    a worker started to replace a dead one wraps around to the first CPUs again.
+    '''
+    import torch
+    with counter.get_lock():
+        worker = counter.value
+        counter.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        worker %= max(1, len(cpus) // threads)
+        mine = cpus[worker * threads:(worker + 1) * threads]
+        if mine:
+            os.sched_setaffinity(0, mine)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _flair_worker['model'] = flair.models.TextClassifier.load('en-sentiment')
+    _flair_worker['batch_size'] = batch_size
+
+def predict_worker_batch(texts):
+    return predict_batch(_flair_worker['model'], texts, _flair_worker['batch_size'])
+
+def run_flair_analysis(tweets, batch_size=FLAIR_BATCH_SIZE, processes=FLAIR_PROCESSES, threads=FLAIR_THREADS):
+    '''
+    Use Flair to get sentiment, the labels of every tweet in order.
+    Each distinct tweet is scored once, in length sorted mini-batches of batch_size.
+    With processes > 1 the batches are spread over that many processes with threads torch threads each.
+    '''
+    tweets = list(tweets)
+    unique = list(dict.fromkeys(tweets))
+    batches = length_batches(unique, batch_size)
+    texts = [[unique[i] for i in batch] for batch in batches]
+    if processes > 1:
+        threads = threads or max(1, (os.cpu_count() or 1) // processes)
+        counter = multiprocessing.Value('i', 0)
+        with multiprocessing.Pool(processes, initializer=init_flair_worker, initargs=(counter, threads, batch_size)) as pool:
+            results = list(tqdm(pool.imap(predict_worker_batch, texts), total=len(texts)))
+    else:
+        # Instantiate Model
+        flair_sentiment = flair.models.TextClassifier.load('en-sentiment')
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        results = [predict_batch(flair_sentiment, batch, batch_size) for batch in tqdm(texts)]
+    labels = {}
+    for batch, batch_labels in zip(batches, results):
+        for i, label in zip(batch, batch_labels):
+            labels[unique[i]] = label
+    return [labels[tweet] for tweet in tweets]
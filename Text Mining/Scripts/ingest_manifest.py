@@ -0,0 +1,144 @@
+"""
+Incremental ingest bookkeeping for the WSB ETL.
+
+_ingested.json in the dataset root records every raw file by a blake2b hash of
+its contents, so a file that was already ingested is skipped even when it is
+renamed or re-downloaded. The id index keeps every Reddit id already written, as
+the base36 id decoded to an int64. It lives in _id_index/<doc_type>/ as sorted
+.npy delta files, one per write, so a crash mid-file loses nothing that was
+written. Rows whose id is in the index are dropped before any expensive stage.
+Writers and the compaction of the delta files into one take a lock file in the
+doc type's folder, so a compaction never removes files another process is
+reading or has just written.
+"""
+
+import glob as g
+import hashlib
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+INGESTED_NAME = '_ingested.json'
+ID_INDEX_DIR = '_id_index'
+# Merge the delta files once a doc type has this many.
+ID_INDEX_COMPACT_FILES = 64
+ID_INDEX_LOCK = '_lock'
+# A lock file older than this was left by a crashed process and is taken over.
+LOCK_STALE_SECONDS = 600
+LOCK_POLL_SECONDS = 0.05
+
+# Hash of the file contents, read in 8MB blocks.
+def fileHash(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Read the processed-file manifest.
+def readIngested(root):
+    path = os.path.join(root, INGESTED_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+# Was the file with this content hash ingested already?
+def isIngested(root, contentHash):
+    return contentHash in readIngested(root)
+
+# Record an ingested file, replaced atomically.
+def recordIngested(root, contentHash, info):
+    os.makedirs(root, exist_ok=True)
+    ingested = readIngested(root)
+    ingested[contentHash] = info
+    tmp = os.path.join(root, INGESTED_NAME + '.' + uuid.uuid4().hex + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(ingested, f, indent=1)
+    os.replace(tmp, os.path.join(root, INGESTED_NAME))
+
+# Reddit ids are base36, decode them to int64.  Anything else, missing ids and ids too long
+# for int64 included, becomes -1 and is never deduped.
+def redditIdCodes(ids):
+    codes = np.empty(len(ids), dtype=np.int64)
+    for i, x in enumerate(ids):
+        if x is None or pd.isna(x):
+            codes[i] = -1
+            continue
+        try:
+            codes[i] = int(str(x), 36)
+        except (ValueError, OverflowError):
+            codes[i] = -1
+    return codes
+
+# Hold the id index lock of folder.  Created exclusively, so it works on every platform.
+@contextmanager
+def indexLock(folder):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, ID_INDEX_LOCK)
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > LOCK_STALE_SECONDS:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(LOCK_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+# Every id code already written for a doc type, sorted and unique.
+def loadIdIndex(root, docType):
+    folder = os.path.join(root, ID_INDEX_DIR, docType)
+    if not os.path.isdir(folder):
+        return np.empty(0, dtype=np.int64)
+    with indexLock(folder):
+        files = sorted(g.glob(os.path.join(folder, '*.npy')))
+        if not files:
+            return np.empty(0, dtype=np.int64)
+        codes = np.unique(np.concatenate([np.load(f) for f in files]))
+        if len(files) > ID_INDEX_COMPACT_FILES:
+            writeDelta(folder, codes)
+            for f in files:
+                os.remove(f)
+    return codes
+
+# Add freshly written id codes to the index as a new delta file.
+def appendIdIndex(root, docType, codes):
+    codes = np.unique(codes[codes >= 0])
+    if len(codes) == 0:
+        return
+    folder = os.path.join(root, ID_INDEX_DIR, docType)
+    with indexLock(folder):
+        writeDelta(folder, codes)
+
+# Write sorted codes as a new delta file of folder, replaced atomically.
+def writeDelta(folder, codes):
+    tmp = os.path.join(folder, uuid.uuid4().hex + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, codes)
+    os.replace(tmp, os.path.join(folder, uuid.uuid4().hex + '.npy'))
+
+# Drop rows whose id is in seen (sorted codes) or repeats earlier in df.
+# Returns the kept rows and their id codes.
+def dropSeen(df, seen, idCol='id'):
+    codes = redditIdCodes(df[idCol].tolist())
+    inIndex = np.zeros(len(codes), dtype=bool)
+    if len(seen):
+        pos = np.minimum(np.searchsorted(seen, codes), len(seen) - 1)
+        inIndex = (seen[pos] == codes) & (codes >= 0)
+    # Repeats are found on the codes, so rows without a valid id (-1) are all kept.
+    keep = ~inIndex & ~(pd.Series(codes).duplicated().to_numpy() & (codes >= 0))
+    return df[keep], codes[keep]
@@ -0,0 +1,82 @@
+"""
+Market data store for the WSB ETL stock join.
+
+OHLCV and RSI for any number of tickers live in one frame indexed by
+(ticker, date), with categorical tickers, datetime64 dates and float32 values. attachMarket
+looks up every document's (ticker, day) position in that index in one pass and
+takes the market rows by position, so nothing is cast to strings and the WSB
+frame is never merged or copied.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+MARKET_COLUMNS = ["rsi", "open", "high", "low", "close", "volume", "adjusted"]
+
+# Wide column names in gme_amc_cleandata.csv, e.g. "GME RSI" and "GME.Open".
+_WIDE_COLUMN = re.compile(r'^([A-Za-z]+)[ .](RSI|Open|High|Low|Close|Volume|Adjusted)$', re.I)
+
+# Build the store from a long frame with ticker, date and MARKET_COLUMNS.
+def marketFromLong(df):
+    market = df[['ticker', 'date'] + MARKET_COLUMNS].copy()
+    market['ticker'] = market['ticker'].astype(str).str.upper().astype('category')
+    market['date'] = pd.to_datetime(market['date']).dt.normalize()
+    market[MARKET_COLUMNS] = market[MARKET_COLUMNS].astype(np.float32)
+    market = market.drop_duplicates(subset=['ticker', 'date'], keep='last')
+    return market.set_index(['ticker', 'date']).sort_index()
+
+# Build the store from the wide Date / "<T> RSI" / "<T>.Open" ... layout.
+def marketFromWide(df):
+    frames = []
+    fields = {}
+    for col in df.columns:
+        m = _WIDE_COLUMN.match(col)
+        if m:
+            fields.setdefault(m.group(1).upper(), {})[m.group(2).lower()] = col
+    for ticker, cols in fields.items():
+        part = pd.DataFrame({'ticker': ticker, 'date': df['Date']})
+        for c in MARKET_COLUMNS:
+            part[c] = df[cols[c]] if c in cols else np.nan
+        frames.append(part)
+    if not frames:
+        return marketFromLong(pd.DataFrame(columns=['ticker', 'date'] + MARKET_COLUMNS))
+    return marketFromLong(pd.concat(frames, ignore_index=True))
+
+# Load a market CSV, long (ticker,date,...) or wide (Date,"GME RSI","GME.Open",...).
+def loadMarketData(path):
+    df = pd.read_csv(path)
+    if 'ticker' in df.columns:
+        return marketFromLong(df)
+    return marketFromWide(df)
+
+# Tickers the store has data for.
+def marketTickers(market):
+    return set(market.index.get_level_values('ticker').unique().astype(str))
+
+# Attach MARKET_COLUMNS plus the matched ticker and date to df in place.
+# Each row joins on its title ticker when the store knows it, else on its body
+# ticker, which is what the old body merge plus title re-merge did for GME.
+# Rows without market data get NaN.
+def attachMarket(df, market, dateCol='created_utc_datetime', bodyTickerCol='body_tickers', titleTickerCol=None):
+    tickers = df[bodyTickerCol].astype(object)
+    if titleTickerCol is not None:
+        title = df[titleTickerCol].astype(object)
+        tickers = title.where(title.isin(marketTickers(market)), tickers)
+
+    dates = pd.to_datetime(df[dateCol]).dt.normalize()
+    keys = pd.MultiIndex.from_arrays([tickers.to_numpy(), dates.to_numpy()])
+    pos = market.index.get_indexer(keys)
+    found = pos >= 0
+
+    values = market[MARKET_COLUMNS].to_numpy()
+    for i, c in enumerate(MARKET_COLUMNS):
+        col = np.full(len(pos), np.nan, dtype=values.dtype)
+        col[found] = values[pos[found], i]
+        df[c] = col
+
+    matchedTicker = pd.Series(tickers.to_numpy(), index=df.index).where(found)
+    df['ticker'] = matchedTicker.astype('category')
+    df['date'] = dates.where(found)
+    return df
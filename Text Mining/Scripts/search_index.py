@@ -0,0 +1,305 @@
+"""
+Embedded search index over the processed WSB dataset, for offline lookups
+without Elasticsearch.
+
+Documents get dense numbers in created_utc order, so a date range is one
+contiguous range of document numbers. The terms of body_filtered are indexed,
+and so are their adjacent pairs (bigrams), so a phrase like 'short squeeze' is
+answered from postings. The text is already lower case with stopwords removed.
+A longer phrase matches the documents that hold all of its pairs.
+
+Each term's postings are the sorted numbers of the documents that contain it.
+They are stored as delta gaps in variable byte encoding: one byte for a gap
+under 128, two under 16384, and so on. Encoding and decoding are vectorized in
+numpy. Terms are found by a 64 bit hash of their text (doc_ids.hashStrings),
+binary searched in a sorted array.
+
+Every ticker mentioned in the body or title (*_ticker_mentions, not only the
+first one in body_tickers) gets postings too, under TICKER_TERM plus the symbol,
+which no word of the text can be. body_vadar_sentiment and doc_type are side
+indexes: one array of category codes per column, in document order. A query
+intersects the postings of its terms inside the date range, then keeps the
+documents that mention one of its tickers and filters on the side columns.
+
+Everything is in <root>/_search_index: numpy arrays opened memory-mapped and a
+docs.parquet table with the id, body_tickers and side columns. buildSearchIndex
+rebuilds the index from the whole dataset and holds the (term, document) pairs
+in memory while doing so.
+
+    index = loadSearchIndex(root)
+    index.query(must=['short squeeze'], tickers=['GME'], sentiments=['negative'],
+                start='2021-01-25', end='2021-01-29')
+"""
+
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from dataset_writer import datasetFiles, readPart
+from doc_ids import hashStrings
+
+SEARCH_DIR = '_search_index'
+TEXT_COLUMN = 'body_filtered'
+SIDE_COLUMNS = ['doc_type', 'body_vadar_sentiment']
+DOC_COLUMNS = ['id', 'created_utc', 'doc_type', 'body_tickers', 'body_vadar_sentiment']
+MENTION_COLUMNS = ['body_ticker_mentions', 'title_ticker_mentions']
+# Ticker terms start with a private use character, which no cleaned text holds.
+TICKER_TERM = '\ue000'
+BIGRAMS = True
+DAY = 86400
+
+# 64 bit hashes of the strings of an Arrow array.
+def termHashes(arr):
+    return hashStrings(arr)[:, 0]
+
+# Epoch seconds of a 'YYYY-MM-DD' date or timestamp.  A bare date as an end means the end of that day.
+def epochOf(value, end=False):
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    seconds = int(pd.Timestamp(value).timestamp())
+    if end and isinstance(value, str) and len(value) == 10:
+        seconds += DAY - 1
+    return seconds
+
+# Term hashes of a text column, unigrams and bigrams, and its unique (term, row) pairs
+# as indexes into those hashes.
+def textPairs(text, bigrams=BIGRAMS):
+    arr = pa.array(text, type=pa.large_string(), from_pandas=True)
+    lists = pc.utf8_split_whitespace(pc.fill_null(arr, ''))
+    tokens = pc.list_flatten(lists)
+    rows = pc.list_parent_indices(lists).to_numpy().astype(np.int64)
+    if bigrams and len(tokens) > 1:
+        same = np.flatnonzero(rows[1:] == rows[:-1])
+        pairs = pc.binary_join_element_wise(tokens.take(same), tokens.take(same + 1), pa.scalar(' ', pa.large_string()))
+        tokens = pa.concat_arrays([tokens, pairs])
+        rows = np.concatenate([rows, rows[same]])
+    encoded = pc.dictionary_encode(tokens)
+    terms = len(encoded.dictionary)
+    keys = np.sort(rows * terms + encoded.indices.to_numpy())
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+    return termHashes(encoded.dictionary), keys % terms, keys // terms
+
+# Ticker terms of a part file, one space separated string per row, from every mention
+# column it has.  "GME:3 AMC:1" in the body and "GME:1" in the title give "\ue000GME \ue000AMC \ue000GME".
+def tickerText(path):
+    columns = [c for c in MENTION_COLUMNS if c in pq.read_schema(path).names]
+    if not columns:
+        return None
+    df = readPart(path, columns)
+    text = None
+    for col in columns:
+        terms = df[col].astype(object).fillna('').astype(str).str.replace(r'(\S+?):\d+', TICKER_TERM + r'\1', regex=True)
+        text = terms if text is None else text + ' ' + terms
+    return text
+
+# Variable byte encoding: 7 bits per byte, low bits first, the high bit set on all but the last byte.
+def vbyteEncode(values):
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28, 35):
+        lengths += values >= (np.uint64(1) << np.uint64(bits))
+    ends = np.cumsum(lengths)
+    out = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    starts = ends - lengths
+    for j in range(int(lengths.max()) if len(lengths) else 0):
+        sel = lengths > j
+        chunk = (values[sel] >> np.uint64(7 * j)) & np.uint64(127)
+        out[starts[sel] + j] = chunk | np.where(lengths[sel] > j + 1, 128, 0).astype(np.uint64)
+    return out, ends
+
+def vbyteDecode(data):
+    data = np.asarray(data, dtype=np.int64)
+    if len(data) == 0:
+        return data
+    ends = np.flatnonzero(data < 128)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((data & 127) << shift, starts)
+
+# Postings of (term, document) pairs sorted by term then document: per term its
+# hash, count, first document and the byte range of its encoded gaps.
+def encodePostings(hashes, terms, docs):
+    n = len(terms)
+    starts = np.flatnonzero(np.concatenate([[True], terms[1:] != terms[:-1]])) if n else np.empty(0, np.int64)
+    counts = np.diff(np.append(starts, n))
+    gaps = np.diff(docs)
+    keep = np.ones(max(n - 1, 0), dtype=bool)
+    keep[starts[1:] - 1] = False
+    data, ends = vbyteEncode(gaps[keep])
+    gapEnds = np.concatenate([[0], ends])
+    return {'hashes': hashes[terms[starts]], 'counts': counts, 'first': docs[starts],
+            'byteOffset': gapEnds[np.concatenate([[0], np.cumsum(counts - 1)])],
+            'gaps': data}
+
+# Values of sorted unique a that are in sorted unique b.
+def intersectSorted(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[pos] == a]
+
+class SearchIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.postings = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+                         for name in ['hashes', 'counts', 'first', 'byteOffset', 'gaps']}
+        self.hashes = np.asarray(self.postings['hashes'])
+        self.docs = pq.read_table(os.path.join(folder, 'docs.parquet'))
+        self.created = self.docs['created_utc'].to_numpy()
+        self.codes = {}
+        self.categories = {}
+        for col in SIDE_COLUMNS:
+            arr = self.docs[col].combine_chunks()
+            if not pa.types.is_dictionary(arr.type):
+                arr = arr.dictionary_encode()
+            self.codes[col] = pc.fill_null(arr.indices, -1).to_numpy()
+            self.categories[col] = arr.dictionary.to_pylist()
+
+    def __len__(self):
+        return len(self.created)
+
+    # Sorted document numbers of one term, empty when unknown.
+    def termDocs(self, term):
+        h = termHashes(pa.array([term], type=pa.large_string()))[0]
+        t = np.searchsorted(self.hashes, h)
+        if t == len(self.hashes) or self.hashes[t] != h:
+            return np.empty(0, dtype=np.int64)
+        p = self.postings
+        docs = np.empty(int(p['counts'][t]), dtype=np.int64)
+        docs[0] = p['first'][t]
+        np.cumsum(vbyteDecode(p['gaps'][p['byteOffset'][t]:p['byteOffset'][t + 1]]), out=docs[1:])
+        docs[1:] += docs[0]
+        return docs
+
+    # Documents of a word or phrase.  Phrases intersect their bigrams.
+    def phraseDocs(self, text):
+        words = text.lower().split()
+        grams = [' '.join(words[i:i + 2]) for i in range(len(words) - 1)] if len(words) > 1 and BIGRAMS else words
+        docs = None
+        for gram in grams:
+            found = self.termDocs(gram)
+            docs = found if docs is None else intersectSorted(docs, found)
+            if len(docs) == 0:
+                break
+        return docs if docs is not None else np.empty(0, dtype=np.int64)
+
+    # Documents with a code of col in values.
+    def sideMask(self, col, docs, values):
+        wanted = [self.categories[col].index(v) for v in values if v in self.categories[col]]
+        return np.isin(self.codes[col][docs], wanted)
+
+    # Document numbers matching every clause: all of must, at least one of should, none of
+    # mustNot (words or phrases), a mention of one of tickers, the side values and created_utc
+    # from start to end.
+    def search(self, must=(), should=(), mustNot=(), tickers=None, sentiments=None, docTypes=None,
+               start=None, end=None):
+        lo = 0 if start is None else int(np.searchsorted(self.created, epochOf(start)))
+        hi = len(self.created) if end is None else int(np.searchsorted(self.created, epochOf(end, True), 'right'))
+
+        def inRange(docs):
+            return docs[np.searchsorted(docs, lo):np.searchsorted(docs, hi)]
+
+        docs = None
+        # Shortest postings first, so the intersections stay small.
+        for found in sorted((inRange(self.phraseDocs(t)) for t in must), key=len):
+            docs = found if docs is None else intersectSorted(docs, found)
+            if len(docs) == 0:
+                return docs
+        # Unions and exclusions as a bitmap over the date range.
+        if should:
+            hit = np.zeros(hi - lo, dtype=bool)
+            for text in should:
+                hit[inRange(self.phraseDocs(text)) - lo] = True
+            docs = np.flatnonzero(hit) + lo if docs is None else docs[hit[docs - lo]]
+        if docs is None:
+            docs = np.arange(lo, hi, dtype=np.int64)
+        if mustNot:
+            hit = np.zeros(hi - lo, dtype=bool)
+            for text in mustNot:
+                hit[inRange(self.phraseDocs(text)) - lo] = True
+            docs = docs[~hit[docs - lo]]
+        if tickers is not None:
+            hit = np.zeros(hi - lo, dtype=bool)
+            for ticker in tickers:
+                hit[inRange(self.termDocs(TICKER_TERM + ticker)) - lo] = True
+            docs = docs[hit[docs - lo]]
+        for col, values in [('body_vadar_sentiment', sentiments), ('doc_type', docTypes)]:
+            if values is not None:
+                docs = docs[self.sideMask(col, docs, values)]
+        return docs
+
+    # The id, body_tickers and side columns of documents.
+    def frame(self, docs):
+        return self.docs.take(pa.array(docs, type=pa.int64())).to_pandas()
+
+    # search, returning the matching documents as a frame.
+    def query(self, **clauses):
+        return self.frame(self.search(**clauses))
+
+    def count(self, **clauses):
+        return len(self.search(**clauses))
+
+# Build the index of the dataset at root and save it.
+def buildSearchIndex(root, bigrams=BIGRAMS):
+    files = datasetFiles(root)
+    if not files:
+        raise ValueError('no dataset files under ' + root)
+    parts = [readPart(f, DOC_COLUMNS) for f in files]
+    sizes = [p.shape[0] for p in parts]
+    docs = pd.concat(parts, ignore_index=True)
+    order = np.argsort(docs['created_utc'].to_numpy(dtype=np.int64, na_value=-1), kind='stable')
+    docNo = np.empty(len(order), dtype=np.int64)
+    docNo[order] = np.arange(len(order))
+
+    # Per file: its term hashes and (term, document number) pairs, for the text and the tickers.
+    fileTerms = []
+    pairs = []
+    base = 0
+    for f, size in zip(files, sizes):
+        if size:
+            for text, grams in [(readPart(f, [TEXT_COLUMN])[TEXT_COLUMN], bigrams), (tickerText(f), False)]:
+                if text is None:
+                    continue
+                termHash, terms, rows = textPairs(text, grams)
+                fileTerms.append(termHash)
+                pairs.append((terms, docNo[base + rows]))
+        base += size
+    # Terms ranked by hash over all files, so one int64 key sorts by term then document.
+    hashes = np.unique(np.concatenate(fileTerms)) if fileTerms else np.empty(0, np.uint64)
+    keys = np.sort(np.concatenate([np.searchsorted(hashes, termHash)[terms] * len(order) + numbers
+                                   for termHash, (terms, numbers) in zip(fileTerms, pairs)])) if pairs else np.empty(0, np.int64)
+    postings = encodePostings(hashes, keys // max(len(order), 1), keys % max(len(order), 1))
+
+    folder = os.path.join(root, SEARCH_DIR)
+    tmp = folder + '.' + uuid.uuid4().hex + '.tmp'
+    os.makedirs(tmp)
+    # A failed build leaves no half written folder behind.
+    try:
+        for name, values in postings.items():
+            np.save(os.path.join(tmp, name + '.npy'), values)
+        table = pa.Table.from_pandas(docs.iloc[order].reset_index(drop=True), preserve_index=False)
+        table = table.set_column(table.schema.get_field_index('created_utc'), 'created_utc',
+                                 pc.fill_null(table['created_utc'], -1).cast(pa.int64()))
+        pq.write_table(table, os.path.join(tmp, 'docs.parquet'))
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.replace(tmp, folder)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return SearchIndex(folder)
+
+# The saved index, built first when there is none.
+def loadSearchIndex(root):
+    folder = os.path.join(root, SEARCH_DIR)
+    if not os.path.exists(folder):
+        return buildSearchIndex(root)
+    return SearchIndex(folder)
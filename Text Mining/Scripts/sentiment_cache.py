@@ -0,0 +1,82 @@
+"""
+Persistent sentiment cache for the WSB ETL.
+
+WSB is full of exact duplicates (copypasta, bot replies, rocket spam) and files
+get re-ingested, so TextBlob and VADER results are kept in a SQLite file keyed
+by a blake2b hash of the cleaned text. Every worker opens its own connection to
+the same file, WAL mode lets them read while one writes. Titles only need
+VADER, so their rows may leave polarity and subjectivity NULL until the same
+text turns up as a body. A hit bumps last_used only when it is older than
+TOUCH_SECONDS, so most lookups are plain reads with no write or commit.
+evictCache trims the least recently used rows down to a bound.
+"""
+
+import hashlib
+import sqlite3
+import time
+
+# Metrics stored per text, in column order.
+CACHE_FIELDS = ['polarity', 'subjectivity', 'neg', 'neu', 'pos', 'compound']
+# Default bound on cached texts, about 100 bytes a row.
+CACHE_MAX_ENTRIES = 20000000
+# last_used is only as fine as this, eviction goes by days anyway.
+TOUCH_SECONDS = 24 * 3600
+# SQLite's limit on bound parameters is 999 on older builds.
+_SQL_BATCH = 900
+
+# Hash the cleaned text into the cache key.
+def textKey(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+# Open (and create if needed) the cache at path.
+def openCache(path):
+    conn = sqlite3.connect(path, timeout=120)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, '
+                 + ', '.join(f + ' REAL' for f in CACHE_FIELDS) + ', last_used INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+    conn.commit()
+    return conn
+
+# Look up keys, returns {key: tuple of CACHE_FIELDS} for the hits.  Only hits last used
+# more than TOUCH_SECONDS ago are written back, in one UPDATE per call.
+def lookupScores(conn, keys):
+    hits = {}
+    now = int(time.time())
+    stale = []
+    for x in range(0, len(keys), _SQL_BATCH):
+        part = keys[x:x + _SQL_BATCH]
+        marks = ','.join('?' * len(part))
+        for r in conn.execute('SELECT key, ' + ', '.join(CACHE_FIELDS) + ', last_used FROM scores WHERE key IN ('
+                              + marks + ')', part):
+            hits[r[0]] = r[1:-1]
+            if r[-1] < now - TOUCH_SECONDS:
+                stale.append(r[0])
+    if stale:
+        for x in range(0, len(stale), _SQL_BATCH):
+            part = stale[x:x + _SQL_BATCH]
+            conn.execute('UPDATE scores SET last_used = ? WHERE key IN (' + ','.join('?' * len(part)) + ')', [now] + part)
+        conn.commit()
+    return hits
+
+# Store freshly scored texts, rows are (key, polarity, subjectivity, neg, neu, pos, compound).
+# A NULL polarity and subjectivity never overwrite stored ones, and stored NULLs are filled in.
+def storeScores(conn, rows):
+    now = int(time.time())
+    conn.executemany('INSERT INTO scores VALUES (' + ','.join('?' * (len(CACHE_FIELDS) + 2)) + ') '
+                     'ON CONFLICT (key) DO UPDATE SET polarity = coalesce(polarity, excluded.polarity), '
+                     'subjectivity = coalesce(subjectivity, excluded.subjectivity), last_used = excluded.last_used',
+                     [tuple(r) + (now,) for r in rows])
+    conn.commit()
+
+# Drop the least recently used rows until at most maxEntries remain.
+def evictCache(path, maxEntries=CACHE_MAX_ENTRIES):
+    conn = openCache(path)
+    count = conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+    if count > maxEntries:
+        conn.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)',
+                     (count - maxEntries,))
+        conn.commit()
+    conn.close()
+    return max(0, count - maxEntries)
@@ -0,0 +1,102 @@
+"""
+Batch VADER scoring for the WSB ETL.
+
+The analyzer is built once per worker process (use initVader as the pool
+initializer) instead of once per text. scoreVader returns the three-way label
+the ES indices already use, plus the raw neg/neu/pos/compound scores as
+float32 columns, so nothing downstream has to run VADER again.
+
+scoreSentiment adds the TextBlob polarity/subjectivity from a single parse and
+goes through the sentiment cache when the worker was started with a cache path,
+so duplicate texts are scored once. With textBlob=False it scores VADER only,
+for the titles, and still reads and fills the cache.
+"""
+
+import numpy as np
+from textblob import TextBlob
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+#nltk.download('vader_lexicon')
+
+from sentiment_cache import openCache, textKey, lookupScores, storeScores
+
+VADER_SCORES = ['neg', 'neu', 'pos', 'compound']
+
+_analyzer = None
+_cache = None
+
+# Pool initializer, loads the VADER lexicon once per worker and opens the
+# sentiment cache when a path is given.
+def initVader(cachePath=None):
+    global _analyzer, _cache
+    _analyzer = SentimentIntensityAnalyzer()
+    if cachePath:
+        _cache = openCache(cachePath)
+
+# The worker's analyzer, built on first use outside a pool.
+def getVader():
+    if _analyzer is None:
+        initVader()
+    return _analyzer
+
+# Map VADER scores to the negative/positive/neutral label.
+def vaderLabel(scores):
+    if scores['neg'] != 0:
+        return "negative"
+    elif scores['pos'] != 0:
+        return "positive"
+    return "neutral"
+
+# Polarity and subjectivity from one TextBlob parse.
+def textBlobScores(text):
+    sentiment = TextBlob(text).sentiment
+    return sentiment.polarity, sentiment.subjectivity
+
+# Score a list of texts.  Returns <prefix>_vadar_sentiment labels plus
+# <prefix>_vadar_neg/neu/pos/compound float32 arrays.
+def scoreVader(texts, prefix='body'):
+    analyzer = getVader()
+    size = len(texts)
+    scores = {s: np.empty(size, dtype=np.float32) for s in VADER_SCORES}
+    labels = []
+    for i, text in enumerate(texts):
+        result = analyzer.polarity_scores(text)
+        for s in VADER_SCORES:
+            scores[s][i] = result[s]
+        labels.append(vaderLabel(result))
+
+    out = {prefix + '_vadar_sentiment': labels}
+    for s in VADER_SCORES:
+        out[prefix + '_vadar_' + s] = scores[s]
+    return out
+
+# Score a list of texts with TextBlob and VADER, each distinct text once.
+# Returns the scoreVader columns plus, with textBlob, <prefix>_polarity and <prefix>_subjectivity, all float32.
+def scoreSentiment(texts, prefix='body', textBlob=True):
+    analyzer = getVader()
+    keys = [textKey(t) for t in texts]
+    hits = lookupScores(_cache, list(set(keys))) if _cache is not None else {}
+
+    fresh = {}
+    for key, text in zip(keys, texts):
+        hit = hits.get(key)
+        if key in fresh or (hit is not None and (hit[0] is not None or not textBlob)):
+            continue
+        if hit is not None:
+            vader = hit[2:]
+        else:
+            scores = analyzer.polarity_scores(text)
+            vader = tuple(scores[s] for s in VADER_SCORES)
+        fresh[key] = (textBlobScores(text) if textBlob else (None, None)) + vader
+    if _cache is not None and fresh:
+        storeScores(_cache, [(k,) + v for k, v in fresh.items()])
+    hits.update(fresh)
+
+    rows = np.array([hits[k] for k in keys], dtype=np.float64).reshape(len(keys), 2 + len(VADER_SCORES))
+    out = {}
+    if textBlob:
+        out[prefix + '_polarity'] = rows[:, 0].astype(np.float32)
+        out[prefix + '_subjectivity'] = rows[:, 1].astype(np.float32)
+    out[prefix + '_vadar_sentiment'] = [vaderLabel({'neg': r[2], 'pos': r[4]}) for r in rows]
+    for i, s in enumerate(VADER_SCORES):
+        out[prefix + '_vadar_' + s] = rows[:, 2 + i].astype(np.float32)
+    return out
@@ -0,0 +1,233 @@
+"""
+Shared-memory transport between the ETL and its worker pool.
+
+Pickling a batch pickles every string of it, and the main process then builds
+every result string again. Here the main process packs a frame's text input
+columns, as Arrow large_string offsets plus UTF-8 data, into one
+SharedMemory segment per frame (SharedInput). A worker gets only the segment
+name, the layout and its row range. It views the buffers in place and decodes
+just its own rows.
+
+Outputs go into a SharedOutput segment that the main process preallocates per
+batch. Numeric columns are written straight into typed slots. Text columns are
+written as row end offsets plus UTF-8 data, into a slot sized from the batch's
+input bytes (OUT_GROWTH per input byte plus OUT_SLACK per row). Back in the
+main process each text column becomes an Arrow array, built with a single
+memcpy out of the segment and no Python string per row, and it is assigned as
+an Arrow-backed string column. A text column that outgrows its slot comes back
+pickled, so the result is the same either way.
+
+The main process creates and unlinks every segment, so segments never outlive
+the frame or the batch, on Windows as well. Call startTransport before the pool
+is made so forked workers share the main process's resource tracker, instead
+of starting their own, which would unlink the segments they saw when they exit.
+"""
+
+import collections
+import os
+import pickle
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from etl_profiler import profiledBatch
+
+TEXT = 'text'
+OUT_GROWTH = 2
+OUT_SLACK = 64
+# Input segments a worker keeps mapped.
+ATTACHED_MAX = 8
+_ALIGN = 8
+
+def aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+# Round up and never ask for an empty segment, which SharedMemory refuses.
+def newSegment(size):
+    return shared_memory.SharedMemory(create=True, size=max(_ALIGN, aligned(size)))
+
+def closeSegment(shm):
+    shm.close()
+    shm.unlink()
+
+# Start the resource tracker before the worker pool forks, POSIX only.
+def startTransport():
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+# A frame's text columns in one segment, created by the main process.
+class SharedInput:
+    def __init__(self, df, columns):
+        arrays = {}
+        for c in columns:
+            arr = pa.array(df[c], type=pa.large_string(), from_pandas=True)
+            arrays[c] = arr.combine_chunks() if isinstance(arr, pa.ChunkedArray) else arr
+        size = sum(aligned(8 * (len(a) + 1)) + aligned(a.buffers()[2].size if a.buffers()[2] else 0)
+                   for a in arrays.values())
+        self.shm = newSegment(size)
+        self.layout = {}
+        self.offsets = {}
+        pos = 0
+        for c, arr in arrays.items():
+            n = len(arr)
+            offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64, count=n + 1, offset=8 * arr.offset)
+            base = int(offsets[0])
+            data = arr.buffers()[2]
+            dataLen = int(offsets[-1]) - base
+            nulls = None
+            if arr.null_count:
+                nulls = arr.is_null().to_numpy(zero_copy_only=False)
+
+            view = np.ndarray(n + 1, dtype=np.int64, buffer=self.shm.buf, offset=pos)
+            view[:] = offsets - base
+            self.offsets[c] = view
+            offsetsPos = pos
+            pos += aligned(8 * (n + 1))
+            if dataLen:
+                self.shm.buf[pos:pos + dataLen] = memoryview(data).cast('B')[base:base + dataLen]
+            self.layout[c] = (n, offsetsPos, pos, dataLen, None if nulls is None else np.flatnonzero(nulls))
+            pos += aligned(dataLen)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # UTF-8 bytes of the input text of rows start to end.
+    def batchBytes(self, start, end):
+        return sum(int(o[end] - o[start]) for o in self.offsets.values())
+
+    def close(self):
+        self.offsets = {}
+        closeSegment(self.shm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Output columns of a batch worker: TEXT or the numpy dtype of each, from a run on an empty batch.
+_specs = {}
+
+def outputSpec(worker, columns):
+    if worker not in _specs:
+        spec = []
+        for k, v in worker({c: [] for c in columns}).items():
+            spec.append((k, v.dtype.str if isinstance(v, np.ndarray) else TEXT))
+        _specs[worker] = spec
+    return _specs[worker]
+
+# The output segment of one batch, preallocated by the main process.
+class SharedOutput:
+    def __init__(self, spec, rows, inputBytes):
+        self.rows = rows
+        self.layout = []
+        pos = 0
+        for name, kind in spec:
+            if kind == TEXT:
+                capacity = OUT_GROWTH * inputBytes + OUT_SLACK * rows
+                self.layout.append((name, kind, pos, pos + aligned(8 * rows), capacity))
+                pos += aligned(8 * rows) + aligned(capacity)
+            else:
+                self.layout.append((name, kind, pos, None, None))
+                pos += aligned(np.dtype(kind).itemsize * rows)
+        self.shm = newSegment(pos)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # The columns the worker wrote, copied out of the segment.  overflow holds
+    # the text columns that came back pickled.
+    def read(self, overflow):
+        cols = {}
+        for name, kind, pos, dataPos, capacity in self.layout:
+            if name in overflow:
+                cols[name] = overflow[name]
+            elif kind == TEXT:
+                ends = np.ndarray(self.rows, dtype=np.int64, buffer=self.shm.buf, offset=pos)
+                offsets = np.zeros(self.rows + 1, dtype=np.int64)
+                offsets[1:] = ends
+                used = int(offsets[-1])
+                data = pa.py_buffer(bytes(self.shm.buf[dataPos:dataPos + used]))
+                cols[name] = pa.LargeStringArray.from_buffers(self.rows, pa.py_buffer(offsets), data)
+            else:
+                cols[name] = np.ndarray(self.rows, dtype=kind, buffer=self.shm.buf, offset=pos).copy()
+        return cols
+
+    def close(self):
+        closeSegment(self.shm)
+
+# Worker side: input segments stay mapped across batches, oldest unmapped first.
+_attached = collections.OrderedDict()
+
+def attach(name):
+    shm = _attached.pop(name, None)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        while len(_attached) >= ATTACHED_MAX:
+            _attached.popitem(last=False)[1].close()
+    _attached[name] = shm
+    return shm
+
+# Rows start to start + rows of the input columns as lists of str (None for nulls).
+def readInput(shm, layout, start, rows):
+    batch = {}
+    for c, (n, offsetsPos, dataPos, dataLen, nulls) in layout.items():
+        offsets = np.ndarray(n + 1, dtype=np.int64, buffer=shm.buf, offset=offsetsPos)
+        lo, hi = int(offsets[start]), int(offsets[start + rows])
+        local = offsets[start:start + rows + 1] - lo
+        data = bytes(shm.buf[dataPos + lo:dataPos + hi])
+        batch[c] = [data[a:b].decode('utf-8') for a, b in zip(local[:-1].tolist(), local[1:].tolist())]
+        if nulls is not None:
+            for i in nulls[(nulls >= start) & (nulls < start + rows)] - start:
+                batch[c][i] = None
+        del offsets, local
+    return batch
+
+# Write a worker's columns into the batch output segment.  Returns the text columns that did not fit.
+def writeOutput(shm, layout, cols):
+    overflow = {}
+    for name, kind, pos, dataPos, capacity in layout:
+        values = cols[name]
+        if kind != TEXT:
+            view = np.ndarray(len(values), dtype=kind, buffer=shm.buf, offset=pos)
+            view[:] = values
+            del view
+            continue
+        arr = pa.array(values, type=pa.large_string())
+        offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64, count=len(arr) + 1)
+        used = int(offsets[-1])
+        if used > capacity or arr.null_count:
+            overflow[name] = values
+            continue
+        ends = np.ndarray(len(arr), dtype=np.int64, buffer=shm.buf, offset=pos)
+        ends[:] = offsets[1:]
+        del ends
+        if used:
+            shm.buf[dataPos:dataPos + used] = memoryview(arr.buffers()[2]).cast('B')[:used]
+    return overflow
+
+# Run one batch through worker via the shared segments.  Returns the overflow
+# columns and the profiledBatch stats, with the bytes that crossed the pipe.
+def sharedBatch(worker, inName, inLayout, start, rows, outName, outLayout, measure=False):
+    batch = readInput(attach(inName), inLayout, start, rows)
+    cols, stats = profiledBatch(worker, batch, measure)
+    out = shared_memory.SharedMemory(name=outName)
+    try:
+        overflow = writeOutput(out, outLayout, cols)
+    finally:
+        out.close()
+    if measure:
+        stats['bytes_sent'] = len(pickle.dumps((inName, inLayout, start, rows, outName, outLayout), pickle.HIGHEST_PROTOCOL))
+        stats['bytes_received'] = len(pickle.dumps(overflow, pickle.HIGHEST_PROTOCOL))
+    return overflow, stats
+
+# The batch chunks of one text output column as an Arrow-backed string column,
+# without a Python string per row.  Pickled (list) chunks are converted.
+def arrowColumn(chunks):
+    arrays = [c if isinstance(c, pa.Array) else pa.array(c, type=pa.large_string()) for c in chunks]
+    return pd.arrays.ArrowStringArray(pa.chunked_array(arrays, type=pa.large_string()))
@@ -0,0 +1,237 @@
+"""
+Comment-thread graph index over the processed WSB comments.
+
+Every comment write appends its (id, parent_id, link_id) edges, as base36
+codes, to _thread_index/edges/ as .npy delta files, like the id index. Once a
+file is ingested the index is rebuilt from them and saved to
+_thread_index/index.npz.
+
+Nodes are dense integers. The posts (every link_id seen) come first, in id
+order, and then the comments. parent holds each node's parent node (-1 for
+posts). A comment whose parent_id equals its link_id is top level. A reply
+whose parent comment is not in the dataset hangs off its post. The child lists
+are CSR arrays (childPtr, children). depth (posts 0), subtreeSize (self
+included) and root (the post node) are precomputed level by level, with no
+per-row Python.
+
+rollUp aggregates any comment column per thread and subtreeTotals sums it
+under every node. Both are bincounts over these arrays instead of repeated
+self-merges.
+"""
+
+import glob as g
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from ingest_manifest import redditIdCodes
+
+THREAD_DIR = '_thread_index'
+EDGES_DIR = 'edges'
+INDEX_NAME = 'index.npz'
+# Merge the edge delta files once there are this many.
+EDGES_COMPACT_FILES = 64
+
+# Reddit id codes back to base36 ids.
+def idStrings(codes):
+    return [np.base_repr(int(c), 36).lower() for c in codes]
+
+# Indexes of the children of every node in nodes, concatenated, from CSR arrays.
+def gatherChildren(childPtr, children, nodes):
+    starts = childPtr[nodes]
+    lengths = childPtr[nodes + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return children[np.arange(total) + offsets]
+
+class ThreadIndex:
+    def __init__(self, codes, nPosts, parent, childPtr, children, depth, subtreeSize, root, levels=None):
+        self.codes = codes
+        self.nPosts = int(nPosts)
+        self.parent = parent
+        self.childPtr = childPtr
+        self.children = children
+        self.depth = depth
+        self.subtreeSize = subtreeSize
+        self.root = root
+        self.levels = levels if levels is not None else self.levelsOf()
+
+    # Build the index from comment id, parent_id and link_id codes.
+    @classmethod
+    def build(cls, ids, parents, links):
+        valid = (ids >= 0) & (links >= 0)
+        ids, parents, links = ids[valid], parents[valid], links[valid]
+        ids, first = np.unique(ids, return_index=True)
+        parents, links = parents[first], links[first]
+
+        posts = np.unique(links)
+        nPosts = len(posts)
+        codes = np.concatenate([posts, ids])
+        n = len(codes)
+
+        postNode = np.searchsorted(posts, links)
+        pos = np.minimum(np.searchsorted(ids, parents), max(len(ids) - 1, 0))
+        isReply = (parents != links) & (len(ids) > 0)
+        found = isReply & (ids[pos] == parents) & (pos != np.arange(len(ids)))
+        parent = np.full(n, -1, dtype=np.int64)
+        parent[nPosts:] = np.where(found, nPosts + pos, postNode)
+
+        root = np.arange(n, dtype=np.int64)
+        root[nPosts:] = postNode
+
+        # CSR child lists, children in node order.
+        counts = np.bincount(parent[nPosts:], minlength=n)
+        childPtr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=childPtr[1:])
+        children = nPosts + np.argsort(parent[nPosts:], kind='stable')
+
+        # Depth level by level from the posts.  A cycle in the input is never reached and keeps depth -1.
+        depth = np.full(n, -1, dtype=np.int32)
+        frontier = np.arange(nPosts, dtype=np.int64)
+        depth[frontier] = 0
+        levels = [frontier]
+        while len(frontier):
+            frontier = gatherChildren(childPtr, children, frontier)
+            frontier = frontier[depth[frontier] < 0]
+            depth[frontier] = len(levels)
+            if len(frontier):
+                levels.append(frontier)
+
+        index = cls(codes, nPosts, parent, childPtr, children, depth, None, root, levels)
+        index.subtreeSize = index.subtreeTotals(np.arange(n), np.ones(n, dtype=np.int64))
+        return index
+
+    # Nodes grouped by depth, posts first.
+    def levelsOf(self):
+        order = np.argsort(self.depth, kind='stable')
+        order = order[self.depth[order] >= 0]
+        bounds = np.flatnonzero(np.diff(self.depth[order])) + 1
+        return np.split(order, bounds)
+
+    def __len__(self):
+        return len(self.codes)
+
+    # Node of every id (base36 strings or codes), -1 when unknown.  posts picks the post or comment nodes.
+    def nodes(self, ids, posts=False):
+        codes = np.asarray(ids, dtype=np.int64) if np.issubdtype(np.asarray(ids).dtype, np.integer) else redditIdCodes(list(ids))
+        lo, hi = (0, self.nPosts) if posts else (self.nPosts, len(self.codes))
+        keys = self.codes[lo:hi]
+        if len(keys) == 0:
+            return np.full(len(codes), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+        return np.where((keys[pos] == codes) & (codes >= 0), lo + pos, -1)
+
+    # Base36 ids of the posts, in post node order.
+    def postIds(self):
+        return idStrings(self.codes[:self.nPosts])
+
+    def childrenOf(self, node):
+        return self.children[self.childPtr[node]:self.childPtr[node + 1]]
+
+    # Every node under node, itself included, in breadth-first order.
+    def subtreeOf(self, node):
+        out = [np.array([node], dtype=np.int64)]
+        while len(out[-1]):
+            out.append(gatherChildren(self.childPtr, self.children, out[-1]))
+        return np.concatenate(out)
+
+    # Sum of values over the subtree of every node.  values are given for nodes, the rest count 0.
+    def subtreeTotals(self, nodes, values):
+        values = np.asarray(values)
+        keep = nodes >= 0
+        acc = np.zeros(len(self.codes), dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+        np.add.at(acc, nodes[keep], values[keep])
+        for level in reversed(self.levels[1:]):
+            acc += np.bincount(self.parent[level], weights=acc[level], minlength=len(acc)).astype(acc.dtype)
+        return acc
+
+    # Aggregate values of nodes per thread.  how is sum, mean, count, min or max.
+    # Returns an array over the post nodes, NaN for threads without values (0 for sum/count).
+    def rollUp(self, nodes, values=None, how='sum'):
+        keep = nodes >= 0
+        roots = self.root[nodes[keep]]
+        if how == 'count':
+            return np.bincount(roots, minlength=self.nPosts)
+        values = np.asarray(values, dtype=np.float64)[keep]
+        if how in ('sum', 'mean'):
+            totals = np.bincount(roots, weights=values, minlength=self.nPosts)
+            if how == 'sum':
+                return totals
+            counts = np.bincount(roots, minlength=self.nPosts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return totals / counts
+        if how in ('min', 'max'):
+            out = np.full(self.nPosts, np.inf if how == 'min' else -np.inf)
+            (np.minimum if how == 'min' else np.maximum).at(out, roots, values)
+            out[np.isinf(out)] = np.nan
+            return out
+        raise ValueError('unknown aggregation ' + how)
+
+    # rollUp of comment columns of df (with an id column) into a frame indexed by post id.
+    # columns maps output name to (column, how), e.g. {'sentiment': ('body_vadar_compound', 'mean')}.
+    def threadFrame(self, df, columns, idCol='id'):
+        nodes = self.nodes(df[idCol].astype(str).tolist())
+        out = {'comments': self.rollUp(nodes, how='count')}
+        for name, (col, how) in columns.items():
+            out[name] = self.rollUp(nodes, df[col].to_numpy(dtype=np.float64, na_value=np.nan), how)
+        out['thread_size'] = self.subtreeSize[:self.nPosts] - 1
+        return pd.DataFrame(out, index=pd.Index(self.postIds(), name='link_id'))
+
+    def save(self, path):
+        tmp = path + '.' + uuid.uuid4().hex + '.tmp.npz'
+        np.savez(tmp, codes=self.codes, nPosts=self.nPosts, parent=self.parent, childPtr=self.childPtr,
+                 children=self.children, depth=self.depth, subtreeSize=self.subtreeSize, root=self.root)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['codes'], f['nPosts'], f['parent'], f['childPtr'], f['children'], f['depth'],
+                       f['subtreeSize'], f['root'])
+
+# Add the edges of written comments (cleaned id, parent_id, link_id) as a new delta file.
+def appendEdges(root, df):
+    if df.shape[0] == 0:
+        return
+    edges = np.stack([redditIdCodes(df[c].tolist()) for c in ['id', 'parent_id', 'link_id']], axis=1)
+    folder = os.path.join(root, THREAD_DIR, EDGES_DIR)
+    os.makedirs(folder, exist_ok=True)
+    tmp = os.path.join(folder, uuid.uuid4().hex + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, edges)
+    os.replace(tmp, os.path.join(folder, uuid.uuid4().hex + '.npy'))
+
+# Every edge written so far as an (n, 3) array, compacting the delta files when there are many.
+def loadEdges(root):
+    folder = os.path.join(root, THREAD_DIR, EDGES_DIR)
+    files = sorted(g.glob(os.path.join(folder, '*.npy')))
+    if not files:
+        return np.empty((0, 3), dtype=np.int64)
+    edges = np.concatenate([np.load(f) for f in files])
+    if len(files) > EDGES_COMPACT_FILES:
+        tmp = os.path.join(folder, uuid.uuid4().hex + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, edges)
+        os.replace(tmp, os.path.join(folder, uuid.uuid4().hex + '.npy'))
+        for f in files:
+            os.remove(f)
+    return edges
+
+# Rebuild the index from the edges and save it.
+def buildThreadIndex(root):
+    edges = loadEdges(root)
+    index = ThreadIndex.build(edges[:, 0], edges[:, 1], edges[:, 2])
+    os.makedirs(os.path.join(root, THREAD_DIR), exist_ok=True)
+    index.save(os.path.join(root, THREAD_DIR, INDEX_NAME))
+    return index
+
+# The saved index, built first when there is none.
+def loadThreadIndex(root):
+    path = os.path.join(root, THREAD_DIR, INDEX_NAME)
+    if not os.path.exists(path):
+        return buildThreadIndex(root)
+    return ThreadIndex.load(path)
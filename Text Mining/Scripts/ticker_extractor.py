@@ -0,0 +1,123 @@
+"""
+Multi-ticker extraction for the WSB ETL.
+
+Every document is scanned by one compiled regex, so the scan runs in C. Its
+alternatives are the "$GME" / "(GME)" forms, case sensitive like the old
+getTickersByRe, and the company names of a ticker universe in any case. The
+symbol forms take any one to four capital letters, as the old regex did, plus
+any longer symbol of the universe. A hit counts only when it is whole, meaning
+whitespace or the start/end of the text on both sides.
+
+Names in AMBIGUOUS_NAMES are everyday words ('space', 'silver') that would tag
+ordinary sentences. They are left out unless the extractor is built with
+ambiguous=True. The symbol forms of their tickers still match.
+
+The old GME-only workflow is the GME_UNIVERSE configuration, and
+DEFAULT_UNIVERSE holds the names getTickersByName used to hardcode. A universe
+can also be loaded from a CSV with symbol and name columns.
+"""
+
+import csv
+import re
+
+import pandas as pd
+
+GME_UNIVERSE = {'GME': ['gamestop']}
+
+DEFAULT_UNIVERSE = {'GME': ['gamestop'],
+                    'AMC': [],
+                    'BB': ['black berry', 'blackberry'],
+                    'NOK': ['nokia'],
+                    'SLV': ['silver'],
+                    'K': ['kelloggs'],
+                    'TSLA': ['tesla'],
+                    'SPCE': ['space']}
+
+# Company names that are also everyday words.
+AMBIGUOUS_NAMES = {'space', 'silver', 'gold', 'target', 'apple', 'square', 'visa', 'ford', 'shop', 'snap'}
+
+# Any cashtag the old regex found.
+CASHTAG = '[A-Z]{1,4}'
+
+# Load a universe from a CSV with symbol and name columns.  A symbol can repeat
+# for several names, an empty name just registers the symbol.
+def loadUniverse(path):
+    universe = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            symbol = row['symbol'].strip().upper()
+            names = universe.setdefault(symbol, [])
+            name = (row.get('name') or '').strip().lower()
+            if name and name not in names:
+                names.append(name)
+    return universe
+
+# Longest first, so an alternation prefers 'black berry' over a shorter overlapping key.
+def byLength(keys):
+    return sorted(keys, key=lambda k: (-len(k), k))
+
+# A name in any case that only matches at the start of a word.  Its first character is a
+# literal and the whitespace check comes after it, so the regex can still skip straight to
+# the characters a hit starts with.
+def wordStart(name):
+    rest = r'(?<!\S.)(?i:' + re.escape(name[1:]) + ')'
+    return '|'.join(re.escape(first) + rest for first in sorted({name[0].lower(), name[0].upper()}))
+
+# Finds every ticker of a universe in a document.
+class TickerExtractor:
+    def __init__(self, universe=None, ambiguous=False):
+        self.universe = universe if universe is not None else DEFAULT_UNIVERSE
+        self.names = {}
+        for symbol, names in self.universe.items():
+            for name in names:
+                name = name.lower()
+                if ambiguous or name not in AMBIGUOUS_NAMES:
+                    self.names[name] = symbol
+        symbols = '|'.join([re.escape(s) for s in byLength(self.universe) if not re.fullmatch(CASHTAG, s)] + [CASHTAG])
+        names = ''.join('|' + wordStart(name) for name in byLength(self.names))
+        self.pattern = re.compile(r'(\$(?<!\S.)(%s)|\((?<!\S.)(%s)\)%s)(?!\S)' % (symbols, symbols, names))
+
+    # {symbol: count} for every mention, in order of first mention.
+    def extract(self, text):
+        counts = {}
+        for hit, dollar, paren in self.pattern.findall(text):
+            symbol = dollar or paren or self.names[hit.lower()]
+            counts[symbol] = counts.get(symbol, 0) + 1
+        return counts
+
+    # extract over a list of texts.
+    def extractBatch(self, texts):
+        return [self.extract(t) for t in texts]
+
+    # extract over a pandas Series, returns a Series of {symbol: count} dicts.
+    def extractSeries(self, s):
+        return pd.Series(self.extractBatch(s.tolist()), index=s.index)
+
+# The first mentioned symbol, what the single-ticker stock join uses.
+def primaryTicker(counts):
+    return next(iter(counts), "")
+
+# Flat "GME:3 AMC:1" form of the counts for CSV, Parquet and ES.
+def formatMentions(counts):
+    return ' '.join(symbol + ':' + str(count) for symbol, count in counts.items())
+
+# Back from the flat form to {symbol: count}.
+def parseMentions(text):
+    counts = {}
+    for part in str(text).split():
+        symbol, _, count = part.partition(':')
+        counts[symbol] = int(count or 1)
+    return counts
+
+_extractor = None
+
+# Pool initializer, compiles the ticker pattern once per worker.
+def initTickers(universePath=None):
+    global _extractor
+    _extractor = TickerExtractor(loadUniverse(universePath) if universePath else None)
+
+# The worker's extractor, built with the default universe on first use outside a pool.
+def getTickerExtractor():
+    if _extractor is None:
+        initTickers()
+    return _extractor
@@ -0,0 +1,126 @@
+"""
+Declared column types of the processed WSB posts and comments.
+
+Low-cardinality text (author, subreddit, domain, doc_type, VADER labels,
+tickers and ticker mentions) is categorical. Free text and ids are Arrow
+backed strings. Scores and market columns are float32. created_utc_datetime
+is datetime64, converted in one vectorized pass. The same dtypes are used when
+the raw CSV is read (RAW_DTYPES), after the pipeline (applySchema), and again
+when the Parquet dataset is read back. So a frame has the same compact layout
+wherever it comes from.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+STRING = pd.StringDtype('pyarrow')
+CATEGORY = 'category'
+FLOAT = 'float32'
+
+# Columns of the raw Pushshift post and comment dumps.
+WSB_POST_HEADERS = ['id', 'author', 'author_premium', 'created_utc', 'domain', 'title', 'selftext', 'subreddit',
+                    'subreddit_id', 'num_comments', 'upvote_ratio']
+WSB_COMM_HEADERS = ['id', 'parent_id', 'link_id', 'author', 'created_utc', 'body', 'subreddit', 'subreddit_id']
+
+# Raw CSV column types, applied by read_csv.  Numeric columns are left to the parser and cast in applySchema.
+RAW_DTYPES = {'id': STRING,
+              'parent_id': STRING,
+              'link_id': STRING,
+              'author': CATEGORY,
+              'domain': CATEGORY,
+              'title': STRING,
+              'selftext': STRING,
+              'body': STRING,
+              'subreddit': CATEGORY,
+              'subreddit_id': CATEGORY}
+
+# Columns both doc types have.
+_SHARED = {'id': STRING,
+           'author': CATEGORY,
+           'created_utc': 'Int64',
+           'body': STRING,
+           'subreddit': CATEGORY,
+           'subreddit_id': CATEGORY,
+           'body_filtered': STRING,
+           'created_utc_datetime': 'datetime64[ns]',
+           'body_tickers': CATEGORY,
+           'body_ticker_mentions': CATEGORY,
+           'body_polarity': FLOAT,
+           'body_subjectivity': FLOAT,
+           'body_vadar_sentiment': CATEGORY,
+           'body_vadar_neg': FLOAT,
+           'body_vadar_neu': FLOAT,
+           'body_vadar_pos': FLOAT,
+           'body_vadar_compound': FLOAT,
+           'doc_type': CATEGORY,
+           'created_date': CATEGORY,  # dataset partition, see dataset_writer
+           'rsi': FLOAT,
+           'open': FLOAT,
+           'high': FLOAT,
+           'low': FLOAT,
+           'close': FLOAT,
+           'volume': FLOAT,
+           'adjusted': FLOAT,
+           'ticker': CATEGORY,
+           'date': 'datetime64[ns]'}
+
+POST_SCHEMA = dict(_SHARED, **{'author_premium': 'boolean',
+                               'domain': CATEGORY,
+                               'title': STRING,
+                               'num_comments': 'Int32',
+                               'upvote_ratio': FLOAT,
+                               'title_filtered': STRING,
+                               'title_tickers': CATEGORY,
+                               'title_ticker_mentions': CATEGORY,
+                               'title_vadar_sentiment': CATEGORY,
+                               'title_vadar_neg': FLOAT,
+                               'title_vadar_neu': FLOAT,
+                               'title_vadar_pos': FLOAT,
+                               'title_vadar_compound': FLOAT})
+
+COMMENT_SCHEMA = dict(_SHARED, **{'parent_id': STRING,
+                                  'link_id': STRING})
+
+# Every column of the dataset, for readers that mix doc types.
+DATASET_SCHEMA = dict(POST_SCHEMA, **COMMENT_SCHEMA)
+
+# The schema of a doc type.
+def schemaOf(docType):
+    return POST_SCHEMA if docType == 'wsb_post' else COMMENT_SCHEMA
+
+# read_csv dtypes for the columns of a raw file.
+def rawDtypes(header):
+    return {c: RAW_DTYPES[c] for c in header if c in RAW_DTYPES}
+
+# Cast the declared columns df has to their schema dtype, in place.  Other columns are left alone.
+def applySchema(df, schema=DATASET_SCHEMA):
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if dtype == CATEGORY:
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                # Categories left over from filtering or from another part file.
+                df[col] = s.cat.remove_unused_categories()
+            else:
+                df[col] = s.astype(CATEGORY)
+        elif str(s.dtype) != str(dtype):
+            df[col] = s.astype(dtype)
+    return df
+
+# Epoch seconds to naive local datetime64, the same values datetime.fromtimestamp gives.
+# The UTC offset is looked up once per distinct 15 minute slot, which is as fine as
+# any DST rule goes, instead of once per row.
+def localDatetimes(seconds):
+    seconds = pd.to_numeric(pd.Series(seconds), errors='coerce').astype('float64')
+    values = seconds.to_numpy()
+    valid = ~np.isnan(values)
+    slots, inverse = np.unique(np.floor(values[valid] / 900), return_inverse=True)
+    offsets = np.array([time.localtime(int(s) * 900).tm_gmtoff for s in slots], dtype=np.int64)
+
+    shift = np.zeros(len(values), dtype=np.int64)
+    shift[valid] = offsets[inverse.reshape(-1)]
+    utc = pd.to_datetime(seconds, unit='s')
+    return (utc + pd.to_timedelta(shift, unit='s')).astype('datetime64[ns]')
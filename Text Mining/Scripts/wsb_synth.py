@@ -0,0 +1,243 @@
+"""
+Synthetic WallStreetBets corpus for measuring the ETL without the Reddit dumps.
+
+generateCorpus writes wallstreetbets_posts_<size>.csv and
+wallstreetbets_comments_<size>.csv with the raw dump columns
+(WSB_POST_HEADERS / WSB_COMM_HEADERS). It also writes a long-format market CSV
+that covers the same days. Text is drawn from a weighted token pool of WSB
+slang, stopwords, cashtags, "(GME)" and company names, emoji, URLs, @mentions
+and numbers. A share of bodies are copypasta repeated word for word, and some
+are [removed]/[deleted], so the sentiment cache and dedup have work to do.
+Authors are Zipf distributed. Comments form proper threads: a reply has the
+link_id of its parent.
+
+Rows are generated in chunks of CHUNK_ROWS, each from its own seed derived from
+(seed, file, chunk). The output depends only on the seed and the row count.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from wsb_schema import WSB_POST_HEADERS, WSB_COMM_HEADERS
+
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000}
+CHUNK_ROWS = 100000
+
+# 2021-01-01 to 2021-04-01 UTC, the GME squeeze and after.
+START_UTC = 1609459200
+END_UTC = 1617235200
+
+SUBREDDIT = 'wallstreetbets'
+SUBREDDIT_ID = 't5_2th52'
+# First ids, so synthetic ids look like 2021 Reddit ids and never collide between posts and comments.
+POST_ID_BASE = int('kn0000', 36)
+COMMENT_ID_BASE = int('gh00000', 36)
+
+WORDS = ['to', 'the', 'moon', 'apes', 'together', 'strong', 'hold', 'hodl', 'tendies', 'diamond', 'hands', 'paper',
+         'buy', 'the', 'dip', 'yolo', 'calls', 'puts', 'short', 'squeeze', 'gamma', 'hedge', 'funds', 'are', 'fucked',
+         'i', 'am', 'not', 'a', 'cat', 'this', 'is', 'the', 'way', 'retard', 'wife', 'boyfriend', 'loss', 'porn',
+         'gain', 'dd', 'shares', 'options', 'expire', 'friday', 'robinhood', 'melvin', 'citadel', 'shorts', 'have',
+         'not', 'covered', 'it', 'and', 'of', 'in', 'my', 'we', 'you', 'just', 'like', 'stock', 'what', 'when',
+         'good', 'bad', 'great', 'terrible', 'love', 'hate', 'win', 'lose', 'rich', 'broke', 'happy', 'sad']
+CASHTAGS = ['$GME', '$AMC', '$BB', '$NOK', '$TSLA', '$SLV', '$PLTR', '$SPCE', '(GME)', '(AMC)', '(BB)', 'GME', 'AMC']
+NAMES = ['gamestop', 'GameStop', 'blackberry', 'nokia', 'tesla', 'silver', 'space', 'kelloggs']
+EMOJI = ['\U0001F680', '\U0001F48E', '\U0001F64C', '\U0001F98D', '\U0001F315', '\U0001F4C8', '\U0001F921', '\U0001F4B0',
+         '\U0001F680\U0001F680\U0001F680', '\U0001F48E\U0001F64C']
+NUMBERS = ['420', '69', '69.420', '$500k', '10%', '1000%', '$GME 800c', '2/19', '40', '$320']
+PUNCTUATION = ['!!!', '?', '...', 'YOLO!', '&amp;', '-', '#1']
+
+COPYPASTA = [
+    "What is the GME short interest? It's 140% of the float. Apes together strong. "
+    "I am not a financial advisor and this is not financial advice \U0001F680\U0001F680\U0001F680",
+    "Hedge funds are fucked. $GME to the moon. \U0001F48E\U0001F64C\U0001F48E\U0001F64C "
+    "https://www.reddit.com/r/wallstreetbets/comments/l6omry/ I like the stock.",
+    "To the people who are buying now, you are the real heroes. HOLD THE LINE. "
+    "Do not sell. This is not about money anymore.",
+    "Sir, this is a Wendy's.",
+    "Positions or ban.",
+    "I am a simple man. I see GME, I upvote. \U0001F98D\U0001F98D\U0001F98D",
+]
+
+DOMAINS = ['self.wallstreetbets', 'i.redd.it', 'v.redd.it', 'reddit.com', 'youtube.com', 'twitter.com']
+DOMAIN_WEIGHTS = [0.6, 0.22, 0.05, 0.06, 0.04, 0.03]
+
+# Reddit ids are base36.
+def base36(n):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if n == 0:
+            return out
+
+# Token pool and draw weights.  URLs and @mentions come from a fixed seeded list,
+# so the pool is the same for every chunk.
+def tokenPool(seed=0):
+    rng = np.random.default_rng([seed, 99])
+    urls = (['https://www.reddit.com/r/wallstreetbets/comments/' + base36(x) + '/' for x in rng.integers(10 ** 8, 10 ** 9, 200)]
+            + ['https://i.redd.it/' + base36(x) + '.png' for x in rng.integers(10 ** 8, 10 ** 9, 100)]
+            + ['http://bit.ly/' + base36(x) for x in rng.integers(10 ** 6, 10 ** 7, 50)])
+    mentions = ['@' + base36(x) for x in rng.integers(10 ** 6, 10 ** 8, 100)]
+    groups = [(WORDS, 0.70), (CASHTAGS, 0.07), (NAMES, 0.03), (EMOJI, 0.07), (urls, 0.03),
+              (mentions, 0.02), (NUMBERS, 0.04), (PUNCTUATION, 0.04)]
+    tokens = []
+    weights = []
+    for group, share in groups:
+        tokens.extend(group)
+        weights.extend([share / len(group)] * len(group))
+    return np.array(tokens, dtype=object), np.array(weights) / sum(weights)
+
+# n texts of lognormal token counts.  copypasta/removed are the shares replaced by a copypasta or [removed]/[deleted].
+def makeTexts(rng, pool, n, meanTokens, copypasta=0.0, removed=0.0):
+    tokens, weights = pool
+    counts = np.maximum(1, rng.lognormal(np.log(meanTokens), 0.8, n).astype(np.int64))
+    draws = tokens[rng.choice(len(tokens), size=int(counts.sum()), p=weights)]
+    ends = np.cumsum(counts)
+    texts = [' '.join(draws[e - c:e]) for c, e in zip(counts, ends)]
+
+    kind = rng.random(n)
+    pasta = rng.integers(0, len(COPYPASTA), n)
+    gone = rng.integers(0, 2, n)
+    for i in np.flatnonzero(kind < copypasta + removed):
+        texts[i] = COPYPASTA[pasta[i]] if kind[i] < copypasta else ('[removed]', '[deleted]')[gone[i]]
+    return texts
+
+# Zipf distributed author names, with [deleted] for a share of rows.
+def makeAuthors(rng, n, poolSize):
+    ranks = (rng.zipf(1.3, n) - 1) % poolSize
+    authors = np.array(['u_' + base36(r * 7919 + 1000) for r in ranks], dtype=object)
+    authors[rng.random(n) < 0.05] = '[deleted]'
+    return authors
+
+# created_utc rising from START_UTC to END_UTC over the rows, with a little jitter.
+def makeTimes(rng, first, n, total):
+    span = END_UTC - START_UTC
+    base = START_UTC + (np.arange(first, first + n) * span) // max(total, 1)
+    return np.minimum(END_UTC - 1, base + rng.integers(0, 600, n))
+
+def writeChunks(path, header, chunks):
+    first = True
+    for df in chunks:
+        df[header].to_csv(path, mode='w' if first else 'a', header=first, index=False)
+        first = False
+
+def postChunks(rows, seed):
+    pool = tokenPool(seed)
+    for first in range(0, rows, CHUNK_ROWS):
+        n = min(CHUNK_ROWS, rows - first)
+        rng = np.random.default_rng([seed, 1, first // CHUNK_ROWS])
+        domain = rng.choice(len(DOMAINS), n, p=DOMAIN_WEIGHTS)
+        selftext = np.array(makeTexts(rng, pool, n, 40, copypasta=0.02, removed=0.15), dtype=object)
+        # Link posts have no self text.
+        selftext[domain != 0] = None
+        yield pd.DataFrame({'id': [base36(POST_ID_BASE + i) for i in range(first, first + n)],
+                            'author': makeAuthors(rng, n, max(1000, rows // 10)),
+                            'author_premium': rng.random(n) < 0.04,
+                            'created_utc': makeTimes(rng, first, n, rows),
+                            'domain': np.array(DOMAINS, dtype=object)[domain],
+                            'title': makeTexts(rng, pool, n, 9, copypasta=0.01),
+                            'selftext': selftext,
+                            'subreddit': SUBREDDIT,
+                            'subreddit_id': SUBREDDIT_ID,
+                            'num_comments': np.minimum(rng.zipf(1.6, n) - 1, 50000),
+                            'upvote_ratio': np.round(rng.uniform(0.3, 1.0, n), 2)})
+
+# Comment threads: about 40% are top level replies to a post, the rest reply to a
+# recent comment and share its link_id.  Posts are picked near the comment's
+# position in time.
+def commentChunks(rows, posts, seed):
+    pool = tokenPool(seed)
+    recent = np.empty(0, dtype=np.int64)  # link of the previous chunk's last comments
+    window = 200
+    for first in range(0, rows, CHUNK_ROWS):
+        n = min(CHUNK_ROWS, rows - first)
+        rng = np.random.default_rng([seed, 2, first // CHUNK_ROWS])
+        topLevel = rng.random(n) < 0.4
+        back = rng.integers(1, window + 1, n)
+        near = (np.arange(first, first + n) * posts) // max(rows, 1)
+        post = np.maximum(0, near - rng.integers(0, 50, n))
+
+        links = np.concatenate([recent, np.empty(n, dtype=np.int64)])
+        parents = np.empty(n, dtype=object)
+        offset = len(recent)
+        for i in range(n):
+            j = i - back[i]
+            if topLevel[i] or first + j < 0:
+                links[offset + i] = post[i]
+                parents[i] = 't3_' + base36(POST_ID_BASE + post[i])
+            else:
+                links[offset + i] = links[offset + j] if offset + j >= 0 else post[i]
+                parents[i] = 't1_' + base36(COMMENT_ID_BASE + first + j)
+        links = links[offset:]
+        recent = links[-window:]
+
+        yield pd.DataFrame({'id': [base36(COMMENT_ID_BASE + i) for i in range(first, first + n)],
+                            'parent_id': parents,
+                            'link_id': ['t3_' + base36(POST_ID_BASE + p) for p in links],
+                            'author': makeAuthors(rng, n, max(1000, rows // 20)),
+                            'created_utc': makeTimes(rng, first, n, rows),
+                            'body': makeTexts(rng, pool, n, 18, copypasta=0.04, removed=0.06),
+                            'subreddit': SUBREDDIT,
+                            'subreddit_id': SUBREDDIT_ID})
+
+# Write rows posts to path.
+def generatePosts(path, rows, seed=0):
+    writeChunks(path, WSB_POST_HEADERS, postChunks(rows, seed))
+    return path
+
+# Write rows comments replying to the first posts posts to path.
+def generateComments(path, rows, posts, seed=0):
+    writeChunks(path, WSB_COMM_HEADERS, commentChunks(rows, max(1, posts), seed))
+    return path
+
+# Daily random-walk OHLCV and RSI for the tickers, long format for market_data.loadMarketData.
+def generateMarket(path, tickers=('GME', 'AMC', 'BB', 'NOK', 'TSLA', 'SLV', 'SPCE', 'K'), seed=0):
+    rng = np.random.default_rng([seed, 3])
+    dates = pd.date_range(pd.to_datetime(START_UTC, unit='s'), pd.to_datetime(END_UTC, unit='s'), freq='D')
+    frames = []
+    for t in tickers:
+        close = 20 * np.exp(np.cumsum(rng.normal(0, 0.08, len(dates))))
+        frames.append(pd.DataFrame({'ticker': t, 'date': dates.strftime('%Y-%m-%d'),
+                                    'rsi': np.round(rng.uniform(20, 90, len(dates)), 2),
+                                    'open': np.round(close * rng.uniform(0.9, 1.1, len(dates)), 2),
+                                    'high': np.round(close * 1.15, 2), 'low': np.round(close * 0.85, 2),
+                                    'close': np.round(close, 2),
+                                    'volume': rng.integers(10 ** 6, 2 * 10 ** 8, len(dates)),
+                                    'adjusted': np.round(close, 2)}))
+    pd.concat(frames, ignore_index=True).to_csv(path, index=False)
+    return path
+
+# Rows for a size name such as '100k', or a plain number.
+def sizeRows(size):
+    return SIZES[size.lower()] if str(size).lower() in SIZES else int(size)
+
+# Write a posts file, a comments file and the market CSV of size rows each into folder.
+# Files already there are kept, so a corpus is generated once per seed and size.
+def generateCorpus(folder, size='10k', seed=0):
+    rows = sizeRows(size)
+    os.makedirs(folder, exist_ok=True)
+    name = str(size).lower() + '_s' + str(seed)
+    paths = {'posts': os.path.join(folder, 'wallstreetbets_posts_' + name + '.csv'),
+             'comments': os.path.join(folder, 'wallstreetbets_comments_' + name + '.csv'),
+             'market': os.path.join(folder, 'market_s' + str(seed) + '.csv')}
+    if not os.path.exists(paths['posts']):
+        generatePosts(paths['posts'] + '.tmp', rows, seed)
+        os.replace(paths['posts'] + '.tmp', paths['posts'])
+    if not os.path.exists(paths['comments']):
+        generateComments(paths['comments'] + '.tmp', rows, rows, seed)
+        os.replace(paths['comments'] + '.tmp', paths['comments'])
+    if not os.path.exists(paths['market']):
+        generateMarket(paths['market'], seed=seed)
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic WSB posts/comments corpus.')
+    parser.add_argument('folder')
+    parser.add_argument('--size', default='10k', help='10k, 100k, 1m, 10m or a row count')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generateCorpus(args.folder, args.size, args.seed))